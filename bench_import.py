@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright 2012-2014 John Whitlock
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+'''Microbenchmark for importing stop_times.txt
+
+Reports the rows per second of StopTime.import_txt on a synthetic feed, in
+a test database configured like run_tests.py.  By default, only the
+parsing and conversion is timed, and bulk_create is skipped.  Use --write
+to include the database inserts.
+
+To compare two versions, copy the script out of the tree, since commits
+before it was added don't have it, and run the copy on a checkout of each:
+
+    cp bench_import.py /tmp/bench_import.py
+    git worktree add /tmp/multigtfs-before <before>
+    python /tmp/bench_import.py --tree /tmp/multigtfs-before
+    python /tmp/bench_import.py --tree .
+    git worktree remove /tmp/multigtfs-before
+
+The --tree checkout's multigtfs and run_tests.py are imported instead of
+any installed version.
+'''
+
+from __future__ import print_function
+import argparse
+import os.path
+import sys
+import time
+
+import django
+from django.conf import settings
+from django.utils.six import StringIO
+
+
+def make_feed(trips, stops):
+    '''Create a feed with a route, trips and stops'''
+    from multigtfs.models import Feed, Route, Stop, Trip
+
+    feed = Feed.objects.create(name='Benchmark')
+    route = Route.objects.create(feed=feed, route_id='R1', rtype=3)
+    Trip.objects.bulk_create(
+        Trip(route=route, trip_id='T%d' % t) for t in range(trips))
+    Stop.objects.bulk_create(
+        Stop(feed=feed, stop_id='S%d' % s, name='Stop %d' % s,
+             point='POINT(-117.1 36.4)') for s in range(stops))
+    return feed
+
+
+def make_stop_times(trips, stops):
+    '''Create the text of a stop_times.txt'''
+    lines = [
+        'trip_id,arrival_time,departure_time,stop_id,stop_sequence,'
+        'pickup_type,drop_off_type,shape_dist_traveled']
+    for t in range(trips):
+        for s in range(stops):
+            seconds = 6 * 3600 + t * 60 + s * 90
+            hms = '%d:%02d:%02d' % (
+                seconds // 3600, (seconds // 60) % 60, seconds % 60)
+            lines.append('T%d,%s,%s,S%d,%d,0,0,%0.2f' % (
+                t, hms, hms, s, s + 1, s * 0.25))
+    return '\n'.join(lines) + '\n'
+
+
+def run(trips, stops, repeat, write):
+    from multigtfs.models import StopTime
+
+    feed = make_feed(trips, stops)
+    stop_times_txt = make_stop_times(trips, stops)
+    rows = trips * stops
+
+    manager_class = type(StopTime.objects)
+    bulk_create = manager_class.bulk_create
+    if not write:
+        manager_class.bulk_create = lambda self, objs, *a, **kw: objs
+    try:
+        best = None
+        for attempt in range(repeat):
+            StopTime.objects.all().delete()
+            start = time.time()
+            StopTime.import_txt(StringIO(stop_times_txt), feed)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+            print('Run %d: %d rows in %0.3f seconds, %0.0f rows/second' % (
+                attempt + 1, rows, elapsed, rows / elapsed))
+    finally:
+        manager_class.bulk_create = bulk_create
+    print('Best: %0.0f rows/second (%s)' % (
+        rows / best, 'with inserts' if write else 'conversion only'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--trips', type=int, default=2000, help='Number of trips')
+    parser.add_argument(
+        '--stops', type=int, default=50, help='Number of stops per trip')
+    parser.add_argument(
+        '--repeat', type=int, default=3, help='Number of timed runs')
+    parser.add_argument(
+        '--write', action='store_true', default=False,
+        help='Include the database inserts in the timing')
+    parser.add_argument(
+        '--tree', default=os.path.dirname(os.path.abspath(__file__)),
+        help='The source tree to benchmark, by default the one with this'
+             ' script')
+    args = parser.parse_args()
+
+    # Import multigtfs and the test settings from the tree
+    sys.path.insert(0, os.path.abspath(args.tree))
+    from run_tests import test_config
+
+    config = test_config()
+    config['DEBUG'] = False
+    settings.configure(**config)
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        run(args.trips, args.stops, args.repeat, args.write)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#
+# Copyright 2012-2014 John Whitlock
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Read and write GTFS tables as typed Parquet files
+
+Each GTFS file is a Parquet file of the same name (stop_times.parquet for
+stop_times.txt), with a typed column per GTFS column, so that analytics
+tools can load the tables without parsing CSV.  This requires pyarrow,
+which is installed by the 'parquet' extra:
+
+    pip install multigtfs[parquet]
+
+See Feed.export_parquet and Feed.import_parquet.
+"""
+from __future__ import unicode_literals
+import os.path
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: nocover
+    pyarrow = None
+
+# Rows per Parquet row group
+row_group_size = 100000
+
+
+def require_pyarrow():
+    """Raise an ImportError if pyarrow is not installed."""
+    if pyarrow is None:  # pragma: nocover
+        raise ImportError(
+            'pyarrow is required for Parquet files.  Install it with'
+            ' "pip install multigtfs[parquet]".')
+
+
+def arrow_type(kind):
+    """Get the Arrow type of an exported column kind
+
+    See Base.export_typed_batches for the kinds.  Times are int32 seconds
+    after noon minus 12 hours, and points are float64 latitude and
+    longitude columns.
+    """
+    return {
+        'date': pyarrow.date32,
+        'bool': pyarrow.bool_,
+        'seconds': pyarrow.int32,
+        'integer': pyarrow.int64,
+        'float': pyarrow.float64,
+        'point': pyarrow.float64,
+    }.get(kind, pyarrow.string)()
+
+
+def parquet_name(filename):
+    """Get the Parquet file name for a GTFS file name"""
+    return os.path.splitext(filename)[0] + '.parquet'
+
+
+def write_parquet(path, columns, batches):
+    """Write batches of typed rows as a Parquet file
+
+    Keyword arguments:
+    path - The path of the Parquet file
+    columns - The (name, kind) pairs from Base.export_typed_batches
+    batches - The batches of rows that follow
+
+    Returns the number of rows written
+    """
+    require_pyarrow()
+    names = [name for name, _ in columns]
+    types = [arrow_type(kind) for _, kind in columns]
+    schema = pyarrow.schema(
+        [pyarrow.field(name, type_) for name, type_ in zip(names, types)])
+
+    def write_rows(rows):
+        arrays = [
+            pyarrow.array(list(values), type=type_)
+            for values, type_ in zip(zip(*rows), types)]
+        parquet_writer.write_table(
+            pyarrow.Table.from_arrays(arrays, names=names))
+
+    parquet_writer = pyarrow.parquet.ParquetWriter(path, schema)
+    count = 0
+    pending = []
+    try:
+        for rows in batches:
+            pending.extend(rows)
+            if len(pending) >= row_group_size:
+                write_rows(pending)
+                count += len(pending)
+                pending = []
+        if pending:
+            write_rows(pending)
+            count += len(pending)
+    finally:
+        parquet_writer.close()
+    return count
+
+
+class ParquetRows(object):
+    """The rows of a Parquet file, for Base.import_txt(typed=True)
+
+    The header row is followed by the data rows, read one row group at a
+    time.  Blank text is '' rather than None, as in a GTFS file.  line_num
+    is the number of rows read, counting the header, like a csv.reader.
+    """
+
+    def __init__(self, path):
+        require_pyarrow()
+        self.parquet_file = pyarrow.parquet.ParquetFile(path)
+        self.schema = pyarrow.parquet.read_schema(path)
+        self.line_num = 0
+
+    def __iter__(self):
+        names = list(self.schema.names)
+        is_text = [pyarrow.types.is_string(t) for t in self.schema.types]
+        self.line_num = 1
+        yield names
+        for index in range(self.parquet_file.num_row_groups):
+            table = self.parquet_file.read_row_group(index)
+            columns = []
+            for name, text in zip(names, is_text):
+                values = table.column(name).to_pylist()
+                if text:
+                    values = ['' if v is None else v for v in values]
+                columns.append(values)
+            for row in zip(*columns):
+                self.line_num += 1
+                yield list(row)
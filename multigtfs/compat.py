@@ -3,11 +3,14 @@
 Handle compatibility between Python versions, Django versions, etc.
 """
 from codecs import BOM_UTF8
+from contextlib import contextmanager
 from distutils.version import LooseVersion
+from tempfile import TemporaryFile
 from zipfile import ZipFile, ZIP_DEFLATED
+import sys
 
 from django import get_version
-from django.utils.six import PY3, binary_type, text_type
+from django.utils.six import PY3, StringIO, binary_type, text_type
 
 DJ_VERSION = LooseVersion(get_version())
 
@@ -88,6 +91,37 @@ def opener_from_zipfile(zipfile):
     return opener
 
 
+def temporary_text_file():
+    """Open a temporary file for writing, then reading, UTF-8 text."""
+    if PY3:
+        return TemporaryFile('w+', encoding='utf-8', newline='')
+    else:
+        return TemporaryFile('w+b')
+
+
+@contextmanager
+def writable_zipfile_entry(zipfile, filename):
+    """
+    Open a text file in a zipfile for writing, as a context manager.
+
+    In Python 3.6 and later, the text is compressed into the zipfile as it is
+    written.  Earlier versions can't write a zipfile entry in pieces, so the
+    text is collected in memory and written when the context exits.
+    """
+    if sys.version_info >= (3, 6):
+        from io import TextIOWrapper
+        # The size isn't known in advance, so allow entries over 2 GB
+        with zipfile.open(filename, 'w', force_zip64=True) as raw:
+            text = TextIOWrapper(raw, encoding='utf-8', newline='')
+            yield text
+            text.flush()
+            text.detach()
+    else:  # pragma: nocover
+        text = StringIO()
+        yield text
+        zipfile.writestr(filename, text.getvalue())
+
+
 def write_text_rows(writer, rows):
     '''Write CSV row data which may include text.'''
     for row in rows:
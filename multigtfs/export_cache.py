@@ -0,0 +1,130 @@
+#
+# Copyright 2012-2014 John Whitlock
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache exported GTFS zipfiles on local disk
+
+The export of an unchanged feed is the same every time.  An ExportCache
+keeps the exported zipfiles in a directory, named by the feed ID and the
+feed version (see Feed.bump_version), so a feed is only exported again
+after its records change.  When the files are larger than max_size, the
+least recently used are removed:
+
+    cache = ExportCache('/var/cache/gtfs', max_size=2 * 1024 ** 3)
+    path = cache.get_path(feed)
+"""
+from __future__ import unicode_literals
+from logging import getLogger
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+
+from django.utils.six import string_types
+
+logger = getLogger(__name__)
+re_cached = re.compile(r'^feed-(?P<feed_id>\d+)-(?P<version>\d+)\.zip$')
+
+
+class ExportCache(object):
+    '''A directory of exported GTFS zipfiles
+
+    Keyword arguments:
+    directory - The directory for the zipfiles, which is created if needed
+    max_size - The maximum total size of the zipfiles in bytes, or None for
+        no limit.  The newest zipfile is kept, even if it is larger.
+    export_kwargs - Keyword arguments for Feed.export_gtfs, such as jobs,
+        except subset
+    '''
+
+    def __init__(self, directory, max_size=None, **export_kwargs):
+        if export_kwargs.get('subset') is not None:
+            raise ValueError('Exports of a subset are not cached')
+        self.directory = directory
+        self.max_size = max_size
+        self.export_kwargs = export_kwargs
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_path(self, feed):
+        '''Get the path of the exported feed, exporting it if needed'''
+        from multigtfs.models import Feed
+        version = Feed.objects.values_list('version', flat=True).get(
+            id=feed.id)
+        path = os.path.join(
+            self.directory, 'feed-%d-%d.zip' % (feed.id, version))
+        with self.lock:
+            if os.path.exists(path):
+                os.utime(path, None)  # Mark as recently used
+                logger.info('Using cached export %s', path)
+                return path
+
+        fd, temp_path = tempfile.mkstemp(
+            suffix='.tmp', prefix='feed-%d-' % feed.id, dir=self.directory)
+        os.close(fd)
+        try:
+            feed.export_gtfs(temp_path, **self.export_kwargs)
+            os.rename(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        with self.lock:
+            self._evict(path)
+        return path
+
+    def export_gtfs(self, feed, gtfs_file):
+        '''Copy the exported feed to a path or a writable binary file'''
+        path = self.get_path(feed)
+        if isinstance(gtfs_file, string_types):
+            shutil.copyfile(path, gtfs_file)
+        else:
+            with open(path, 'rb') as cached:
+                shutil.copyfileobj(cached, gtfs_file)
+
+    def _evict(self, newest):
+        '''Remove old versions, then the least recently used zipfiles'''
+        latest = {}
+        cached = []
+        for name in os.listdir(self.directory):
+            match = re_cached.match(name)
+            if not match:
+                continue
+            path = os.path.join(self.directory, name)
+            feed_id, version = [int(v) for v in match.groups()]
+            stat = os.stat(path)
+            cached.append(
+                (stat.st_mtime, stat.st_size, path, feed_id, version))
+            latest[feed_id] = max(latest.get(feed_id, version), version)
+
+        # Older versions are never used again
+        current = []
+        for mtime, size, path, feed_id, version in cached:
+            if version < latest[feed_id]:
+                logger.info('Removing outdated export %s', path)
+                os.remove(path)
+            else:
+                current.append((mtime, size, path))
+
+        if self.max_size is None:
+            return
+        total = sum(size for _, size, _ in current)
+        for mtime, size, path in sorted(current):
+            if total <= self.max_size:
+                break
+            if path != newest:
+                logger.info('Removing least recently used export %s', path)
+                os.remove(path)
+                total -= size
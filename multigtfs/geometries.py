@@ -0,0 +1,164 @@
+#
+# Copyright 2012-2014 John Whitlock
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Coalesce the cached geometry updates of a block of edits
+
+Saving a ShapePoint or a Stop updates the cached geometries that depend on
+it right away, so editing every point of a shape rebuilds the shape, its
+trips and their routes once per point.  Inside a GeometryBatch, the saves
+are only noted, and each affected geometry is updated once at the end:
+
+    with GeometryBatch():
+        for point in shape.points.all():
+            point.point = fix(point.point)
+            point.save()
+"""
+from __future__ import unicode_literals
+from collections import defaultdict
+from logging import getLogger
+import threading
+
+from django.db import connection, transaction
+from django.utils.six.moves import queue
+
+logger = getLogger(__name__)
+_local = threading.local()
+_queue = queue.Queue()
+_worker_lock = threading.Lock()
+_worker = []
+
+
+def current_batch():
+    '''Get the innermost active GeometryBatch of this thread, or None'''
+    batches = getattr(_local, 'batches', None)
+    return batches[-1] if batches else None
+
+
+class GeometryBatch(object):
+    '''Collect the edited shapes and stops, and update geometries once
+
+    Keyword arguments:
+    on_commit - If True, update the geometries when the current transaction
+        is committed, instead of at the end of the block.  The update is
+        dropped if the transaction is rolled back.  Django 1.8 doesn't
+        support this, and updates at the end of the block.
+    background - If True, queue the update for a background thread.  Use
+        wait_for_geometry_updates() to wait for the queue to empty.
+
+    A batch inside another batch adds its edits to the outer batch.  If the
+    block raises an exception, no geometries are updated, but they are still
+    marked as out of date (see Feed.update_dirty_geometries).
+    '''
+
+    def __init__(self, on_commit=False, background=False):
+        self.on_commit = on_commit
+        self.background = background
+        self.shape_ids = set()
+        self.stop_ids = set()
+
+    def __enter__(self):
+        if not hasattr(_local, 'batches'):
+            _local.batches = []
+        _local.batches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.batches.pop()
+        outer = current_batch()
+        if outer is not None:
+            outer.shape_ids.update(self.shape_ids)
+            outer.stop_ids.update(self.stop_ids)
+        elif exc_type is None:
+            on_commit = getattr(transaction, 'on_commit', None)
+            if self.on_commit and on_commit:
+                on_commit(self.update)
+            else:
+                self.update()
+
+    def update(self):
+        '''Update the geometries of the collected shapes and stops'''
+        pending = (self.shape_ids, self.stop_ids)
+        self.shape_ids, self.stop_ids = set(), set()
+        if not any(pending):
+            return
+        if self.background:
+            _start_worker()
+            _queue.put(pending)
+        else:
+            update_geometries(*pending)
+
+
+def update_geometries(shape_ids, stop_ids):
+    '''Update the geometries affected by edits to shapes and stops
+
+    The shapes are updated, then the trips of the shapes and the trips
+    without a shape that visit the stops, then the routes of the trips,
+    one feed at a time.
+    '''
+    from multigtfs.models import Feed, Shape, StopTime, Trip
+    from multigtfs.models.base import in_batch_size
+
+    trip_ids = set()
+    stop_list = sorted(stop_ids)
+    for start in range(0, len(stop_list), in_batch_size):
+        trip_ids.update(StopTime.objects.filter(
+            stop_id__in=stop_list[start:start + in_batch_size],
+            trip__shape=None).values_list('trip_id', flat=True))
+
+    def by_feed(klass, feed_field, ids):
+        feed_ids = defaultdict(set)
+        id_list = sorted(ids)
+        for start in range(0, len(id_list), in_batch_size):
+            for feed_id, obj_id in klass.objects.filter(
+                    id__in=id_list[start:start + in_batch_size]
+                    ).values_list(feed_field, 'id'):
+                feed_ids[feed_id].add(obj_id)
+        return feed_ids
+
+    feed_shapes = by_feed(Shape, 'feed', shape_ids)
+    feed_trips = by_feed(Trip, 'route__feed', trip_ids)
+    feeds = Feed.objects.filter(
+        id__in=set(feed_shapes) | set(feed_trips)).order_by('id')
+    for feed in feeds:
+        feed.update_geometries(
+            feed_shapes.get(feed.id, set()), feed_trips.get(feed.id, set()))
+
+
+def wait_for_geometry_updates():
+    '''Wait for the queued background geometry updates to finish'''
+    _queue.join()
+
+
+def _start_worker():
+    '''Start the background thread, if it isn't running'''
+    with _worker_lock:
+        if not _worker:
+            thread = threading.Thread(
+                target=_work, name='multigtfs-geometries')
+            thread.daemon = True
+            thread.start()
+            _worker.append(thread)
+
+
+def _work():
+    '''Update queued geometries in the background thread'''
+    while True:
+        pending = _queue.get()
+        try:
+            update_geometries(*pending)
+        except Exception:
+            logger.exception('Background geometry update failed')
+        finally:
+            connection.close()
+            _queue.task_done()
@@ -0,0 +1,86 @@
+#
+# Copyright 2012-2014 John Whitlock
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Drop and rebuild secondary indexes around a bulk import
+
+Building an index once over a loaded table is much faster than updating it
+for every inserted row.  Primary keys and unique constraints are kept.
+PostgreSQL / PostGIS and SQLite / SpatiaLite are supported.
+"""
+from __future__ import unicode_literals
+from logging import getLogger
+
+from django.db import connection
+
+logger = getLogger(__name__)
+
+
+def supports_deferred_indexes():
+    '''Return True if the database backend can drop and rebuild indexes'''
+    return connection.vendor in ('postgresql', 'sqlite')
+
+
+def drop_indexes(models):
+    '''Drop the secondary indexes on the tables of the models
+
+    Returns a list of (sql, params) statements to rebuild them.
+    '''
+    rebuild = []
+    quote_name = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for model in models:
+            table = model._meta.db_table
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT indexname, indexdef FROM pg_indexes'
+                    ' WHERE schemaname = current_schema()'
+                    ' AND tablename = %s AND indexname NOT IN ('
+                    '  SELECT conname FROM pg_constraint'
+                    '  WHERE conrelid = %s::regclass)', [table, table])
+            else:
+                cursor.execute(
+                    "SELECT name, sql FROM sqlite_master WHERE type = 'index'"
+                    " AND tbl_name = %s AND sql IS NOT NULL", [table])
+            indexes = cursor.fetchall()
+            for name, sql in indexes:
+                cursor.execute('DROP INDEX %s' % quote_name(name))
+                rebuild.append((sql, None))
+
+            # SpatiaLite keeps spatial indexes in R*Tree tables
+            if getattr(connection.ops, 'spatialite', False):
+                cursor.execute(
+                    'SELECT f_geometry_column FROM geometry_columns'
+                    ' WHERE f_table_name = %s AND spatial_index_enabled = 1',
+                    [table.lower()])
+                for (column,) in cursor.fetchall():
+                    cursor.execute(
+                        'SELECT DisableSpatialIndex(%s, %s)', [table, column])
+                    cursor.execute('DROP TABLE IF EXISTS %s' % quote_name(
+                        'idx_%s_%s' % (table, column)))
+                    rebuild.append((
+                        'SELECT CreateSpatialIndex(%s, %s)', [table, column]))
+            logger.info(
+                'Dropped %d indexes on %s', len(indexes), table)
+    return rebuild
+
+
+def rebuild_indexes(rebuild, models):
+    '''Rebuild the indexes dropped by drop_indexes, then analyze the tables'''
+    with connection.cursor() as cursor:
+        for sql, params in rebuild:
+            cursor.execute(sql, params)
+        for model in models:
+            cursor.execute(
+                'ANALYZE %s' % connection.ops.quote_name(model._meta.db_table))
+    logger.info('Rebuilt %d indexes', len(rebuild))
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import unicode_literals
+from datetime import datetime
 import logging
 
 from django.db import connection
@@ -20,7 +21,9 @@ from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from django.template.defaultfilters import slugify
 
+from multigtfs.export_cache import ExportCache
 from multigtfs.models.feed import Feed
+from multigtfs.models.subset import FeedSubset
 
 
 class Command(BaseCommand):
@@ -37,6 +40,77 @@ class Command(BaseCommand):
                             type=str,
                             dest='name',
                             help='Set the name of the exported feed')
+        parser.add_argument('--copy',
+                            action='store_true',
+                            dest='use_copy',
+                            default=False,
+                            help=(
+                                'Format and stream rows with COPY TO STDOUT,'
+                                ' for PostgreSQL databases'))
+        parser.add_argument('-j', '--jobs',
+                            type=int,
+                            dest='jobs',
+                            default=1,
+                            help=(
+                                'Export up to this many files at the same'
+                                ' time, for PostgreSQL databases'))
+        parser.add_argument('--cache',
+                            type=str,
+                            dest='cache',
+                            metavar='DIRECTORY',
+                            help=(
+                                'Keep exported feeds in this directory, and'
+                                ' reuse them until the feed is changed'))
+        parser.add_argument('--cache-size',
+                            type=int,
+                            dest='cache_size',
+                            metavar='MB',
+                            help=(
+                                'Remove the least recently used exports when'
+                                ' the cache is larger than this'))
+        parser.add_argument('--parquet',
+                            action='store_true',
+                            dest='parquet',
+                            default=False,
+                            help=(
+                                'Export a directory of typed Parquet files'
+                                ' instead of a zipfile (requires pyarrow)'))
+        parser.add_argument('--route',
+                            action='append',
+                            dest='route_ids',
+                            metavar='ROUTE_ID',
+                            help=(
+                                'Export just the trips of this route, and'
+                                ' the records they refer to.  Can be'
+                                ' repeated'))
+        parser.add_argument('--agency',
+                            action='append',
+                            dest='agency_ids',
+                            metavar='AGENCY_ID',
+                            help=(
+                                'Export just the trips of this agency\'s'
+                                ' routes.  Can be repeated'))
+        parser.add_argument('--start-date',
+                            type=str,
+                            dest='start_date',
+                            metavar='YYYYMMDD',
+                            help=(
+                                'Export just the trips with service on or'
+                                ' after this date'))
+        parser.add_argument('--end-date',
+                            type=str,
+                            dest='end_date',
+                            metavar='YYYYMMDD',
+                            help=(
+                                'Export just the trips with service on or'
+                                ' before this date'))
+        parser.add_argument('--bbox',
+                            type=str,
+                            dest='bbox',
+                            metavar='MIN_LON,MIN_LAT,MAX_LON,MAX_LAT',
+                            help=(
+                                'Export just the trips that stop inside'
+                                ' this box'))
 
     def handle(self, *args, **options):
         # Setup logging
@@ -71,11 +145,64 @@ class Command(BaseCommand):
             feed = Feed.objects.get(id=feed_id)
         except Feed.DoesNotExist:
             raise CommandError('Feed %s not found' % feed_id)
+        subset = self.get_subset(options)
+        if subset is not None and options.get('cache'):
+            raise CommandError('--cache can not be used with a subset')
         out_name = options.get('name') or slugify(feed.name)
+        if options.get('parquet'):
+            self.stdout.write(
+                "Exporting Feed %s to %s...\n" % (feed_id, out_name))
+            try:
+                feed.export_parquet(out_name, subset=subset)
+            except ImportError as error:
+                raise CommandError(str(error))
+            self.stdout.write(
+                "Successfully exported Feed %s to %s\n" % (feed_id, out_name))
+            return
         if not out_name.endswith('.zip'):
             out_name += '.zip'
         self.stdout.write(
             "Exporting Feed %s to %s...\n" % (feed_id, out_name))
-        feed.export_gtfs(out_name)
+        export_kwargs = {
+            'use_copy': options.get('use_copy'),
+            'jobs': options.get('jobs') or 1,
+        }
+        if subset is not None:
+            export_kwargs['subset'] = subset
+        if options.get('cache'):
+            cache_size = options.get('cache_size')
+            if cache_size is not None:
+                cache_size *= 1024 * 1024
+            cache = ExportCache(
+                options['cache'], max_size=cache_size, **export_kwargs)
+            cache.export_gtfs(feed, out_name)
+        else:
+            feed.export_gtfs(out_name, **export_kwargs)
         self.stdout.write(
             "Successfully exported Feed %s to %s\n" % (feed_id, out_name))
+
+    def get_subset(self, options):
+        """Get the FeedSubset selected by the options, or None"""
+        dates = {}
+        for name in ('start_date', 'end_date'):
+            value = options.get(name)
+            if value:
+                try:
+                    dates[name] = datetime.strptime(value, '%Y%m%d').date()
+                except ValueError:
+                    raise CommandError('Invalid date "%s"' % value)
+        bbox = options.get('bbox')
+        if bbox:
+            try:
+                bbox = tuple(float(v) for v in bbox.split(','))
+            except ValueError:
+                bbox = ()
+            if len(bbox) != 4:
+                raise CommandError('Invalid bbox "%s"' % options['bbox'])
+        route_ids = options.get('route_ids')
+        agency_ids = options.get('agency_ids')
+        if not (dates or bbox or route_ids or agency_ids):
+            return None
+        return FeedSubset(
+            route_ids=route_ids, agency_ids=agency_ids, bbox=bbox or None,
+            **dates)
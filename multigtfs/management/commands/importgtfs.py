@@ -14,13 +14,15 @@
 # limitations under the License.
 from __future__ import unicode_literals
 from datetime import datetime
+import json
 import logging
 
 from django.db import connection
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
 from multigtfs.models import Agency, Feed, Service
+from multigtfs.signals import ImportReport
 
 
 class Command(BaseCommand):
@@ -40,6 +42,75 @@ class Command(BaseCommand):
                                 'Set the name of the imported feed.  Defaults'
                                 ' to name derived from agency name and'
                                 ' start date'))
+        parser.add_argument('--copy',
+                            action='store_true',
+                            dest='use_copy',
+                            default=False,
+                            help=(
+                                'Load rows with COPY FROM STDIN, for'
+                                ' PostgreSQL databases'))
+        parser.add_argument('-j', '--jobs',
+                            type=int,
+                            dest='jobs',
+                            default=1,
+                            help=(
+                                'Import up to this many independent files'
+                                ' at the same time'))
+        parser.add_argument('--dedupe',
+                            choices=('memory', 'database'),
+                            dest='dedupe',
+                            default='memory',
+                            help=(
+                                'Drop duplicate rows while reading (memory),'
+                                ' or delete them after loading each file'
+                                ' (database)'))
+        parser.add_argument('--atomic',
+                            choices=('file', 'feed'),
+                            dest='atomic',
+                            default=None,
+                            help=(
+                                'Import each file (file) or the whole feed'
+                                ' (feed) in a transaction'))
+        parser.add_argument('-b', '--batch-size',
+                            action='append',
+                            dest='batch_size',
+                            metavar='[NAME=]SIZE',
+                            default=[],
+                            help=(
+                                'Insert this many rows at a time, for all'
+                                ' files or for the model or file NAME, such'
+                                ' as stop_times.txt=50000.  Can be repeated'))
+        parser.add_argument('--resume',
+                            type=int,
+                            dest='resume',
+                            metavar='FEED_ID',
+                            help=(
+                                'Continue an interrupted import into this'
+                                ' feed, skipping the files and rows already'
+                                ' imported'))
+        parser.add_argument('--defer-indexes',
+                            action='store_true',
+                            dest='defer_indexes',
+                            default=False,
+                            help=(
+                                'Drop the indexes of the stop_time, trip,'
+                                ' and shape_point tables while loading, and'
+                                ' rebuild them at the end.  Only for a'
+                                ' database without other feeds'))
+        parser.add_argument('--report',
+                            type=str,
+                            dest='report',
+                            metavar='PATH',
+                            help=(
+                                'Write the timings of the import as JSON'
+                                ' to this file'))
+        parser.add_argument('--update',
+                            type=int,
+                            dest='update',
+                            metavar='FEED_ID',
+                            help=(
+                                'Update this feed in place to match the'
+                                ' GTFS feed, writing only the changed rows'))
 
     def handle(self, *args, **options):
         gtfs_feed = options.get('gtfs_feed')
@@ -72,8 +143,55 @@ class Command(BaseCommand):
         if settings.DEBUG:
             connection.use_debug_cursor = False
 
-        feed = Feed.objects.create(name=name)
-        feed.import_gtfs(gtfs_feed)
+        batch_size = {}
+        for setting in options.get('batch_size') or []:
+            key, _, size = setting.rpartition('=')
+            try:
+                batch_size[key or None] = int(size)
+            except ValueError:
+                raise CommandError('Invalid batch size "%s"' % setting)
+
+        update = options.get('update')
+        if update:
+            try:
+                feed = Feed.objects.get(id=update)
+            except Feed.DoesNotExist:
+                raise CommandError('Feed %s not found' % update)
+            changes = feed.update_gtfs(
+                gtfs_feed, batch_size=batch_size or None)
+            for filename in sorted(changes):
+                change = changes[filename]
+                self.stdout.write(
+                    "%s: %d inserted, %d updated, %d deleted\n" % (
+                        filename, len(change['inserted']),
+                        len(change['updated']), change['deleted']))
+            self.stdout.write("Successfully updated Feed %s\n" % (feed))
+            return
+
+        resume = options.get('resume')
+        if resume:
+            try:
+                feed = Feed.objects.get(id=resume)
+            except Feed.DoesNotExist:
+                raise CommandError('Feed %s not found' % resume)
+            if options.get('name'):
+                feed.name = name
+                feed.save()
+            elif feed.name.startswith('Imported at '):
+                unset_name = feed.name
+        else:
+            feed = Feed.objects.create(name=name)
+        with ImportReport(feed) as report:
+            feed.import_gtfs(
+                gtfs_feed, use_copy=options.get('use_copy'),
+                jobs=options.get('jobs') or 1,
+                dedupe=options.get('dedupe') or 'memory',
+                batch_size=batch_size or None,
+                atomic=options.get('atomic'), resume=bool(resume),
+                defer_indexes=options.get('defer_indexes'))
+        if options.get('report'):
+            with open(options['report'], 'w') as report_file:
+                json.dump(report.as_dict(), report_file, indent=2)
 
         # Set name based on feed
         if feed.name == unset_name:
@@ -13,14 +13,69 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import unicode_literals
+from collections import defaultdict
+from multiprocessing import Pool
 import logging
 import time
 
+import django
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db import connection
+from django.db import connection, connections
 
-from multigtfs.models import Feed, Route, Shape, Trip
+# The geometry stages and their models, in the order they depend on each
+# other.  The models are imported when needed, since worker processes
+# started with "spawn" (the default on macOS and Windows) import this
+# module before Django is set up.
+stages = (('shapes', 'Shape'), ('trips', 'Trip'), ('routes', 'Route'))
+
+# The most IDs refreshed by one worker task
+shard_size = 5000
+
+
+def setup_worker():
+    '''Prepare a worker process to use the database
+
+    A spawned worker starts a new interpreter, which sets up Django from
+    the DJANGO_SETTINGS_MODULE environment variable.
+    '''
+    django.setup()
+
+
+def stage_model(stage):
+    '''Get the model of a geometry stage'''
+    from multigtfs import models
+    return getattr(models, dict(stages)[stage])
+
+
+def refresh_shard(shard):
+    '''Refresh the geometries of a range of IDs in a worker process
+
+    shard is a tuple (stage, feed ID, first ID, last ID).  Returns a tuple
+    (stage, feed ID, objects checked, objects changed, elapsed seconds).
+    '''
+    from multigtfs.models import Feed
+    stage, feed_id, first_id, last_id = shard
+    start_time = time.time()
+    model = stage_model(stage)
+    feed = Feed.objects.get(id=feed_id)
+    ids = list(model.objects.in_feed(feed).filter(
+        id__range=(first_id, last_id)).values_list('id', flat=True))
+    changed = model.update_geometries(feed, ids)
+    connection.close()
+    return stage, feed_id, len(ids), changed, time.time() - start_time
+
+
+def plan_shards(stage, model, feeds):
+    '''Split the objects of the feeds into ID ranges of shard_size'''
+    shards = []
+    for feed in feeds:
+        ids = list(model.objects.in_feed(feed).order_by(
+            'id').values_list('id', flat=True))
+        for start in range(0, len(ids), shard_size):
+            chunk = ids[start:start + shard_size]
+            shards.append((stage, feed.id, chunk[0], chunk[-1]))
+    return shards
 
 
 class Command(BaseCommand):
@@ -39,6 +94,20 @@ class Command(BaseCommand):
                             dest='all',
                             default=False,
                             help='Update all feeds')
+        parser.add_argument('-j', '--jobs',
+                            type=int,
+                            dest='jobs',
+                            default=1,
+                            help=(
+                                'Refresh in this many worker processes,'
+                                ' sharded by feed and ID range'))
+        parser.add_argument('--dirty-only',
+                            action='store_true',
+                            dest='dirty_only',
+                            default=False,
+                            help=(
+                                'Only refresh the geometries marked as out'
+                                ' of date by edits'))
         parser.add_argument('-q', '--quiet',
                             action='store_false',
                             dest='verbose',
@@ -46,6 +115,7 @@ class Command(BaseCommand):
                             help="Don't print status messages to stdout")
 
     def handle(self, *args, **options):
+        from multigtfs.models import Feed
         total_start = time.time()
 
         # Validate the arguments
@@ -55,6 +125,10 @@ class Command(BaseCommand):
             raise CommandError('You must pass in a feed ID or --all.')
         if len(feed_ids) > 0 and all_feeds:
             raise CommandError("You can't specify a feed and --all.")
+        jobs = options.get('jobs') or 1
+        dirty_only = options.get('dirty_only')
+        if dirty_only and jobs > 1:
+            raise CommandError("You can't specify --dirty-only and --jobs.")
 
         # Setup logging
         verbosity = int(options['verbosity'])
@@ -94,47 +168,68 @@ class Command(BaseCommand):
                     raise CommandError('Feed %s not found' % feed_id)
 
         # Refresh the geometries
+        if jobs > 1:
+            self.refresh_parallel(list(feeds), jobs, logger)
+        else:
+            for feed in feeds:
+                logger.info(
+                    "Updating geometries in Feed %s (ID %s)...",
+                    feed.name, feed.id)
+                start_time = time.time()
+                if dirty_only:
+                    feed.update_dirty_geometries()
+                else:
+                    feed.update_geometries()
+                end_time = time.time()
+                logger.info(
+                    "Feed %d: Updated geometries in %0.1f seconds.",
+                    feed.id, end_time - start_time)
+
+        total_end = time.time()
+        logger.info(
+            "Updated geometries in %d feed%s in %0.1f seconds.",
+            len(feeds), '' if len(feeds) == 1 else 's',
+            total_end - total_start)
+
+    def refresh_parallel(self, feeds, jobs, logger):
+        '''Refresh the geometries of feeds in worker processes
+
+        Each stage (shapes, trips, then routes) is finished for all the
+        feeds before the next starts, since it is built from the last.
+        '''
+        report = defaultdict(lambda: [0, 0, 0, 0.0])
+        # The workers open their own database connections
+        for conn in connections.all():
+            conn.close()
+        pool = Pool(jobs, initializer=setup_worker)
+        try:
+            for stage, _ in stages:
+                start_time = time.time()
+                shards = plan_shards(stage, stage_model(stage), feeds)
+                connection.close()
+                done = 0
+                for result in pool.imap_unordered(refresh_shard, shards):
+                    _, feed_id, checked, changed, elapsed = result
+                    totals = report[(feed_id, stage)]
+                    totals[0] += 1
+                    totals[1] += checked
+                    totals[2] += changed
+                    totals[3] += elapsed
+                    done += 1
+                    logger.info(
+                        "%s: %d of %d shards done", stage, done, len(shards))
+                logger.info(
+                    "Updated %s in %0.1f seconds", stage,
+                    time.time() - start_time)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Report the work done
+        self.stdout.write(
+            "Feed     Stage    Shards  Checked  Changed  Worker seconds\n")
         for feed in feeds:
-            logger.info(
-                "Updating geometries in Feed %s (ID %s)...",
-                feed.name, feed.id)
-
-            start_time = time.time()
-            shapes = Shape.objects.in_feed(feed)
-            for shape in shapes:
-                shape.update_geometry(update_parent=False)
-            end_time = time.time()
-            logger.debug(
-                "Imported %s shape%s in %0.1f seconds",
-                shapes.count(), '' if shapes.count() == 1 else 's',
-                end_time - start_time)
-
-            start_time = time.time()
-            trips = Trip.objects.in_feed(feed)
-            for trip in trips:
-                trip.update_geometry(update_parent=False)
-            end_time = time.time()
-            logger.debug(
-                "Imported %s trip%s in %0.1f seconds",
-                trips.count(), '' if trips.count() == 1 else 's',
-                end_time - start_time)
-
-            start_time = time.time()
-            routes = Route.objects.in_feed(feed)
-            for route in routes:
-                route.update_geometry()
-            end_time = time.time()
-            logger.debug(
-                "Imported %s route%s in %0.1f seconds",
-                routes.count(), '' if routes.count() == 1 else 's',
-                end_time - start_time)
-
-            total_end = time.time()
-            logger.info(
-                "Feed %d: Updated geometries in %d shape%s, %d trip%s, and"
-                " %d route%s %0.1f seconds.",
-                feed.id,
-                shapes.count(), '' if shapes.count() == 1 else 's',
-                trips.count(), '' if trips.count() == 1 else 's',
-                routes.count(), '' if routes.count() == 1 else 's',
-                total_end - total_start)
+            for stage, _ in stages:
+                shards, checked, changed, elapsed = report[(feed.id, stage)]
+                self.stdout.write("%-8d %-8s %6d %8d %8d %15.1f\n" % (
+                    feed.id, stage, shards, checked, changed, elapsed))
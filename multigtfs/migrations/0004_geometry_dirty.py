@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multigtfs', '0003_auto_20180826_2041'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='geometry_dirty',
+            field=models.BooleanField(db_index=True, default=False, help_text='Is the geometry cache out of date?'),
+        ),
+        migrations.AddField(
+            model_name='shape',
+            name='geometry_dirty',
+            field=models.BooleanField(db_index=True, default=False, help_text='Is the geometry cache out of date?'),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='geometry_dirty',
+            field=models.BooleanField(db_index=True, default=False, help_text='Is the geometry cache out of date?'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# flake8: noqa
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('multigtfs', '0004_geometry_dirty'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='Incremented when the records of the feed are changed'),
+        ),
+    ]
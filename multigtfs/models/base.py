@@ -16,27 +16,559 @@ from __future__ import unicode_literals
 from codecs import BOM_UTF8
 from collections import defaultdict
 from csv import reader, writer
-from datetime import datetime, date
+from datetime import datetime
+from itertools import islice
 from logging import getLogger
+from operator import itemgetter
+from threading import Lock
+import json
 import re
+import time
 
 from django.contrib.gis.db import models
+from django.db import connection, transaction
+from django.db.models import (
+    Case, ExpressionWrapper, F, Func, Max, Q, Value, When)
 from django.db.models.fields.related import ManyToManyField
-from django.utils.six import StringIO, text_type, PY3
+from django.utils.six import StringIO, string_types, text_type, PY3
 
+from multigtfs import signals
 from multigtfs.compat import (
     get_blank_value, write_text_rows, Manager, QuerySet)
+from multigtfs.models.fields import SecondsField, format_times, parse_times
 
 logger = getLogger(__name__)
 re_point = re.compile(r'(?P<name>point)\[(?P<index>\d)\]')
 batch_size = 1000
+
+
+def default_batch_size():
+    '''Get the default number of rows per import or export batch'''
+    return batch_size
+
+
+# IDs per __in lookup, below SQLite's limit of 999 query parameters
+in_batch_size = 500
 CSV_BOM = BOM_UTF8.decode('utf-8') if PY3 else BOM_UTF8
+# Serializes Feed.meta updates from importers running in parallel
+meta_lock = Lock()
+
+
+def copy_text(value):
+    '''Format a value for the PostgreSQL COPY text format'''
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        return 't' if value else 'f'
+    return (
+        text_type(value).replace('\\', '\\\\').replace('\t', '\\t')
+        .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def comparable_value(field, value):
+    '''Get a hashable value, to compare the old and new values of a field'''
+    if isinstance(field, models.GeometryField):
+        # Compare the WKB, without the SRID, which is not set for a point
+        # built from the GTFS text
+        wkb = getattr(value, 'wkb', None)
+        return value if wkb is None else bytes(wkb)
+    elif isinstance(value, dict):
+        return tuple(sorted(value.items()))
+    return field.get_db_prep_save(value, connection)
+
+
+# Conversion functions from GTFS to Django format
+def no_convert(value): return value
+
+
+def date_convert(value): return datetime.strptime(value, '%Y%m%d')
+
+
+def bool_convert(value): return (value == '1')
+
+
+def char_convert(value): return (value or '')
+
+
+def null_convert(value): return (value or None)
+
+
+def point_convert(value):
+    """Convert latitude / longitude, strip leading +."""
+    if value.startswith('+'):
+        return value[1:]
+    else:
+        return (value or 0.0)
+
+
+def typed_point_convert(value): return repr(float(value))
+
+
+def default_convert(field):
+    def get_value_or_default(value):
+        if value == '' or value is None:
+            return field.get_default()
+        else:
+            return value
+    return get_value_or_default
+
+
+# Conversion functions from Django to GTFS format
+def export_text(value): return (u'' if value is None else text_type(value))
+
+
+def export_date(value):
+    return (u'' if value is None else text_type(value.strftime('%Y%m%d')))
+
+
+def export_bool(value): return (1 if value else 0)
+
+
+def export_point(value): return value
+
+
+# Conversion functions from Django to typed values, for columnar formats
+def export_float(value): return (None if value is None else float(value))
+
+
+def export_kind(field):
+    '''Get the kind of an exported column, for export_typed_batches'''
+    if isinstance(field, models.DateField):
+        return 'date'
+    elif isinstance(field, models.BooleanField):
+        return 'bool'
+    elif isinstance(field, SecondsField):
+        return 'seconds'
+    elif isinstance(field, models.IntegerField):
+        return 'integer'
+    elif isinstance(field, (models.FloatField, models.DecimalField)):
+        return 'float'
+    return 'text'
+
+
+text_formatters = {
+    'date': export_date,
+    'bool': export_bool,
+    'point': export_point,
+}
+typed_formatters = {
+    'float': export_float,
+}
+# Conversion functions for whole columns, by kind
+text_column_formatters = {
+    'seconds': format_times,
+}
+
+
+def column_formatter(formatter):
+    '''Get a formatter of a column from a formatter of a value'''
+    def format_column(values):
+        return [formatter(value) for value in values]
+    return format_column
+
+
+# Format integer seconds as HH:MM:SS in PostgreSQL
+copy_seconds_template = (
+    "CASE WHEN %(expressions)s < 36000 THEN '0' ELSE '' END"
+    " || (%(expressions)s / 3600)::text"
+    " || ':' || lpad(mod(%(expressions)s / 60, 60)::text, 2, '0')"
+    " || ':' || lpad(mod(%(expressions)s, 60)::text, 2, '0')")
+
+
+def copy_blank(expression):
+    '''Export blank text as NULL, which COPY writes as an empty field
+
+    CSV COPY quotes an empty string as "", to tell it apart from NULL.
+    '''
+    return Func(
+        expression, Value(''), function='NULLIF',
+        output_field=models.TextField())
+
+
+class PendingRelation(object):
+    """A related object to be created before the row is saved"""
+    __slots__ = ('key1', 'key2')
+
+    def __init__(self, key1, key2):
+        self.key1 = key1
+        self.key2 = key2
+
+
+class ImportPlan(object):
+    """The conversion of GTFS rows to model fields
+
+    The plan is compiled once from the header row of a GTFS file, so that
+    converting a data row is a loop over the column positions, without
+    looking up columns by name.  A typed plan converts rows of typed values,
+    as exported by Base.export_typed_batches, rather than text.
+    """
+
+    def __init__(self, model, feed, columns, typed=False):
+        self.model = model
+        self.feed = feed
+        self.columns = columns
+        self.typed = typed
+        self.cache = {}
+        self.missing = {}
+        self.unresolved = []
+
+        # Check unique fields
+        column_names = [c for c, _ in model._column_map]
+        for unique_field in model._unique_fields:
+            assert unique_field in column_names, \
+                '{} not in {}'.format(unique_field, column_names)
+
+        # Compile the (position, target, converter) steps
+        converters = self.get_converters()
+        value_steps = []
+        relation_steps = []
+        point_steps = []
+        deferred_steps = []
+        extra_steps = []
+        column_steps = []
+        for position, column_name in enumerate(columns):
+            if column_name not in converters:
+                extra_steps.append((position, column_name))
+                continue
+            kind, target, converter = converters[column_name]
+            if kind == 'column':
+                # Copied as is, and converted a batch at a time
+                value_steps.append((position, target, no_convert))
+                column_steps.append((target, converter))
+            elif kind == 'point':
+                point_steps.append((position, target, converter))
+            elif kind == 'deferred':
+                deferred_steps.append((position, target, converter))
+            elif kind == 'relation':
+                relation_steps.append((position, target, converter))
+            else:
+                value_steps.append((position, target, converter))
+        self.value_steps = tuple(value_steps)
+        self.relation_steps = tuple(relation_steps)
+        self.point_steps = tuple(point_steps)
+        self.deferred_steps = tuple(deferred_steps)
+        self.extra_steps = tuple(extra_steps)
+        self.column_steps = tuple(column_steps)
+        self.has_point = any(
+            kind == 'point' for kind, _, _ in converters.values())
+        self.feed_fields = {'feed': feed} if model._rel_to_feed == 'feed' \
+            else {}
+        self.size = len(columns)
+
+        # Compile the checks for optional columns in use
+        optional = set(
+            csv_name for csv_name, _ in model.objects.all().optional_columns())
+        self.optional_steps = tuple(
+            (position, column_name)
+            for position, column_name in enumerate(columns)
+            if column_name in optional)
+        self.populated = set()
+
+        # Compile the unique key extractor
+        self.unique_names = tuple(
+            converters[u][1] for u in model._unique_fields)
+        self.unique_positions = tuple(
+            columns.index(u) if u in columns else None
+            for u in model._unique_fields)
+        if None in self.unique_positions:
+            self.unique_key = self._short_unique_key
+        elif len(self.unique_positions) == 1:
+            position = self.unique_positions[0]
+
+            def unique_key(row):
+                if len(row) > position:
+                    return (row[position],)
+                return (None,)
+            self.unique_key = unique_key
+        else:
+            getter = itemgetter(*self.unique_positions)
+            last = max(self.unique_positions)
+
+            def unique_key(row):
+                if len(row) > last:
+                    return getter(row)
+                return self._short_unique_key(row)
+            self.unique_key = unique_key
+
+    def get_converters(self):
+        """Get the converters for the GTFS columns in the _column_map
+
+        Returns a dictionary of GTFS column name to a tuple:
+        ('value', field_name, converter) - Set a model field
+        ('column', field_name, converter) - Set a model field, converting
+            a column of values at a time in convert_columns()
+        ('relation', field_name, converter) - Set a foreign key, which may
+            be a PendingRelation until save_related() is called
+        ('point', index, converter) - Set a coordinate of the point
+        ('deferred', field_name, rel_name) - Set a relation to another row
+            in the same file, after the rows are imported
+        """
+        model = self.model
+        typed = self.typed
+        converters = {}
+        for csv_name, field_pattern in model._column_map:
+            # Separate the local field name from foreign columns
+            if '__' in field_pattern:
+                field_base, rel_name = field_pattern.split('__', 1)
+                field_name = field_base + '_id'
+            else:
+                field_name = field_base = field_pattern
+
+            # Is it a point field?
+            point_match = re_point.match(field_name)
+            if point_match:
+                index = int(point_match.group('index'))
+                converters[csv_name] = (
+                    'point', index,
+                    typed_point_convert if typed else point_convert)
+                continue
+            field = model._meta.get_field(field_base)
+
+            # Pick a conversion function for the field
+            if isinstance(field, models.DateField):
+                converter = no_convert if typed else date_convert
+            elif isinstance(field, models.BooleanField):
+                converter = bool if typed else bool_convert
+            elif isinstance(field, models.CharField):
+                converter = char_convert
+            elif isinstance(field, SecondsField):
+                if not typed:
+                    converters[csv_name] = ('column', field_name, parse_times)
+                    continue
+                converter = no_convert
+            elif field.is_relation and field.related_model is model:
+                # Relations within the file are set after the import
+                converters[csv_name] = ('deferred', field_name, rel_name)
+                continue
+            elif field.is_relation:
+                assert not isinstance(field, models.ManyToManyField)
+                converters[csv_name] = (
+                    'relation', field_name,
+                    self.instance_convert(field, rel_name))
+                continue
+            elif field.null:
+                converter = no_convert if typed else null_convert
+            elif field.has_default():
+                converter = default_convert(field)
+            else:
+                converter = no_convert
+            converters[csv_name] = ('value', field_name, converter)
+        return converters
+
+    def instance_convert(self, field, rel_name):
+        """Get a converter from a GTFS ID to a related object's ID
+
+        If the related object does not exist, a PendingRelation is returned,
+        and the object is created by the next call to save_related().
+        """
+        related = field.related_model
+        cache = self.cache
+        feed = self.feed
+        key1 = "{}:{}".format(related.__name__, rel_name)
+        missing = self.missing.setdefault(key1, (related, rel_name, {}))[2]
+
+        def get_instance(value):
+            if value.strip():
+                key2 = text_type(value)
+
+                # Load existing objects
+                if key1 not in cache:
+                    pairs = related.objects.filter(
+                        **{related._rel_to_feed: feed}).values_list(
+                        rel_name, 'id')
+                    cache[key1] = dict((text_type(x), i) for x, i in pairs)
+
+                # Create new with the next batch?
+                if key2 not in cache[key1]:
+                    if key2 not in missing:
+                        missing[key2] = PendingRelation(key1, key2)
+                    return missing[key2]
+                return cache[key1][key2]
+            else:
+                return None
+        return get_instance
+
+    def save_related(self):
+        """Create the related objects needed by the converted rows
+
+        The new objects are created with one bulk_create per related model,
+        and the PendingRelations in the converted rows are replaced with
+        the new IDs.
+        """
+        feed = self.feed
+        for key1, (related, rel_name, missing) in self.missing.items():
+            if not missing:
+                continue
+            values = sorted(missing)
+            related.objects.bulk_create(
+                related(**{related._rel_to_feed: feed, rel_name: value})
+                for value in values)
+            ids = self.cache[key1]
+            for start in range(0, len(values), in_batch_size):
+                pairs = related.objects.filter(**{
+                    related._rel_to_feed: feed,
+                    rel_name + '__in': values[start:start + in_batch_size]
+                }).values_list(rel_name, 'id')
+                ids.update((text_type(x), i) for x, i in pairs)
+            missing.clear()
+
+        cache = self.cache
+        for fields, field_name in self.unresolved:
+            pending = fields[field_name]
+            fields[field_name] = cache[pending.key1][pending.key2]
+        self.unresolved = []
+
+    def unique_lookup(self, fields):
+        """Get the filter arguments to find a row's unique key in the feed
+
+        Returns None if the row refers to a related object that is not yet
+        created, so it can't be in the feed.
+        """
+        lookup = dict(
+            (name, fields.get(name)) for name in self.unique_names)
+        for value in lookup.values():
+            if isinstance(value, PendingRelation):
+                return None
+        return lookup
+
+    def _short_unique_key(self, row):
+        """Get the unique key of a row missing unique columns"""
+        size = len(row)
+        return tuple(
+            row[p] if p is not None and p < size else None
+            for p in self.unique_positions)
+
+    def convert(self, row):
+        """Convert a data row
+
+        Returns a tuple (fields, deferred):
+        fields - A dictionary of model field values, for the constructor
+        deferred - A list of (field_name, rel_name, value) relations to
+            other rows in the same file
+        """
+        value_steps = self.value_steps
+        relation_steps = self.relation_steps
+        point_steps = self.point_steps
+        deferred_steps = self.deferred_steps
+        extra_steps = self.extra_steps
+        size = len(row)
+        if size < self.size:
+            # Skip the columns missing from a short row
+            value_steps = [s for s in value_steps if s[0] < size]
+            relation_steps = [s for s in relation_steps if s[0] < size]
+            point_steps = [s for s in point_steps if s[0] < size]
+            deferred_steps = [s for s in deferred_steps if s[0] < size]
+            extra_steps = [s for s in extra_steps if s[0] < size]
+
+        fields = self.feed_fields.copy()
+        for position, field_name, converter in value_steps:
+            fields[field_name] = converter(row[position])
+        for position, field_name, converter in relation_steps:
+            value = converter(row[position])
+            fields[field_name] = value
+            if isinstance(value, PendingRelation):
+                self.unresolved.append((fields, field_name))
+
+        # Join the lat/long into a point
+        if self.has_point:
+            point_coords = [None, None]
+            for position, index, converter in point_steps:
+                point_coords[index] = converter(row[position])
+            assert point_coords[0] and point_coords[1]
+            fields['point'] = "POINT(%s)" % (' '.join(point_coords))
+
+        deferred = []
+        for position, field_name, rel_name in deferred_steps:
+            value = row[position]
+            if value.strip():
+                deferred.append((field_name, rel_name, value))
+
+        # Store populated extra columns
+        for position, column_name in extra_steps:
+            value = row[position]
+            if value:
+                fields.setdefault('extra_data', {})[column_name] = value
+        return fields, deferred
+
+    def convert_columns(self, rows):
+        """Convert the columns of a batch of converted rows
+
+        Some columns, such as times, are copied as is by convert(), and
+        converted a whole column at a time.  rows is a list of the field
+        dictionaries from convert(), which are updated in place.
+        """
+        for field_name, converter in self.column_steps:
+            column = [fields.get(field_name) for fields in rows]
+            for fields, value in zip(rows, converter(column)):
+                if field_name in fields:
+                    fields[field_name] = value
+
+    def note_populated(self, row):
+        """Note the optional columns with a value in a data row
+
+        A column is only checked until a value is found, so after the first
+        rows, most rows are not checked at all.
+        """
+        size = len(row)
+        found = [
+            column_name for position, column_name in self.optional_steps
+            if position < size and row[position] not in ('', None)]
+        if found:
+            self.populated.update(found)
+            self.optional_steps = tuple(
+                step for step in self.optional_steps
+                if step[1] not in self.populated)
+
+
+class UniqueKeys(object):
+    """The unique keys of the rows imported from a GTFS file
+
+    To keep memory low for large files, only a hash of the key is kept once
+    a row is saved.  The exact keys of the unsaved rows are kept until
+    saved() is called.  When a key's hash matches a saved row, the database
+    is checked to confirm it is a duplicate.
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.hashes = set()
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, ukey, line_num, fields):
+        """Add the unique key of a row
+
+        Returns None if the key is new.  If it is a duplicate, returns the
+        line number of the original row, or 0 if it is already saved.
+        """
+        key_hash = hash(ukey)
+        if key_hash in self.hashes:
+            if ukey in self.pending:
+                return self.pending[ukey]
+            plan = self.plan
+            objects = plan.model.objects.in_feed(plan.feed)
+            lookup = plan.unique_lookup(fields)
+            if lookup is not None and objects.filter(**lookup).exists():
+                return 0
+        self.hashes.add(key_hash)
+        self.pending[ukey] = line_num
+        return None
+
+    def saved(self):
+        """Forget the exact keys of the rows that are now saved"""
+        self.pending.clear()
+
+    def add_saved(self, ukey):
+        """Add the unique key of a row saved by an earlier import"""
+        self.hashes.add(hash(ukey))
 
 
 class BaseQuerySet(QuerySet):
-    def populated_column_map(self):
-        '''Return the _column_map without unused optional fields'''
-        column_map = []
+    def optional_columns(self):
+        '''Return (csv_name, field) for the optional fields in _column_map'''
+        optional = []
         cls = self.model
         for csv_name, field_pattern in cls._column_map:
             # Separate the local field name from foreign columns
@@ -45,21 +577,55 @@ class BaseQuerySet(QuerySet):
             else:
                 field_name = field_pattern
 
-            # Handle point fields
-            point_match = re_point.match(field_name)
-            if point_match:
-                field = None
-            else:
-                field = cls._meta.get_field(field_name)
+            # Point fields are required
+            if re_point.match(field_name):
+                continue
+            field = cls._meta.get_field(field_name)
+            if field.blank and not field.has_default():
+                optional.append((csv_name, field))
+        return optional
 
-            # Only add optional columns if they are used in the records
-            if field and field.blank and not field.has_default():
-                kwargs = {field_name: get_blank_value(field)}
-                if self.exclude(**kwargs).exists():
-                    column_map.append((csv_name, field_pattern))
-            else:
-                column_map.append((csv_name, field_pattern))
-        return column_map
+    def populated_columns(self, csv_names=None):
+        '''Return the names of optional columns used in the records
+
+        All the optional columns are checked in a single query.
+
+        Keyword arguments:
+        csv_names - If set, only check these columns
+        '''
+        checks = []
+        aggregates = {}
+        for csv_name, field in self.optional_columns():
+            if csv_names is not None and csv_name not in csv_names:
+                continue
+            alias = 'populated_%d' % len(checks)
+            blank = Q(**{field.name: get_blank_value(field)})
+            aggregates[alias] = Max(Case(
+                When(~blank, then=Value(1)), default=Value(0),
+                output_field=models.IntegerField()))
+            checks.append((alias, csv_name))
+        if not checks:
+            return set()
+        result = self.aggregate(**aggregates)
+        return set(csv_name for alias, csv_name in checks if result[alias])
+
+    def populated_column_map(self, cached_columns=None):
+        '''Return the _column_map without unused optional fields
+
+        Keyword arguments:
+        cached_columns - If set, the optional columns known to be used, such
+            as the list cached in Feed.meta by import_txt, instead of
+            querying the records
+        '''
+        optional = set(csv_name for csv_name, _ in self.optional_columns())
+        if cached_columns is None:
+            populated = self.populated_columns()
+        else:
+            populated = set(cached_columns)
+        return [
+            (csv_name, field_pattern)
+            for csv_name, field_pattern in self.model._column_map
+            if csv_name not in optional or csv_name in populated]
 
 
 class BaseManager(Manager):
@@ -104,131 +670,297 @@ class Base(models.Model):
     # The relation of the model to the feed it belongs to.
     _rel_to_feed = 'feed'
 
+    def save(self, *args, **kwargs):
+        '''Save the record, and bump the version of the feed
+
+        Keyword arguments:
+        bump_version - If False, leave the feed version alone, for changes
+            that are not exported (such as cached geometries), or when the
+            caller bumps the version once for many records
+        '''
+        bump_version = kwargs.pop('bump_version', True)
+        super(Base, self).save(*args, **kwargs)
+        if bump_version:
+            self._bump_feed_version()
+
+    def delete(self, *args, **kwargs):
+        '''Delete the record, and bump the version of the feed'''
+        with transaction.atomic():
+            # The feed is found through the record, so bump first
+            self._bump_feed_version()
+            return super(Base, self).delete(*args, **kwargs)
+
+    def _bump_feed_version(self):
+        '''Bump the version of the record's feed in a single query'''
+        from multigtfs.models.feed import Feed
+        if self._rel_to_feed == 'feed':
+            feeds = Feed.objects.filter(id=self.feed_id)
+        else:
+            feeds = Feed.objects.filter(id__in=type(self).objects.filter(
+                pk=self.pk).values(self._rel_to_feed))
+        feeds.update(version=F('version') + 1)
+
     @classmethod
-    def import_txt(cls, txt_file, feed, filter_func=None):
-        '''Import from the GTFS text file'''
+    def copy_rows(cls, rows):
+        '''Insert rows of field values with PostgreSQL's COPY FROM STDIN
 
-        # Setup the conversion from GTFS to Django Format
-        # Conversion functions
-        def no_convert(value): return value
+        Each row is a dictionary of model field names (or attribute names)
+        to values, as passed to the model constructor.  Missing fields get
+        their default value.
+        '''
+        fields = [f for f in cls._meta.concrete_fields if not f.primary_key]
+        out = StringIO()
+        for row in rows:
+            values = []
+            for field in fields:
+                if field.attname in row:
+                    value = row[field.attname]
+                elif field.name in row:
+                    value = row[field.name]
+                else:
+                    value = field.get_default()
+                if isinstance(value, models.Model):
+                    value = value.pk
+                if isinstance(field, models.GeometryField):
+                    if hasattr(value, 'ewkt'):
+                        value = value.ewkt
+                    elif value is not None:
+                        value = 'SRID=%d;%s' % (field.srid, value)
+                else:
+                    value = field.get_db_prep_save(value, connection)
+                values.append(copy_text(value))
+            out.write('\t'.join(values))
+            out.write('\n')
+        out.seek(0)
 
-        def date_convert(value): return datetime.strptime(value, '%Y%m%d')
+        quote_name = connection.ops.quote_name
+        sql = 'COPY %s (%s) FROM STDIN' % (
+            quote_name(cls._meta.db_table),
+            ', '.join(quote_name(f.column) for f in fields))
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, out)
 
-        def bool_convert(value): return (value == '1')
+    @classmethod
+    def save_geometries(cls, geometries):
+        '''Save the cached geometries of records
 
-        def char_convert(value): return (value or '')
+        geometries is a dictionary of IDs to geometries (or None).  On
+        PostgreSQL, each batch is saved with one UPDATE query.
+        '''
+        items = sorted(geometries.items())
+        if connection.vendor != 'postgresql':
+            for obj_id, geometry in items:
+                cls.objects.filter(id=obj_id).update(geometry=geometry)
+            return
 
-        def null_convert(value): return (value or None)
+        quote_name = connection.ops.quote_name
+        table = quote_name(cls._meta.db_table)
+        column = quote_name(cls._meta.get_field('geometry').column)
+        size = default_batch_size()
+        with connection.cursor() as cursor:
+            for start in range(0, len(items), size):
+                chunk = items[start:start + size]
+                params = []
+                for obj_id, geometry in chunk:
+                    params.extend((
+                        obj_id, None if geometry is None else geometry.ewkt))
+                cursor.execute(
+                    'UPDATE %s SET %s = v.geometry FROM (VALUES %s)'
+                    ' AS v(id, geometry) WHERE %s.id = v.id' % (
+                        table, column,
+                        ', '.join(['(%s, %s::geometry)'] * len(chunk)),
+                        table),
+                    params)
 
-        def point_convert(value):
-            """Convert latitude / longitude, strip leading +."""
-            if value.startswith('+'):
-                return value[1:]
-            else:
-                return (value or 0.0)
+    def _save_geometry(self, changed):
+        '''Save a changed geometry cache, and clear the out of date marker
 
-        cache = {}
+        Returns changed
+        '''
+        self.geometry_dirty = False
+        if changed:
+            # Geometries are not exported, so the feed version is kept
+            self.save(bump_version=False)
+        else:
+            type(self).objects.filter(
+                id=self.id, geometry_dirty=True).update(geometry_dirty=False)
+        return changed
 
-        def default_convert(field):
-            def get_value_or_default(value):
-                if value == '' or value is None:
-                    return field.get_default()
-                else:
-                    return value
-            return get_value_or_default
-
-        def instance_convert(field, feed, rel_name):
-            def get_instance(value):
-                if value.strip():
-                    related = field.related_model
-                    key1 = "{}:{}".format(related.__name__, rel_name)
-                    key2 = text_type(value)
-
-                    # Load existing objects
-                    if key1 not in cache:
-                        pairs = related.objects.filter(
-                            **{related._rel_to_feed: feed}).values_list(
-                            rel_name, 'id')
-                        cache[key1] = dict((text_type(x), i) for x, i in pairs)
-
-                    # Create new?
-                    if key2 not in cache[key1]:
-                        kwargs = {
-                            related._rel_to_feed: feed,
-                            rel_name: value}
-                        cache[key1][key2] = related.objects.create(
-                            **kwargs).id
-                    return cache[key1][key2]
-                else:
-                    return None
-            return get_instance
+    @classmethod
+    def _clear_geometry_dirty(cls, feed, ids):
+        '''Clear the out of date markers before updating geometries'''
+        objects = cls.objects.in_feed(feed).filter(geometry_dirty=True)
+        if ids is not None:
+            objects = objects.filter(id__in=ids)
+        objects.update(geometry_dirty=False)
 
-        # Check unique fields
-        column_names = [c for c, _ in cls._column_map]
-        for unique_field in cls._unique_fields:
-            assert unique_field in column_names, \
-                '{} not in {}'.format(unique_field, column_names)
+    @classmethod
+    def _save_changed_geometries(cls, current, geometries):
+        '''Save the geometries that differ from the current ones
 
-        # Map of field_name to converters from GTFS to Django format
-        val_map = dict()
-        name_map = dict()
-        point_map = dict()
-        for csv_name, field_pattern in cls._column_map:
-            # Separate the local field name from foreign columns
-            if '__' in field_pattern:
-                field_base, rel_name = field_pattern.split('__', 1)
-                field_name = field_base + '_id'
-            else:
-                field_name = field_base = field_pattern
-            # Use the field name in the name mapping
-            name_map[csv_name] = field_name
+        current and geometries are dictionaries of IDs to geometries.
+        Returns the number of records changed.
+        '''
+        changed = dict(
+            (obj_id, geometry) for obj_id, geometry in geometries.items()
+            if geometry != current.get(obj_id))
+        cls.save_geometries(changed)
+        return len(changed)
 
-            # Is it a point field?
-            point_match = re_point.match(field_name)
-            if point_match:
-                field = None
-            else:
-                field = cls._meta.get_field(field_base)
+    @classmethod
+    def _update_geometries_sql(cls, select, params):
+        '''Set the cached geometries from a PostGIS query, if changed
 
-            # Pick a conversion function for the field
-            if point_match:
-                converter = point_convert
-            elif isinstance(field, models.DateField):
-                converter = date_convert
-            elif isinstance(field, models.BooleanField):
-                converter = bool_convert
-            elif isinstance(field, models.CharField):
-                converter = char_convert
-            elif field.is_relation:
-                converter = instance_convert(field, feed, rel_name)
-                assert not isinstance(field, models.ManyToManyField)
-            elif field.null:
-                converter = null_convert
-            elif field.has_default():
-                converter = default_convert(field)
+        select is a query for (id, geometry) rows.  Returns the number of
+        records changed.
+        '''
+        quote_name = connection.ops.quote_name
+        table = quote_name(cls._meta.db_table)
+        column = quote_name(cls._meta.get_field('geometry').column)
+        sql = (
+            'UPDATE {table} SET {column} = v.geometry FROM ({select})'
+            ' AS v(id, geometry) WHERE {table}.id = v.id AND ('
+            '({table}.{column} IS NULL) <> (v.geometry IS NULL) OR'
+            ' NOT ST_OrderingEquals({table}.{column}, v.geometry))').format(
+                table=table, column=column, select=select)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    @classmethod
+    def _geometry_chunks(cls, feed, ids):
+        '''Split the IDs of records for a geometry update
+
+        Returns [None] to update the whole feed with one PostGIS query.
+        Otherwise, returns sorted lists of IDs, short enough for __in
+        lookups.  Without PostGIS, the whole feed is split into lists.
+        '''
+        if ids is None:
+            if getattr(connection.ops, 'postgis', False):
+                return [None]
+            ids = cls.objects.in_feed(feed).values_list('id', flat=True)
+        ids = sorted(ids)
+        return [
+            ids[start:start + in_batch_size]
+            for start in range(0, len(ids), in_batch_size)]
+
+    @classmethod
+    def _id_filter(cls, column, ids):
+        '''Get SQL and params to limit a query to IDs, if set'''
+        if ids is None:
+            return '', []
+        return (
+            ' AND %s IN (%s)' % (column, ', '.join(['%s'] * len(ids))),
+            list(ids))
+
+    @classmethod
+    def import_txt(
+            cls, txt_file, feed, filter_func=None, use_copy=False,
+            dedupe='memory', batch_size=None, checkpoint=None,
+            on_save=None, typed=False):
+        '''Import from the GTFS text file
+
+        Keyword arguments:
+        txt_file - An open GTFS text file
+        feed - The Feed to import into
+        filter_func - If set, a function that is passed the (column, value)
+            pairs of a row, and returns False if the row should be skipped
+        use_copy - If True and the database is PostgreSQL, load the rows with
+            COPY FROM STDIN rather than the ORM's bulk_create
+        dedupe - How to drop rows with a duplicate unique key.  'memory'
+            (the default) drops them as they are read, keeping a hash of
+            each key.  'database' imports all the rows, and then deletes
+            the duplicates with a query, so memory use does not grow with
+            the file.
+        batch_size - The number of rows to insert at a time, defaulting to
+            multigtfs.models.base.batch_size
+        checkpoint - If set, a name for the file in the feed's import
+            progress.  Each batch is saved in a transaction with the line
+            number and row count reached, and an import of the same
+            checkpoint continues after the last saved batch.  Returns None
+            if the file was already imported.
+        on_save - If set, a function that is passed each batch of rows,
+            as dictionaries of model field values, after they are saved
+        typed - If True, txt_file is instead an iterable of typed rows with
+            a line_num, such as multigtfs.columnar.ParquetRows.  The first
+            row is the header, and the values are as exported by
+            export_typed_batches, with '' for blank text.
+        '''
+        assert dedupe in ('memory', 'database')
+        if batch_size is None:
+            batch_size = default_batch_size()
+        if use_copy and connection.vendor != 'postgresql':
+            logger.warning(
+                'COPY is not supported by the %s backend, using bulk_create.',
+                connection.vendor)
+            use_copy = False
+
+        progress = {}
+        if checkpoint:
+            progress = feed.meta.get('import_progress', {}).get(checkpoint, {})
+            if progress.get('complete'):
+                logger.info(
+                    'Skipping %s, already imported.', cls._filename)
+                return None
+        resume_line = progress.get('line', 0)
+
+        def insert_rows(rows):
+            '''Create the related objects, then the rows'''
+            plan.convert_columns(rows)
+            plan.save_related()
+            if use_copy:
+                cls.copy_rows(rows)
             else:
-                converter = no_convert
+                cls.objects.bulk_create([cls(**fields) for fields in rows])
 
-            if point_match:
-                index = int(point_match.group('index'))
-                point_map[csv_name] = (index, converter)
+        def save_rows(rows, line_num):
+            if checkpoint:
+                with transaction.atomic():
+                    insert_rows(rows)
+                    cls._save_progress(
+                        feed, checkpoint, line=line_num,
+                        rows=count + len(rows),
+                        extra_columns=sorted(extra_counts),
+                        populated_columns=sorted(plan.populated))
             else:
-                val_map[csv_name] = converter
+                insert_rows(rows)
+            if on_save:
+                on_save(rows)
+            elapsed = time.time() - start_time
+            signals.batch_flushed.send(
+                sender=cls, feed=feed, filename=cls._filename,
+                rows=len(rows), total_rows=count + len(rows),
+                elapsed=elapsed,
+                rows_per_second=signals.rows_per_second(
+                    count + len(rows) - resumed_rows, elapsed))
 
         # Read and convert the source txt
-        csv_reader = reader(txt_file, skipinitialspace=True)
-        unique_line = dict()
-        count = 0
-        first = True
+        start_time = time.time()
+        if typed:
+            csv_reader = txt_file
+        else:
+            csv_reader = reader(txt_file, skipinitialspace=True)
+        unique_keys = None
+        resumed_rows = progress.get('rows', 0)
+        count = resumed_rows
+        plan = None
         extra_counts = defaultdict(int)
+        for column_name in progress.get('extra_columns', []):
+            extra_counts[column_name] += 1
         new_objects = []
+        deferred = []
         for row in csv_reader:
-            if first:
-                # Read the columns
+            if plan is None:
+                # Compile the conversion from the header row
                 columns = row
                 if columns[0].startswith(CSV_BOM):
                     columns[0] = columns[0][len(CSV_BOM):]
-                first = False
+                plan = ImportPlan(cls, feed, columns, typed)
+                plan.populated.update(progress.get('populated_columns', []))
+                unique_key = plan.unique_key
+                convert = plan.convert
+                if dedupe == 'memory':
+                    unique_keys = UniqueKeys(plan)
                 continue
 
             if filter_func and not filter_func(zip(columns, row)):
@@ -237,80 +969,485 @@ class Base(models.Model):
             if not row:
                 continue
 
-            # Read a data row
-            fields = dict()
-            point_coords = [None, None]
-            ukey_values = {}
-            if cls._rel_to_feed == 'feed':
-                fields['feed'] = feed
-            for column_name, value in zip(columns, row):
-                if column_name not in name_map:
-                    val = null_convert(value)
-                    if val is not None:
-                        fields.setdefault('extra_data', {})[column_name] = val
-                        extra_counts[column_name] += 1
-                elif column_name in val_map:
-                    fields[name_map[column_name]] = val_map[column_name](value)
-                else:
-                    assert column_name in point_map
-                    pos, converter = point_map[column_name]
-                    point_coords[pos] = converter(value)
-
-                # Is it part of the unique key?
-                if column_name in cls._unique_fields:
-                    ukey_values[column_name] = value
+            # Skip rows saved by an earlier import
+            if resume_line and csv_reader.line_num <= resume_line:
+                if unique_keys is not None:
+                    unique_keys.add_saved(unique_key(row))
+                if plan.deferred_steps:
+                    fields, row_deferred = convert(row)
+                    for field_name, rel_name, value in row_deferred:
+                        deferred.append(
+                            (field_name, rel_name, fields[rel_name], value))
+                continue
 
-            # Join the lat/long into a point
-            if point_map:
-                assert point_coords[0] and point_coords[1]
-                fields['point'] = "POINT(%s)" % (' '.join(point_coords))
+            # Read a data row
+            fields, row_deferred = convert(row)
+            if 'extra_data' in fields:
+                for column_name in fields['extra_data']:
+                    extra_counts[column_name] += 1
 
             # Is the item unique?
-            ukey = tuple(ukey_values.get(u) for u in cls._unique_fields)
-            if ukey in unique_line:
-                logger.warning(
-                    '%s line %d is a duplicate of line %d, not imported.',
-                    cls._filename, csv_reader.line_num, unique_line[ukey])
-                continue
-            else:
-                unique_line[ukey] = csv_reader.line_num
+            if unique_keys is not None:
+                original = unique_keys.add(
+                    unique_key(row), csv_reader.line_num, fields)
+                if original:
+                    logger.warning(
+                        '%s line %d is a duplicate of line %d, not imported.',
+                        cls._filename, csv_reader.line_num, original)
+                    continue
+                elif original is not None:
+                    logger.warning(
+                        '%s line %d is a duplicate of an earlier line, not'
+                        ' imported.', cls._filename, csv_reader.line_num)
+                    continue
+
+            # Remember relations to other rows in the file
+            for field_name, rel_name, value in row_deferred:
+                deferred.append(
+                    (field_name, rel_name, fields[rel_name], value))
+            plan.note_populated(row)
 
             # Create after accumulating a batch
-            new_objects.append(cls(**fields))
+            new_objects.append(fields)
             if len(new_objects) % batch_size == 0:  # pragma: no cover
-                cls.objects.bulk_create(new_objects)
+                save_rows(new_objects, csv_reader.line_num)
                 count += len(new_objects)
                 logger.info(
                     "Imported %d %s",
                     count, cls._meta.verbose_name_plural)
                 new_objects = []
+                if unique_keys is not None:
+                    unique_keys.saved()
 
         # Create remaining objects
         if new_objects:
-            cls.objects.bulk_create(new_objects)
+            save_rows(new_objects, csv_reader.line_num)
+            count += len(new_objects)
 
-        # Take note of extra fields
-        if extra_counts:
+        # Remove duplicates in the database
+        if plan and dedupe == 'database':
+            count -= cls._delete_duplicates(feed, plan.unique_names)
+
+        # Set relations to other rows in the file
+        if deferred:
+            cls._set_deferred_relations(feed, deferred)
+
+        # Take note of extra fields, and the optional fields in use
+        if plan is not None:
+            if extra_counts:
+                cls._note_extra_columns(feed, columns, extra_counts)
+            cls._note_populated_columns(feed, plan.populated)
+        if checkpoint:
+            cls._save_progress(feed, checkpoint, rows=count, complete=True)
+        feed.bump_version()
+        return count
+
+    @classmethod
+    def _note_extra_columns(cls, feed, columns, extra_counts):
+        '''Record the populated extra columns in the feed'''
+        with meta_lock:
             extra_columns = feed.meta.setdefault(
                 'extra_columns', {}).setdefault(cls.__name__, [])
             for column in columns:
                 if column in extra_counts and column not in extra_columns:
                     extra_columns.append(column)
             feed.save()
-        return len(unique_line)
 
     @classmethod
-    def export_txt(cls, feed):
-        '''Export records as a GTFS comma-separated file'''
+    def _note_populated_columns(cls, feed, populated, replaced=()):
+        '''Cache the optional columns used in the feed
+
+        Keyword arguments:
+        feed - The feed of the imported rows
+        populated - The optional columns with values in the imported rows,
+            from ImportPlan.note_populated
+        replaced - The columns whose values were all replaced, so that the
+            cached columns are dropped unless they are still populated
+        '''
+        with meta_lock:
+            cached = feed.meta.setdefault('populated_columns', {})
+            kept = set(cached.get(cls.__name__, [])) - set(replaced)
+            cached[cls.__name__] = sorted(kept | set(populated))
+            feed.save()
+
+    @classmethod
+    def _save_progress(cls, feed, checkpoint, **progress):
+        '''Record the progress of importing a file in the feed'''
+        with meta_lock:
+            feed.meta.setdefault('import_progress', {}).setdefault(
+                checkpoint, {}).update(progress)
+            feed.save()
+
+    @classmethod
+    def _delete_duplicates(cls, feed, unique_names):
+        '''Delete rows in the feed with the same unique fields
+
+        The first row imported (with the lowest ID) is kept.  The rows are
+        deleted with a single DELETE, however many keys are duplicated.
+        Returns the number of rows deleted.
+        '''
+        objects = cls.objects.in_feed(feed).order_by()
+        feed_sql, feed_params = objects.values('id').query.sql_with_params()
+        first_ids = objects.values(*unique_names).annotate(
+            first_id=models.Min('id')).values('first_id')
+        first_sql, first_params = first_ids.query.sql_with_params()
+        # The subqueries are wrapped, since MySQL can't select from the
+        # table in a DELETE
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DELETE FROM %s WHERE id IN (SELECT id FROM (%s) AS f)'
+                ' AND id NOT IN (SELECT first_id FROM (%s) AS k)' % (
+                    connection.ops.quote_name(cls._meta.db_table),
+                    feed_sql, first_sql),
+                tuple(feed_params) + tuple(first_params))
+            deleted = cursor.rowcount
+        if deleted:
+            logger.warning(
+                '%s had %d rows with duplicate %s, not imported.',
+                cls._filename, deleted, ', '.join(cls._unique_fields))
+        return deleted
+
+    @classmethod
+    def _set_deferred_relations(cls, feed, deferred):
+        '''Set relations between rows imported from the same file
+
+        deferred is a list of tuples (field_name, rel_name, key, value), to
+        set field_name on the row where rel_name is key to the row where
+        rel_name is value.
+        '''
+        id_maps = {}
+        updates = defaultdict(list)
+        seen = set()
+        for field_name, rel_name, key, value in deferred:
+            # Use the first row for duplicate keys
+            if (field_name, key) in seen:
+                continue
+            seen.add((field_name, key))
+            if rel_name not in id_maps:
+                pairs = cls.objects.in_feed(feed).values_list(rel_name, 'id')
+                id_maps[rel_name] = dict((text_type(x), i) for x, i in pairs)
+            ids = id_maps[rel_name]
+            if value in ids:
+                updates[(field_name, ids[value])].append(ids[key])
+            else:
+                logger.warning(
+                    '%s %s=%s refers to unknown %s %s, not set.',
+                    cls._filename, rel_name, key, field_name, value)
+
+        # Update all the rows with the same related row together
+        for (field_name, related_id), ids in updates.items():
+            for start in range(0, len(ids), in_batch_size):
+                cls.objects.filter(
+                    id__in=ids[start:start + in_batch_size]).update(
+                    **{field_name: related_id})
+
+    @classmethod
+    def update_txt(cls, txt_file, feed, batch_size=None, keep_missing=False):
+        '''Update the feed's records to match a new GTFS text file
+
+        Rows are matched to the records by the _unique_fields.  New rows
+        are inserted, records with changed values are updated, and records
+        missing from the file are deleted.  Unchanged records are not
+        written.
+
+        Keyword arguments:
+        txt_file - An open GTFS text file
+        feed - The Feed to update
+        batch_size - The number of rows to compare and insert at a time,
+            defaulting to multigtfs.models.base.batch_size
+        keep_missing - If True, the records missing from the file are not
+            deleted, but returned as 'missing', so that they can be deleted
+            by delete_unreferenced once the other files are updated
+
+        Returns a dictionary:
+        inserted - The set of IDs of the new records
+        updated - The set of IDs of the changed records
+        deleted - The number of deleted records
+        unchanged - The number of unchanged records
+        missing - With keep_missing, a dictionary of the IDs of the records
+            missing from the file to their related IDs, by attribute name
+        related - A dictionary of foreign key attribute names, such as
+            'trip_id', to the set of related IDs of the new, changed, and
+            deleted records, before and after the change
+        '''
+        if batch_size is None:
+            batch_size = default_batch_size()
+        csv_reader = reader(txt_file, skipinitialspace=True)
+        columns = next(csv_reader, [])
+        if columns and columns[0].startswith(CSV_BOM):
+            columns[0] = columns[0][len(CSV_BOM):]
+        plan = ImportPlan(cls, feed, columns)
+
+        # Pick the fields set from the GTFS columns
+        names = set(['extra_data', cls._rel_to_feed])
+        for kind, target, _ in plan.get_converters().values():
+            if kind == 'point':
+                names.add('point')
+            elif kind != 'deferred':
+                names.add(target)
+        fields = [
+            f for f in cls._meta.concrete_fields
+            if f.name in names or f.attname in names]
+        update_fields = [f.name for f in fields]
+        related_fields = [
+            f for f in fields if f.is_relation and f.name != 'feed']
+        unique_fields = [
+            f for f in cls._meta.concrete_fields
+            if f.attname in plan.unique_names or
+            f.name in plan.unique_names]
+
+        def unique_key(obj):
+            return tuple(
+                comparable_value(f, getattr(obj, f.attname))
+                for f in unique_fields)
+
+        def row_hash(obj):
+            return hash(tuple(
+                comparable_value(f, getattr(obj, f.attname))
+                for f in fields))
+
+        def related_ids(obj):
+            return tuple(getattr(obj, f.attname) for f in related_fields)
+
+        def note_related(ids):
+            for field, related_id in zip(related_fields, ids):
+                if related_id is not None:
+                    related[field.attname].add(related_id)
+
+        # Hash the existing records
         objects = cls.objects.in_feed(feed)
+        existing = {}
+        for obj in objects.iterator():
+            existing[unique_key(obj)] = (
+                obj.id, row_hash(obj), related_ids(obj))
+        old_ids = set(old[0] for old in existing.values())
+        logger.info(
+            '%d %s to compare...',
+            len(existing), cls._meta.verbose_name_plural)
+
+        related = defaultdict(set)
+        updated = set()
+        seen = set()
+        deferred = []
+        file_keys = []
+        extra_counts = defaultdict(int)
+        counts = {'inserted': 0, 'unchanged': 0}
 
-        # If no records, return None
-        if not objects.exists():
+        def apply_rows(rows):
+            '''Insert the new rows and update the changed rows'''
+            plan.convert_columns([fields for _, fields, _ in rows])
+            plan.save_related()
+            new_objects = []
+            for line_num, fields, row_deferred in rows:
+                obj = cls(**fields)
+                key = unique_key(obj)
+                if key in seen:
+                    logger.warning(
+                        '%s line %d is a duplicate of an earlier line, not'
+                        ' imported.', cls._filename, line_num)
+                    continue
+                seen.add(key)
+                for step in plan.deferred_steps:
+                    file_keys.append(fields[step[2]])
+                for field_name, rel_name, value in row_deferred:
+                    deferred.append(
+                        (field_name, rel_name, fields[rel_name], value))
+
+                old = existing.pop(key, None)
+                if old is None:
+                    new_objects.append(obj)
+                    note_related(related_ids(obj))
+                    continue
+                old_id, old_hash, old_related = old
+                if row_hash(obj) == old_hash:
+                    counts['unchanged'] += 1
+                else:
+                    obj.id = old_id
+                    # Skip Base.save, the feed version is bumped once
+                    models.Model.save(obj, update_fields=update_fields)
+                    updated.add(old_id)
+                    note_related(old_related)
+                    note_related(related_ids(obj))
+            cls.objects.bulk_create(new_objects)
+            counts['inserted'] += len(new_objects)
+
+        # Compare the rows in batches
+        rows = []
+        for row in csv_reader:
+            if not row:
+                continue
+            fields, row_deferred = plan.convert(row)
+            if 'extra_data' in fields:
+                for column_name in fields['extra_data']:
+                    extra_counts[column_name] += 1
+            plan.note_populated(row)
+            rows.append((csv_reader.line_num, fields, row_deferred))
+            if len(rows) == batch_size:
+                apply_rows(rows)
+                rows = []
+        apply_rows(rows)
+
+        # Delete the records missing from the file
+        deleted_ids = []
+        missing = {}
+        for old_id, _, old_related in existing.values():
+            if keep_missing:
+                missing[old_id] = dict(
+                    (f.attname, related_id)
+                    for f, related_id in zip(related_fields, old_related))
+            else:
+                deleted_ids.append(old_id)
+                note_related(old_related)
+        for start in range(0, len(deleted_ids), in_batch_size):
+            cls.objects.filter(
+                id__in=deleted_ids[start:start + in_batch_size]).delete()
+
+        # Update relations to other rows in the file
+        if plan.deferred_steps:
+            updated.update(cls._update_deferred_relations(
+                feed, plan.deferred_steps, file_keys, deferred))
+
+        if extra_counts:
+            cls._note_extra_columns(feed, columns, extra_counts)
+        cls._note_populated_columns(feed, plan.populated, columns)
+        feed.bump_version()
+
+        inserted = set()
+        if counts['inserted']:
+            inserted = set(objects.values_list('id', flat=True)) - old_ids
+        logger.info(
+            'Updated %s: %d inserted, %d updated, %d deleted, %d unchanged',
+            cls._filename, len(inserted), len(updated), len(deleted_ids),
+            counts['unchanged'])
+        return {
+            'inserted': inserted,
+            'updated': updated,
+            'deleted': len(deleted_ids),
+            'unchanged': counts['unchanged'],
+            'missing': missing,
+            'related': dict(related),
+        }
+
+    @classmethod
+    def delete_unreferenced(cls, changes):
+        '''Delete the missing records that no other records refer to
+
+        changes is the result of update_txt(keep_missing=True).  Records
+        that are still referred to are kept, such as Services that are
+        missing from calendar.txt but used in calendar_dates.txt, which the
+        importer would create again.  changes is updated with the deleted
+        records, and the number deleted is returned.
+        '''
+        missing = changes['missing']
+        ids = sorted(missing)
+        deleted_ids = []
+        for start in range(0, len(ids), in_batch_size):
+            objects = cls.objects.filter(
+                id__in=ids[start:start + in_batch_size])
+            for rel in cls._meta.related_objects:
+                objects = objects.filter(**{rel.name + '__isnull': True})
+            chunk = list(objects.values_list('id', flat=True).distinct())
+            cls.objects.filter(id__in=chunk).delete()
+            deleted_ids.extend(chunk)
+        for deleted_id in deleted_ids:
+            for attname, related_id in missing.pop(deleted_id).items():
+                if related_id is not None:
+                    changes['related'].setdefault(attname, set()).add(
+                        related_id)
+        changes['deleted'] += len(deleted_ids)
+        if deleted_ids:
+            logger.info(
+                'Deleted %d unreferenced %s',
+                len(deleted_ids), cls._meta.verbose_name_plural)
+        return len(deleted_ids)
+
+    @classmethod
+    def _update_deferred_relations(
+            cls, feed, deferred_steps, file_keys, deferred):
+        '''Change the relations between rows in the file that differ
+
+        deferred_steps are the plan's (position, field_name, rel_name)
+        steps, file_keys are the rel_name values of the rows in the file,
+        and deferred is a list of (field_name, rel_name, key, value) as for
+        _set_deferred_relations.  Returns the IDs of the changed rows.
+        '''
+        changed = set()
+        objects = cls.objects.in_feed(feed)
+        for _, field_name, rel_name in deferred_steps:
+            ids = dict(
+                (text_type(x), i)
+                for x, i in objects.values_list(rel_name, 'id'))
+            current = dict(objects.values_list('id', field_name))
+            targets = {}
+            for name, _, key, value in deferred:
+                if name == field_name and key not in targets:
+                    if value not in ids:
+                        logger.warning(
+                            '%s %s=%s refers to unknown %s %s, not set.',
+                            cls._filename, rel_name, key, field_name,
+                            value)
+                    targets[key] = ids.get(value)
+            updates = defaultdict(list)
+            for key in file_keys:
+                row_id = ids[text_type(key)]
+                target = targets.get(key)
+                if current.get(row_id) != target:
+                    updates[target].append(row_id)
+                    current[row_id] = target
+            for target, row_ids in updates.items():
+                changed.update(row_ids)
+                for start in range(0, len(row_ids), in_batch_size):
+                    objects.filter(
+                        id__in=row_ids[start:start + in_batch_size]).update(
+                        **{field_name: target})
+        return changed
+
+    @classmethod
+    def export_txt(cls, feed):
+        '''Export records as a GTFS comma-separated file'''
+        batches = cls.export_batches(feed)
+        header = next(batches, None)
+        if header is None:
             return
+        out = StringIO()
+        csv_writer = writer(out, lineterminator='\n')
+        write_text_rows(csv_writer, header)
+        for rows in batches:
+            write_text_rows(csv_writer, rows)
+        return out.getvalue()
+
+    @classmethod
+    def export_objects(cls, feed):
+        '''Get the records to export, or None to skip the file'''
+        return cls.objects.in_feed(feed)
+
+    @classmethod
+    def export_plan(cls, feed, cached_columns=False, subset=None):
+        '''Plan the export of records as a GTFS file
+
+        Keyword arguments:
+        feed - The Feed to export
+        cached_columns - If True, use the optional columns cached by the
+            import, if any, rather than checking the records.  Only use
+            this if the records haven't been edited since the import.
+        subset - If set, a FeedSubset limiting the records to export
+
+        Returns (objects, column_map, extra_columns, sort_fields), or None if
+        there are no records to export.
+        '''
+        objects = cls.export_objects(feed)
+        if objects is not None and subset is not None:
+            objects = subset.filter(cls, feed, objects)
+
+        # If no records, skip the file
+        if objects is None or not objects.exists():
+            return None
 
         # Get the columns used in the dataset
-        column_map = objects.populated_column_map()
-        columns, fields = zip(*column_map)
+        cached = None
+        if cached_columns:
+            cached = feed.meta.get('populated_columns', {}).get(cls.__name__)
+        column_map = objects.populated_column_map(cached)
         extra_columns = feed.meta.get(
             'extra_columns', {}).get(cls.__name__, [])
 
@@ -319,7 +1456,7 @@ class Base(models.Model):
             sort_fields = cls._sort_order
         else:
             sort_fields = []
-            for field in fields:
+            for _, field in column_map:
                 base_field = field.split('__', 1)[0]
                 point_match = re_point.match(base_field)
                 if point_match:
@@ -327,15 +1464,70 @@ class Base(models.Model):
                 field_type = cls._meta.get_field(base_field)
                 assert not isinstance(field_type, ManyToManyField)
                 sort_fields.append(field)
+        return objects, column_map, extra_columns, sort_fields
 
-        # Create CSV writer
-        out = StringIO()
-        csv_writer = writer(out, lineterminator='\n')
+    @classmethod
+    def export_batches(cls, feed, cached_columns=False, subset=None):
+        '''Export records as batches of GTFS rows
 
-        # Write header row
-        header_row = [text_type(c) for c in columns]
-        header_row.extend(extra_columns)
-        write_text_rows(csv_writer, [header_row])
+        The first batch is the header row, and the others have up to
+        batch_size rows.  If there are no records, no batches are yielded.
+        See export_plan for the keyword arguments.
+        '''
+        query = cls._export_query(feed, cached_columns, subset)
+        if query is None:
+            return
+        columns, extra_columns, items = query
+
+        # Yield the header row
+        yield [[name for name, _, _ in columns]]
+
+        formatters = tuple(
+            text_column_formatters.get(kind) or column_formatter(
+                getter or text_formatters.get(kind, export_text))
+            for _, kind, getter in columns[:len(columns) - len(extra_columns)])
+        for rows in cls._export_rows(items, formatters, extra_columns, u''):
+            yield rows
+
+    @classmethod
+    def export_typed_batches(cls, feed, cached_columns=False, subset=None):
+        '''Export records as batches of typed rows, for columnar formats
+
+        The first batch is the columns, as (name, kind) pairs, where kind is
+        'text', 'date', 'bool', 'seconds', 'integer', 'float' or 'point'.
+        The rows have text, dates, booleans, times as integer seconds,
+        integers, and floats, with None for blank values.  Relations are
+        the related GTFS IDs, and points are split into float latitude and
+        longitude columns.  See export_plan for the keyword arguments.
+        '''
+        query = cls._export_query(feed, cached_columns, subset)
+        if query is None:
+            return
+        columns, extra_columns, items = query
+        yield [(name, kind) for name, kind, _ in columns]
+
+        formatters = tuple(
+            column_formatter(getter or typed_formatters.get(kind, no_convert))
+            for _, kind, getter in columns[:len(columns) - len(extra_columns)])
+        for rows in cls._export_rows(items, formatters, extra_columns, None):
+            yield rows
+
+    @classmethod
+    def _export_query(cls, feed, cached_columns, subset):
+        '''Query the columns to export
+
+        Returns None if there are no records, or a tuple:
+        columns - (name, kind, getter) for each GTFS column, where kind is
+            as for export_typed_batches, and getter formats a relation from
+            the related GTFS IDs, or is None for other columns
+        extra_columns - The names of the extra columns, at the end
+        items - A values_list query with a value per column, and the
+            extra_data if there are extra columns
+        '''
+        plan = cls.export_plan(feed, cached_columns, subset)
+        if plan is None:
+            return None
+        objects, column_map, extra_columns, sort_fields = plan
 
         # Report the work to be done
         total = objects.count()
@@ -346,65 +1538,174 @@ class Base(models.Model):
         # Populate related items cache
         model_to_field_name = {}
         cache = {}
-        for field_name in fields:
+        for _, field_name in column_map:
             if '__' in field_name:
                 local_field_name, subfield_name = field_name.split('__', 1)
                 field = cls._meta.get_field(local_field_name)
                 field_type = field.related_model
                 model_name = field_type.__name__
-                if model_name in model_to_field_name:
+                if subset is not None:
+                    # Load just the related records of the subset
+                    related = field_type.objects.filter(
+                        id__in=objects.values(local_field_name))
+                elif model_name in model_to_field_name:
                     # Already loaded this model under a different field name
                     cache[field_name] = cache[model_to_field_name[model_name]]
+                    continue
                 else:
                     # Load all feed data for this model
-                    pairs = field_type.objects.in_feed(
-                        feed).values_list('id', subfield_name)
-                    cache[field_name] = dict(
-                        (i, text_type(x)) for i, x in pairs)
-                    cache[field_name][None] = u''
+                    related = field_type.objects.in_feed(feed)
                     model_to_field_name[model_name] = field_name
+                pairs = related.values_list('id', subfield_name)
+                cache[field_name] = dict(
+                    (i, text_type(x)) for i, x in pairs)
+                cache[field_name][None] = u''
 
-        # Assemble the rows, writing when we hit batch size
-        count = 0
-        rows = []
-        for item in objects.order_by(*sort_fields).iterator():
-            row = []
-            for csv_name, field_name in column_map:
-                obj = item
-                point_match = re_point.match(field_name)
-                if '__' in field_name:
-                    # Return relations from cache
-                    local_field_name = field_name.split('__', 1)[0]
-                    field_id = getattr(obj, local_field_name + '_id')
-                    row.append(cache[field_name][field_id])
-                elif point_match:
-                    # Get the lat or long from the point
-                    name, index = point_match.groups()
-                    field = getattr(obj, name)
-                    row.append(field.coords[int(index)])
+        # Select just the exported columns, with a kind for each
+        values = []
+        columns = []
+        annotations = {}
+        for csv_name, field_name in column_map:
+            point_match = re_point.match(field_name)
+            csv_name = text_type(csv_name)
+            if '__' in field_name:
+                # Format relations from the cache
+                values.append(field_name.split('__', 1)[0])
+                columns.append(
+                    (csv_name, 'text', cache[field_name].__getitem__))
+            elif point_match:
+                # Get the lat or long from the point in the database
+                name, index = point_match.groups()
+                alias = 'export_%s_%s' % (name, index)
+                annotations[alias] = Func(
+                    F(name), function=('ST_X', 'ST_Y')[int(index)],
+                    output_field=models.FloatField())
+                values.append(alias)
+                columns.append((csv_name, 'point', None))
+            else:
+                field = cls._meta.get_field(field_name)
+                kind = export_kind(field)
+                if kind == 'seconds':
+                    # Select the integer seconds, rather than Seconds
+                    alias = 'export_%s' % field_name
+                    annotations[alias] = ExpressionWrapper(
+                        F(field_name), output_field=models.IntegerField())
+                    values.append(alias)
                 else:
-                    # Handle other field types
-                    field = getattr(obj, field_name) if obj else ''
-                    if isinstance(field, date):
-                        formatted = field.strftime(u'%Y%m%d')
-                        row.append(text_type(formatted))
-                    elif isinstance(field, bool):
-                        row.append(1 if field else 0)
-                    elif field is None:
-                        row.append(u'')
-                    else:
-                        row.append(text_type(field))
-            for col in extra_columns:
-                row.append(obj.extra_data.get(col, u''))
-            rows.append(row)
-            if len(rows) % batch_size == 0:  # pragma: no cover
-                write_text_rows(csv_writer, rows)
+                    values.append(field_name)
+                columns.append((csv_name, kind, None))
+        if extra_columns:
+            values.append('extra_data')
+            columns.extend((name, 'text', None) for name in extra_columns)
+        items = objects.annotate(**annotations).order_by(
+            *sort_fields).values_list(*values)
+        return columns, extra_columns, items
+
+    @classmethod
+    def _export_rows(cls, items, formatters, extra_columns, blank):
+        '''Format the queried items as batches of up to batch_size rows
+
+        Keyword arguments:
+        items - The values_list query from _export_query
+        formatters - A formatter for each column of a batch, before the
+            extra_data, which returns a list of the formatted values
+        extra_columns - The names of the extra columns
+        blank - The value of a missing extra column
+        '''
+        count = 0
+        iterator = items.iterator()
+        while True:
+            items_batch = list(islice(iterator, batch_size))
+            if not items_batch:
+                break
+            item_columns = list(zip(*items_batch))
+            columns = [
+                formatter(values)
+                for formatter, values in zip(formatters, item_columns)]
+            if extra_columns:
+                extras = []
+                for extra_data in item_columns[-1]:
+                    extra_data = extra_data or {}
+                    if isinstance(extra_data, string_types):
+                        # Older jsonfields only decode for model instances
+                        extra_data = json.loads(extra_data)
+                    extras.append(extra_data)
+                for col in extra_columns:
+                    columns.append(
+                        [extra_data.get(col, blank) for extra_data in extras])
+            rows = [list(row) for row in zip(*columns)]
+            yield rows
+            if len(rows) == batch_size:
                 count += len(rows)
                 logger.info(
                     "Exported %d %s",
                     count, cls._meta.verbose_name_plural)
-                rows = []
 
-        # Write rows smaller than batch size
-        write_text_rows(csv_writer, rows)
-        return out.getvalue()
+    @classmethod
+    def export_copy(cls, feed, cached_columns=False, subset=None):
+        '''Plan the export of records with PostgreSQL\'s COPY TO
+
+        The database joins the related IDs, and formats the dates, times,
+        points and extra columns, so the rows can be streamed as CSV without
+        Python formatting.  See export_plan for the keyword arguments.
+
+        Returns the header row and a COPY ... TO STDOUT statement for the
+        data rows, or None if there are no records.
+        '''
+        plan = cls.export_plan(feed, cached_columns, subset)
+        if plan is None:
+            return None
+        objects, column_map, extra_columns, sort_fields = plan
+
+        # Select each column as formatted text
+        annotations = {}
+        values = []
+        for csv_name, field_name in column_map:
+            point_match = re_point.match(field_name)
+            if '__' in field_name:
+                expression = copy_blank(F(field_name))
+            elif point_match:
+                name, index = point_match.groups()
+                expression = Func(
+                    F(name), function=('ST_X', 'ST_Y')[int(index)],
+                    output_field=models.FloatField())
+            else:
+                field = cls._meta.get_field(field_name)
+                if isinstance(field, models.DateField):
+                    expression = Func(
+                        F(field_name), Value('YYYYMMDD'), function='to_char',
+                        output_field=models.CharField())
+                elif isinstance(field, models.BooleanField):
+                    expression = Func(
+                        F(field_name), template='(%(expressions)s)::int',
+                        output_field=models.IntegerField())
+                elif isinstance(field, SecondsField):
+                    expression = Func(
+                        F(field_name), template=copy_seconds_template,
+                        output_field=models.CharField())
+                elif export_kind(field) == 'text':
+                    expression = copy_blank(F(field_name))
+                else:
+                    expression = F(field_name)
+            alias = 'export_%d' % len(values)
+            annotations[alias] = expression
+            values.append(alias)
+        for column in extra_columns:
+            alias = 'export_%d' % len(values)
+            annotations[alias] = copy_blank(Func(
+                Func(F('extra_data'), template='(%(expressions)s)::json',
+                     output_field=models.TextField()),
+                Value(column), function='json_extract_path_text',
+                output_field=models.TextField()))
+            values.append(alias)
+
+        items = objects.annotate(**annotations).order_by(
+            *sort_fields).values_list(*values)
+        sql, params = items.query.sql_with_params()
+        with connection.cursor() as cursor:
+            sql = cursor.mogrify(sql, params)
+        if not isinstance(sql, text_type):
+            sql = sql.decode('utf-8')
+        header_row = [text_type(c) for c, _ in column_map]
+        header_row.extend(extra_columns)
+        return header_row, 'COPY (%s) TO STDOUT WITH CSV' % sql
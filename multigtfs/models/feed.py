@@ -13,20 +13,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import unicode_literals
+from contextlib import contextmanager
+from csv import writer
 from zipfile import ZipFile
 import logging
 import os
 import os.path
+import shutil
+import sys
+import threading
 import time
 
 from django.contrib.gis.db import models
+from django.db import connection, transaction
 from django.db.models.signals import post_save
 from django.utils.encoding import python_2_unicode_compatible
-from django.utils.six import string_types
+from django.utils.six import StringIO, reraise, string_types
+from django.utils.six.moves import queue
 from jsonfield import JSONField
 
-from multigtfs.compat import open_writable_zipfile, opener_from_zipfile
+from multigtfs import signals
+from multigtfs.columnar import (
+    ParquetRows, parquet_name, require_pyarrow, write_parquet)
+from multigtfs.compat import (
+    open_writable_zipfile, opener_from_zipfile, temporary_text_file,
+    writable_zipfile_entry, write_text_rows)
+from multigtfs.indexes import (
+    drop_indexes, rebuild_indexes, supports_deferred_indexes)
 from .agency import Agency
+from .base import in_batch_size
 from .fare import Fare
 from .fare_rule import FareRule
 from .feed_info import FeedInfo
@@ -34,15 +49,92 @@ from .frequency import Frequency
 from .route import Route
 from .service import Service
 from .service_date import ServiceDate
-from .shape import ShapePoint, post_save_shapepoint
-from .stop import Stop, post_save_stop
-from .stop_time import StopTime
+from .shape import (
+    Shape, ShapePoint, mark_shapepoint_saved, post_save_shapepoint)
+from .stop import Stop, mark_stop_saved, post_save_stop
+from .stop_time import StopTime, mark_stoptime_saved
 from .transfer import Transfer
 from .trip import Trip
 
 logger = logging.getLogger(__name__)
 
 
+def import_dependencies(gtfs_order):
+    """Find the models that each GTFS model must be imported after.
+
+    A model depends on the models its _column_map refers to.  Missing
+    related objects are created on demand by the importers, such as Zones,
+    Blocks and Shapes, which have no GTFS file of their own, but also
+    Services that are only in calendar_dates.txt.  The importers that refer
+    to the same related model run one after another, in gtfs_order, so
+    they don't both create it.
+
+    Keyword arguments:
+    gtfs_order - A sequence of models, in a valid serial import order
+
+    Returns a dictionary of model to the set of models it depends on
+    """
+    depends = dict((klass, set()) for klass in gtfs_order)
+    shared = {}
+    for klass in gtfs_order:
+        for _, field_pattern in klass._column_map:
+            if '__' not in field_pattern:
+                continue
+            field_name = field_pattern.split('__', 1)[0]
+            related = klass._meta.get_field(field_name).related_model
+            if related is klass:
+                continue
+            if related in depends:
+                depends[klass].add(related)
+            users = shared.setdefault(related, [])
+            if klass not in users:
+                users.append(klass)
+    for users in shared.values():
+        for earlier, later in zip(users, users[1:]):
+            depends[later].add(earlier)
+    return depends
+
+
+def open_gtfs(gtfs_obj):
+    """Get an opener and the list of files in a GTFS feed
+
+    Keyword arguments:
+    gtfs_obj - A path to a zipped GTFS file, a path to an extracted
+        GTFS file, or an open GTFS zip file.
+
+    Returns a tuple (opener, filelist), where opener opens a file name from
+    filelist as a text file
+    """
+    if isinstance(gtfs_obj, string_types) and os.path.isdir(gtfs_obj):
+        opener = open
+        filelist = []
+        for dirpath, dirnames, filenames in os.walk(gtfs_obj):
+            filelist.extend([os.path.join(dirpath, f) for f in filenames])
+    else:
+        zfile = ZipFile(gtfs_obj, 'r')
+        opener = opener_from_zipfile(zfile)
+        filelist = zfile.namelist()
+    return opener, filelist
+
+
+# The order to import GTFS files, so related objects exist
+gtfs_order = (
+    Agency, Stop, Route, Service, ServiceDate, ShapePoint, Trip,
+    StopTime, Frequency, Fare, FareRule, Transfer, FeedInfo,
+)
+
+
+# The order to export GTFS files
+export_order = (
+    Agency, Service, ServiceDate, Fare, FareRule, FeedInfo, Frequency,
+    Route, ShapePoint, StopTime, Stop, Transfer, Trip,
+)
+
+
+# The models with indexes dropped by import_gtfs(defer_indexes=True)
+deferred_index_models = (ShapePoint, Trip, StopTime)
+
+
 @python_2_unicode_compatible
 class Feed(models.Model):
     """Represents a single GTFS feed.
@@ -53,6 +145,9 @@ class Feed(models.Model):
     name = models.CharField(max_length=255)
     created = models.DateTimeField(auto_now_add=True)
     meta = JSONField(default={}, blank=True, null=True)
+    version = models.PositiveIntegerField(
+        default=0,
+        help_text='Incremented when the records of the feed are changed')
 
     class Meta:
         db_table = 'feed'
@@ -64,115 +159,638 @@ class Feed(models.Model):
         else:
             return "%d" % self.id
 
-    def import_gtfs(self, gtfs_obj):
+    def save(self, *args, **kwargs):
+        """Save the feed, leaving the version to bump_version"""
+        if (not self._state.adding and not kwargs.get('force_insert') and
+                kwargs.get('update_fields') is None):
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != 'version']
+        super(Feed, self).save(*args, **kwargs)
+
+    def bump_version(self):
+        """Note that the records of the feed have changed
+
+        This is called by imports and updates, and by saving or deleting a
+        single record.  Call it after changing records with a QuerySet's
+        update() or delete(), or with SQL, so that cached exports of the
+        feed are refreshed.
+        """
+        Feed.objects.filter(id=self.id).update(
+            version=models.F('version') + 1)
+        self.version += 1
+
+    def import_gtfs(
+            self, gtfs_obj, use_copy=False, jobs=1, dedupe='memory',
+            batch_size=None, atomic=None, resume=False,
+            defer_indexes=False):
         """Import a GTFS file as feed
 
         Keyword arguments:
         gtfs_obj - A path to a zipped GTFS file, a path to an extracted
             GTFS file, or an open GTFS zip file.
+        use_copy - If True, load rows with PostgreSQL's COPY FROM STDIN
+            instead of bulk_create.  Ignored on other databases.
+        jobs - The number of GTFS files to import at the same time, each in
+            a thread with its own database connection.  Files are started
+            as soon as the files they refer to are imported.  SQLite,
+            imports inside a transaction, and atomic imports always use
+            one job.
+        dedupe - 'memory' to drop rows with duplicate IDs while reading,
+            or 'database' to delete them after each file is loaded.
+        batch_size - The number of rows to insert at a time.  Either an
+            integer for all files, or a dictionary of model names (such as
+            'StopTime') or GTFS file names (such as 'stop_times.txt') to
+            sizes.  The size for the key None is used for other files.
+            The default is multigtfs.models.base.batch_size.
+        atomic - None (the default) to save each batch as it is inserted,
+            'file' to import each GTFS file in a transaction, or 'feed' to
+            import the whole feed, including geometries, in one
+            transaction.  An atomic import always uses one job, since the
+            import progress in the feed row is saved in each transaction.
+        resume - If True, continue an import into this feed that stopped
+            part way.  Files that were completely imported are skipped, and
+            a partly imported file continues after the last saved batch.
+            The progress of each file is kept in meta['import_progress'].
+        defer_indexes - If True, drop the secondary indexes of the large
+            tables (see deferred_index_models) before loading, and rebuild
+            and analyze them once the files are imported.  This is only
+            done for PostgreSQL and SQLite databases where the tables are
+            empty, such as a new database for the feed.
 
         Returns is a list of objects imported
         """
+        assert atomic in (None, 'file', 'feed')
         total_start = time.time()
+        signals.import_started.send(sender=Feed, feed=self)
+        if not resume and self.meta.pop('import_progress', None):
+            self.save()
+
+        opener, filelist = open_gtfs(gtfs_obj)
+        klass_files = []
+        for klass in gtfs_order:
+            names = [
+                f for f in filelist
+                if os.path.basename(f) == klass._filename]
+            if names:
+                klass_files.append((klass, names))
+
+        def get_batch_size(klass):
+            if isinstance(batch_size, dict):
+                for key in (klass.__name__, klass._filename, None):
+                    if key in batch_size:
+                        return batch_size[key]
+                return None
+            return batch_size
+
+        def import_file(klass, f):
+            signals.file_started.send(sender=klass, feed=self, filename=f)
+            start_time = time.time()
+            resumed_rows = self.meta.get('import_progress', {}).get(
+                f, {}).get('rows', 0)
+            table = opener(f)
+            count = klass.import_txt(
+                table, self, use_copy=use_copy, dedupe=dedupe,
+                batch_size=get_batch_size(klass), checkpoint=f)
+            table.close()
+            elapsed = time.time() - start_time
+            loaded = 0 if count is None else count - resumed_rows
+            signals.file_finished.send(
+                sender=klass, feed=self, filename=f, rows=count or 0,
+                elapsed=elapsed,
+                rows_per_second=signals.rows_per_second(loaded, elapsed),
+                peak_memory=signals.peak_memory())
+            if count is None:
+                return
+            logger.info(
+                'Imported %s (%d %s) in %0.1f seconds',
+                klass._filename, count,
+                klass._meta.verbose_name_plural, elapsed)
+
+        def import_klass(klass, names):
+            for f in names:
+                if atomic:
+                    # A transaction, or a savepoint in a 'feed' import
+                    with transaction.atomic():
+                        import_file(klass, f)
+                else:
+                    import_file(klass, f)
+
+        if jobs > 1 and connection.vendor == 'sqlite':
+            logger.warning(
+                'SQLite does not support concurrent writes, using 1 job.')
+            jobs = 1
+        elif jobs > 1 and (connection.in_atomic_block or atomic):
+            # Each file's transaction would hold the lock on the feed row,
+            # which the other files' transactions update with their progress
+            logger.warning(
+                'Importing inside a transaction, using 1 job.')
+            jobs = 1
 
-        # Determine the type of gtfs_obj
-        opener = None
-        filelist = None
-        if isinstance(gtfs_obj, string_types) and os.path.isdir(gtfs_obj):
-            opener = open
-            filelist = []
-            for dirpath, dirnames, filenames in os.walk(gtfs_obj):
-                filelist.extend([os.path.join(dirpath, f) for f in filenames])
+        rebuild = None
+        if defer_indexes:
+            if not supports_deferred_indexes():
+                logger.warning(
+                    'Deferred indexes are not supported by the %s backend.',
+                    connection.vendor)
+            elif any(m.objects.exists() for m in deferred_index_models):
+                logger.warning(
+                    'Not deferring indexes, the tables are not empty.')
+            else:
+                rebuild = []
+
+        def import_all():
+            post_save.disconnect(dispatch_uid='post_save_shapepoint')
+            post_save.disconnect(dispatch_uid='post_save_stop')
+            if rebuild is not None:
+                rebuild.extend(drop_indexes(deferred_index_models))
+            try:
+                if jobs > 1:
+                    self._import_parallel(
+                        klass_files, import_dependencies(gtfs_order),
+                        import_klass, jobs)
+                else:
+                    for klass, names in klass_files:
+                        import_klass(klass, names)
+            except Exception:
+                # A rolled back transaction restores the indexes
+                if rebuild and not connection.in_atomic_block:
+                    rebuild_indexes(rebuild, deferred_index_models)
+                raise
+            finally:
+                post_save.connect(post_save_shapepoint, sender=ShapePoint)
+                post_save.connect(post_save_stop, sender=Stop)
+            if rebuild:
+                rebuild_indexes(rebuild, deferred_index_models)
+            # Shape geometries are built by ShapePoint.import_txt
+            self.update_geometries(update_shapes=False)
+
+        if atomic == 'feed':
+            with transaction.atomic():
+                import_all()
         else:
-            zfile = ZipFile(gtfs_obj, 'r')
-            opener = opener_from_zipfile(zfile)
-            filelist = zfile.namelist()
+            import_all()
+
+        total_end = time.time()
+        logger.info(
+            "Import completed in %0.1f seconds.", total_end - total_start)
+        signals.import_finished.send(
+            sender=Feed, feed=self, elapsed=total_end - total_start,
+            peak_memory=signals.peak_memory())
+
+    def update_gtfs(self, gtfs_obj, batch_size=None):
+        """Update the feed in place to match a new version of the GTFS feed
 
-        gtfs_order = (
-            Agency, Stop, Route, Service, ServiceDate, ShapePoint, Trip,
-            StopTime, Frequency, Fare, FareRule, Transfer, FeedInfo,
+        Each GTFS file is compared to the feed's records by the model's
+        _unique_fields, and only the new, changed and removed rows are
+        written.  The records of files missing from the new version are
+        deleted.  Records that other models refer to, such as Services, are
+        only deleted at the end if no records refer to them any more, since
+        the importers create them as needed for the other files.  Then the
+        cached geometries are updated for the shapes, trips and routes
+        affected by the changes.
+
+        Keyword arguments:
+        gtfs_obj - A path to a zipped GTFS file, a path to an extracted
+            GTFS file, or an open GTFS zip file.
+        batch_size - The number of rows to compare and insert at a time,
+            as for import_gtfs
+
+        Returns a dictionary of GTFS file names to the changes returned by
+        the model's update_txt
+        """
+        total_start = time.time()
+        opener, filelist = open_gtfs(gtfs_obj)
+        files = dict((os.path.basename(f), f) for f in filelist)
+        changes = {}
+
+        receivers = (
+            (mark_shapepoint_saved, ShapePoint, 'mark_shapepoint_saved'),
+            (post_save_shapepoint, ShapePoint, 'post_save_shapepoint'),
+            (mark_stop_saved, Stop, 'mark_stop_saved'),
+            (post_save_stop, Stop, 'post_save_stop'),
+            (mark_stoptime_saved, StopTime, 'mark_stoptime_saved'),
         )
-        post_save.disconnect(dispatch_uid='post_save_shapepoint')
-        post_save.disconnect(dispatch_uid='post_save_stop')
+        for receiver, sender, uid in receivers:
+            post_save.disconnect(sender=sender, dispatch_uid=uid)
         try:
             for klass in gtfs_order:
-                for f in filelist:
-                    if os.path.basename(f) == klass._filename:
-                        start_time = time.time()
-                        table = opener(f)
-                        count = klass.import_txt(table, self) or 0
-                        end_time = time.time()
-                        logger.info(
-                            'Imported %s (%d %s) in %0.1f seconds',
-                            klass._filename, count,
-                            klass._meta.verbose_name_plural,
-                            end_time - start_time)
-                        table.close()
+                if klass._filename in files:
+                    table = opener(files[klass._filename])
+                elif klass.objects.in_feed(self).exists():
+                    table = StringIO()  # Delete the records
+                else:
+                    continue
+                size = batch_size
+                if isinstance(batch_size, dict):
+                    size = batch_size.get(
+                        klass.__name__, batch_size.get(
+                            klass._filename, batch_size.get(None)))
+                changes[klass._filename] = klass.update_txt(
+                    table, self, batch_size=size,
+                    keep_missing=bool(klass._meta.related_objects))
+                table.close()
 
+            # Delete the records no longer referred to, dependents first
+            deleted = 0
+            for klass in reversed(gtfs_order):
+                if klass._filename in changes:
+                    deleted += klass.delete_unreferenced(
+                        changes[klass._filename])
+            if deleted:
+                self.bump_version()
         finally:
-            post_save.connect(post_save_shapepoint, sender=ShapePoint)
-            post_save.connect(post_save_stop, sender=Stop)
+            for receiver, sender, uid in receivers:
+                post_save.connect(receiver, sender=sender, dispatch_uid=uid)
 
-        # Update geometries
-        start_time = time.time()
-        for shape in self.shape_set.all():
-            shape.update_geometry(update_parent=False)
-        end_time = time.time()
+        empty = {'inserted': set(), 'updated': set(), 'related': {}}
+
+        def related(klass, attname):
+            result = changes.get(klass._filename, empty)
+            return result['related'].get(attname, set())
+
+        # Find the shapes, trips and routes with changed geometries
+        shape_ids = related(ShapePoint, 'shape_id')
+        trip_changes = changes.get(Trip._filename, empty)
+        trip_ids = trip_changes['inserted'] | trip_changes['updated']
+        trip_ids |= related(StopTime, 'trip_id')
+        stop_list = list(changes.get(Stop._filename, empty)['updated'])
+        for start in range(0, len(stop_list), in_batch_size):
+            trip_ids.update(StopTime.objects.filter(
+                stop_id__in=stop_list[start:start + in_batch_size]
+            ).values_list('trip_id', flat=True))
+        route_ids = set(related(Trip, 'route_id'))
+
+        self.update_geometries(shape_ids, trip_ids, route_ids)
+        total_end = time.time()
         logger.info(
-            "Updated geometries for %d shapes in %0.1f seconds",
-            self.shape_set.count(), end_time - start_time)
+            "Update completed in %0.1f seconds.", total_end - total_start)
+        return changes
+
+    def update_dirty_geometries(self):
+        """Update the cached geometries marked as out of date
+
+        Saving a ShapePoint, Stop, or StopTime marks the geometries that
+        depend on it, and deleting a ShapePoint, StopTime, or Trip (but not
+        a bulk delete of a queryset) marks its parent.
+        """
+        def dirty(klass):
+            return set(klass.objects.in_feed(self).filter(
+                geometry_dirty=True).values_list('id', flat=True))
+
+        self.update_geometries(dirty(Shape), dirty(Trip), dirty(Route))
+
+    def update_geometries(
+            self, shape_ids=None, trip_ids=None, route_ids=None,
+            update_shapes=True):
+        """Update the cached geometries of shapes, trips and routes
+
+        Keyword arguments:
+        shape_ids, trip_ids, route_ids - If any are set, only update the
+            geometries of these shapes, trips, and routes, of the trips of
+            the shapes, and of the routes of the trips.  By default, all
+            the geometries in the feed are updated.  Only changed
+            geometries are written.
+        update_shapes - If False, skip the shapes, for example because their
+            geometries were built during the import.
+        """
+        selected = not (
+            shape_ids is None and trip_ids is None and route_ids is None)
+        if selected:
+            shape_ids = set(shape_ids or ())
+            trip_ids = set(trip_ids or ())
+            route_ids = set(route_ids or ())
+
+        def finish_stage(stage, rows, start_time):
+            elapsed = time.time() - start_time
+            logger.info(
+                "Updated geometries for %d %s in %0.1f seconds",
+                rows, stage, elapsed)
+            signals.geometry_stage_finished.send(
+                sender=Feed, feed=self, stage=stage, rows=rows,
+                elapsed=elapsed,
+                rows_per_second=signals.rows_per_second(rows, elapsed),
+                peak_memory=signals.peak_memory())
+
+        if update_shapes:
+            start_time = time.time()
+            rows = Shape.update_geometries(self, shape_ids)
+            finish_stage('shapes', rows, start_time)
+
+        if selected:
+            shape_list = sorted(shape_ids)
+            for start in range(0, len(shape_list), in_batch_size):
+                trip_ids.update(Trip.objects.filter(
+                    shape_id__in=shape_list[start:start + in_batch_size]
+                ).values_list('id', flat=True))
 
         start_time = time.time()
-        trips = Trip.objects.in_feed(self)
-        for trip in trips:
-            trip.update_geometry(update_parent=False)
-        end_time = time.time()
-        logger.info(
-            "Updated geometries for %d trips in %0.1f seconds",
-            trips.count(), end_time - start_time)
+        rows = Trip.update_geometries(self, trip_ids)
+        finish_stage('trips', rows, start_time)
 
         start_time = time.time()
-        routes = self.route_set.all()
-        for route in routes:
-            route.update_geometry()
-        end_time = time.time()
-        logger.info(
-            "Updated geometries for %d routes in %0.1f seconds",
-            routes.count(), end_time - start_time)
+        if selected:
+            for chunk in Trip._geometry_chunks(self, trip_ids):
+                route_ids.update(Trip.objects.filter(
+                    id__in=chunk).values_list('route_id', flat=True))
+        rows = Route.update_geometries(self, route_ids)
+        finish_stage('routes', rows, start_time)
 
-        total_end = time.time()
-        logger.info(
-            "Import completed in %0.1f seconds.", total_end - total_start)
+    def _import_parallel(self, klass_files, depends, import_klass, jobs):
+        """Import GTFS files in threads, respecting dependencies
+
+        Keyword arguments:
+        klass_files - A sequence of (model, filenames) pairs to import
+        depends - A dictionary of model to the models it must follow
+        import_klass - A function to import the files for a model
+        jobs - The maximum number of threads to run at once
+        """
+        present = set(klass for klass, _ in klass_files)
+        pending = list(klass_files)
+        running = set()
+        done = set()
+        results = queue.Queue()
+        error = None
+
+        def worker(klass, names):
+            try:
+                import_klass(klass, names)
+            except Exception:
+                results.put((klass, sys.exc_info()))
+            else:
+                results.put((klass, None))
+            finally:
+                connection.close()
 
-    def export_gtfs(self, gtfs_file):
+        while pending or running:
+            if error is None:
+                for klass, names in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    waiting = (depends[klass] & present) - done
+                    if not waiting:
+                        pending.remove((klass, names))
+                        running.add(klass)
+                        thread = threading.Thread(
+                            target=worker, args=(klass, names))
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+            klass, exc_info = results.get()
+            running.discard(klass)
+            if exc_info:
+                error = error or exc_info
+            else:
+                done.add(klass)
+        if error:
+            reraise(*error)
+
+    def export_gtfs(
+            self, gtfs_file, cached_columns=False, use_copy=False, jobs=1,
+            subset=None):
         """Export a GTFS file as feed
 
         Keyword arguments:
         gtfs_file - A path or file-like object for the GTFS feed
+        cached_columns - If True, use the optional columns cached when the
+            feed was imported, instead of checking the records.  Only use
+            this if the feed hasn't been edited since it was imported.
+        use_copy - If True and the database is PostgreSQL, format the rows
+            in the database and stream them with COPY TO STDOUT.
+        jobs - The number of GTFS files to export at the same time, each in
+            a thread with its own database connection.  The threads share a
+            PostgreSQL snapshot, so the files are consistent.  Other
+            databases export one file at a time.
+        subset - If set, a FeedSubset, such as the trips of some routes and
+            the records they refer to, to export instead of the whole feed
 
         This function will close the file in order to finalize it.
         """
         total_start = time.time()
+        if use_copy and connection.vendor != 'postgresql':
+            logger.warning(
+                'COPY is not supported by the %s backend, exporting rows.',
+                connection.vendor)
+            use_copy = False
+        if jobs > 1 and connection.vendor != 'postgresql':
+            logger.warning(
+                'Snapshots are not supported by the %s backend, using 1 job.',
+                connection.vendor)
+            jobs = 1
+        elif jobs > 1 and connection.in_atomic_block:
+            logger.warning('Exporting inside a transaction, using 1 job.')
+            jobs = 1
         z = open_writable_zipfile(gtfs_file)
 
-        gtfs_order = (
-            Agency, Service, ServiceDate, Fare, FareRule, FeedInfo, Frequency,
-            Route, ShapePoint, StopTime, Stop, Transfer, Trip,
-        )
+        def log_file(klass, record_count, start_time):
+            end_time = time.time()
+            logger.info(
+                'Exported %s (%d %s) in %0.1f seconds',
+                klass._filename, record_count,
+                klass._meta.verbose_name_plural,
+                end_time - start_time)
 
-        for klass in gtfs_order:
-            start_time = time.time()
-            content = klass.export_txt(self)
-            if content:
-                z.writestr(klass._filename, content)
-                end_time = time.time()
-                record_count = content.count(type(content)('\n')) - 1
-                logger.info(
-                    'Exported %s (%d %s) in %0.1f seconds',
-                    klass._filename, record_count,
-                    klass._meta.verbose_name_plural,
-                    end_time - start_time)
+        if jobs > 1:
+            self._export_parallel(
+                z, export_order, cached_columns, use_copy, subset, jobs,
+                log_file)
+        else:
+            for klass in export_order:
+                start_time = time.time()
+                record_count = self._export_file(
+                    klass, lambda: writable_zipfile_entry(z, klass._filename),
+                    cached_columns, use_copy, subset)
+                if record_count is not None:
+                    log_file(klass, record_count, start_time)
         z.close()
         total_end = time.time()
         logger.info(
             'Export completed in %0.1f seconds.', total_end - total_start)
+
+    def export_parquet(self, directory, cached_columns=False, subset=None):
+        """Export the feed as a directory of typed Parquet files
+
+        Each GTFS file is written as a Parquet file of the same name, such
+        as stop_times.parquet, with text, date32, and boolean columns, times
+        as int32 seconds, integers as int64, and other numbers, latitudes
+        and longitudes as float64.  Requires pyarrow.
+
+        Keyword arguments:
+        directory - The directory for the Parquet files, which is created
+            if needed
+        cached_columns, subset - As for export_gtfs
+        """
+        require_pyarrow()
+        total_start = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for klass in export_order:
+            start_time = time.time()
+            batches = klass.export_typed_batches(
+                self, cached_columns, subset)
+            columns = next(batches, None)
+            if columns is None:
+                continue
+            path = os.path.join(directory, parquet_name(klass._filename))
+            record_count = write_parquet(path, columns, batches)
+            logger.info(
+                'Exported %s (%d %s) in %0.1f seconds',
+                os.path.basename(path), record_count,
+                klass._meta.verbose_name_plural, time.time() - start_time)
+        logger.info(
+            'Export completed in %0.1f seconds.', time.time() - total_start)
+
+    def import_parquet(self, directory, use_copy=False, batch_size=None):
+        """Import a directory of Parquet files from export_parquet
+
+        The typed values are loaded without parsing text, dates or times.
+        Files missing from the directory are skipped.  Requires pyarrow.
+
+        Keyword arguments:
+        directory - The directory of Parquet files
+        use_copy, batch_size - As for import_gtfs, but batch_size is
+            an integer
+        """
+        require_pyarrow()
+        total_start = time.time()
+        for klass in gtfs_order:
+            path = os.path.join(directory, parquet_name(klass._filename))
+            if not os.path.exists(path):
+                continue
+            start_time = time.time()
+            count = klass.import_txt(
+                ParquetRows(path), self, use_copy=use_copy,
+                batch_size=batch_size, typed=True)
+            logger.info(
+                'Imported %s (%d %s) in %0.1f seconds',
+                os.path.basename(path), count,
+                klass._meta.verbose_name_plural, time.time() - start_time)
+        # Shape geometries are built by ShapePoint.import_txt
+        self.update_geometries(update_shapes=False)
+        logger.info(
+            "Import completed in %0.1f seconds.", time.time() - total_start)
+
+    def _export_file(
+            self, klass, open_file, cached_columns, use_copy, subset):
+        """Export a model's GTFS file
+
+        Keyword arguments:
+        klass - The model to export
+        open_file - A function returning a context manager for the text file
+            to write, which is only called if there are records
+        cached_columns, use_copy, subset - As for export_gtfs
+
+        Returns the number of rows, or None if there are no records
+        """
+        if use_copy:
+            export = klass.export_copy(self, cached_columns, subset)
+            if export is None:
+                return None
+            header, copy_sql = export
+            with open_file() as out:
+                write_text_rows(writer(out, lineterminator='\n'), [header])
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(copy_sql, out)
+                    return cursor.rowcount
+
+        batches = klass.export_batches(self, cached_columns, subset)
+        header = next(batches, None)
+        if header is None:
+            return None
+        record_count = 0
+        with open_file() as out:
+            csv_writer = writer(out, lineterminator='\n')
+            write_text_rows(csv_writer, header)
+            for rows in batches:
+                write_text_rows(csv_writer, rows)
+                record_count += len(rows)
+        return record_count
+
+    def _export_parallel(
+            self, z, klasses, cached_columns, use_copy, subset, jobs,
+            log_file):
+        """Export GTFS files in threads, and write them in order
+
+        Each thread exports a file to a temporary file, in a repeatable read
+        transaction using the snapshot of this connection.  The finished
+        files are copied into the zipfile in the order of klasses.
+
+        Keyword arguments:
+        z - The zipfile to write
+        klasses - The models to export, in order
+        cached_columns, use_copy, subset, jobs - As for export_gtfs
+        log_file - A function to log an exported file
+        """
+        results = queue.Queue()
+        finished = {}
+        error = None
+
+        def worker(klass, snapshot):
+            start_time = time.time()
+            temp = temporary_text_file()
+
+            @contextmanager
+            def open_temp():
+                yield temp
+
+            try:
+                with transaction.atomic():
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                        cursor.execute(
+                            'SET TRANSACTION SNAPSHOT %s', [snapshot])
+                    record_count = self._export_file(
+                        klass, open_temp, cached_columns, use_copy,
+                        subset)
+            except Exception:
+                temp.close()
+                results.put((klass, None, sys.exc_info()))
+            else:
+                results.put((klass, (temp, record_count, start_time), None))
+            finally:
+                connection.close()
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+                cursor.execute('SELECT pg_export_snapshot()')
+                snapshot = cursor.fetchone()[0]
+
+            pending = list(klasses)
+            running = 0
+            written = 0
+            while written < len(klasses):
+                while pending and running < jobs and error is None:
+                    thread = threading.Thread(
+                        target=worker, args=(pending.pop(0), snapshot))
+                    thread.daemon = True
+                    thread.start()
+                    running += 1
+                if not running:
+                    break
+                klass, result, exc_info = results.get()
+                running -= 1
+                if exc_info:
+                    error = error or exc_info
+                    continue
+                finished[klass] = result
+
+                # Write the finished files that are next in order
+                while written < len(klasses) and klasses[written] in finished:
+                    klass = klasses[written]
+                    temp, record_count, start_time = finished.pop(klass)
+                    if record_count is not None:
+                        temp.seek(0)
+                        with writable_zipfile_entry(z, klass._filename) as out:
+                            shutil.copyfileobj(temp, out)
+                        log_file(klass, record_count, start_time)
+                    temp.close()
+                    written += 1
+
+        for temp, _, _ in finished.values():
+            temp.close()
+        if error:
+            reraise(*error)
@@ -14,8 +14,10 @@
 # limitations under the License.
 from __future__ import unicode_literals
 
-from .seconds import Seconds, SecondsField
+from .seconds import (
+    Seconds, SecondsField, format_time, format_times, parse_time, parse_times)
 
 # pyflakes be quiet
 __classes__ = Seconds
 __fields__ = SecondsField
+__functions__ = (format_time, format_times, parse_time, parse_times)
@@ -19,25 +19,101 @@ from __future__ import unicode_literals
 
 from django.db.models import Field
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.six import integer_types
+
+# Seconds values from 00:00:00 to 47:59:59 are shared instances
+CACHE_LIMIT = 48 * 60 * 60
+
+
+def parse_time(value):
+    '''
+    Parse a time into an integer number of seconds.
+
+    Handled formats:
+    HH:MM:SS
+    HH:MM
+    SS
+    '''
+    if isinstance(value, integer_types):
+        return value
+    parts = str(value).split(':')
+    if len(parts) == 3:
+        hours, minutes, seconds = parts
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    elif len(parts) == 2:
+        hours, minutes = parts
+        return int(hours) * 3600 + int(minutes) * 60
+    elif len(parts) == 1:
+        return int(parts[0])
+    else:
+        raise ValueError('Must be in seconds or HH:MM:SS format')
+
+
+def format_time(seconds):
+    '''Format an integer number of seconds as HH:MM:SS'''
+    return "%02d:%02d:%02d" % (
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def parse_times(values):
+    '''
+    Parse a column of times into a list of integer seconds.
+
+    Blank times are parsed as None.
+    '''
+    return [parse_time(value) if value else None for value in values]
+
+
+def format_times(values):
+    '''
+    Format a column of integer seconds into a list of HH:MM:SS strings.
+
+    None is formatted as a blank string.
+    '''
+    return ['' if value is None else format_time(value) for value in values]
 
 
 @python_2_unicode_compatible
 class Seconds(object):
-    '''A GTFS seconds value, formatted as HH:MM:SS in the GTFS feed'''
-
-    def __init__(self, seconds=0):
-        self.seconds = int(seconds)
-        if self.seconds < 0:
-            raise ValueError('seconds must be positive')
+    '''A GTFS seconds value, formatted as HH:MM:SS in the GTFS feed
+
+    Seconds are immutable, and the values from 0 to 48 hours are cached,
+    so that loading millions of stop times shares the instances.
+    '''
+    __slots__ = ('_seconds',)
+    _cache = {}
+
+    def __new__(cls, seconds=0):
+        seconds = int(seconds)
+        instance = cls._cache.get(seconds)
+        if instance is None or type(instance) is not cls:
+            if seconds < 0:
+                raise ValueError('seconds must be positive')
+            instance = super(Seconds, cls).__new__(cls)
+            instance._seconds = seconds
+            if cls is Seconds and seconds < CACHE_LIMIT:
+                cls._cache[seconds] = instance
+        return instance
+
+    @property
+    def seconds(self):
+        return self._seconds
 
     @classmethod
     def from_hms(cls, hours=0, minutes=0, seconds=0):
         return Seconds((hours * 60 * 60) + (minutes * 60) + seconds)
 
     def __str__(self):
-        minutes, seconds = divmod(self.seconds, 60)
-        hours, minutes = divmod(minutes, 60)
-        return "%02d:%02d:%02d" % (hours, minutes, seconds)
+        return format_time(self._seconds)
+
+    def __repr__(self):
+        return 'Seconds(%d)' % self._seconds
+
+    def __reduce__(self):
+        return (Seconds, (self._seconds,))
+
+    def __hash__(self):
+        return hash(self._seconds)
 
     def _compare(self, other, method):
         try:
@@ -73,6 +149,8 @@ class SecondsField(Field):
         '''Handle data loaded from database.'''
         if value is None:
             return value
+        if isinstance(value, integer_types):
+            return Seconds(value)
         return self.parse_seconds(value)
 
     def to_python(self, value):
@@ -93,25 +171,14 @@ class SecondsField(Field):
         HH:MM
         SS
         '''
-        svalue = str(value)
-        colons = svalue.count(':')
-        if colons == 2:
-            hours, minutes, seconds = [int(v) for v in svalue.split(':')]
-        elif colons == 1:
-            hours, minutes = [int(v) for v in svalue.split(':')]
-            seconds = 0
-        elif colons == 0:
-            hours = 0
-            minutes = 0
-            seconds = int(svalue)
-        else:
-            raise ValueError('Must be in seconds or HH:MM:SS format')
-        return Seconds.from_hms(hours, minutes, seconds)
+        return Seconds(parse_time(value))
 
     def get_prep_value(self, value):
         '''Prepare value for database storage.'''
         if isinstance(value, Seconds):
             return value.seconds
+        elif isinstance(value, integer_types):
+            return Seconds(value).seconds
         elif value:
             return self.parse_seconds(value).seconds
         else:
@@ -15,6 +15,7 @@
 from __future__ import unicode_literals
 
 from django.contrib.gis.geos import MultiLineString
+from django.db import connection
 from django.utils.encoding import python_2_unicode_compatible
 from jsonfield import JSONField
 
@@ -67,6 +68,9 @@ class Route(Base):
     geometry = models.MultiLineStringField(
         null=True, blank=True,
         help_text='Geometry cache of Trips')
+    geometry_dirty = models.BooleanField(
+        default=False, db_index=True,
+        help_text='Is the geometry cache out of date?')
     extra_data = JSONField(default={}, blank=True, null=True)
 
     def update_geometry(self):
@@ -81,8 +85,62 @@ class Route(Base):
                 unique_coords.add(coords)
                 unique_geom.append(t.geometry)
         self.geometry = MultiLineString(unique_geom)
-        if self.geometry != original:
-            self.save()
+        self._save_geometry(self.geometry != original)
+
+    @classmethod
+    def update_geometries(cls, feed, ids=None):
+        """Update the geometries of routes from their Trips
+
+        This is the same as update_geometry() for each route.  With
+        PostGIS, the distinct trip lines are collected in the database.
+
+        Keyword arguments:
+        feed - The Feed of the routes
+        ids - If set, only update the routes with these IDs
+
+        Returns the number of routes changed
+        """
+        from multigtfs.models.trip import Trip
+        changed = 0
+        for chunk in cls._geometry_chunks(feed, ids):
+            cls._clear_geometry_dirty(feed, chunk)
+            if getattr(connection.ops, 'postgis', False):
+                id_sql, id_params = cls._id_filter('r.id', chunk)
+                changed += cls._update_geometries_sql(
+                    'SELECT r.id, COALESCE(g.geometry, ST_GeomFromEWKT(%s))'
+                    ' FROM route r LEFT JOIN ('
+                    '  SELECT u.route_id, ST_Multi(ST_Collect('
+                    '   ST_GeomFromEWKB(u.ewkb) ORDER BY u.first_id))'
+                    '   AS geometry FROM ('
+                    '    SELECT t.route_id, MIN(t.id) AS first_id,'
+                    '     ST_AsEWKB(t.geometry) AS ewkb'
+                    '    FROM trip t JOIN route r ON r.id = t.route_id'
+                    '    WHERE r.feed_id = %s AND t.geometry IS NOT NULL' +
+                    id_sql +
+                    '    GROUP BY t.route_id, ST_AsEWKB(t.geometry)'
+                    '  ) u GROUP BY u.route_id'
+                    ' ) g ON g.route_id = r.id'
+                    ' WHERE r.feed_id = %s' + id_sql,
+                    ['SRID=4326;MULTILINESTRING EMPTY', feed.id] + id_params +
+                    [feed.id] + id_params)
+                continue
+
+            current = dict(cls.objects.filter(
+                id__in=chunk).values_list('id', 'geometry'))
+            lines = dict((route_id, []) for route_id in current)
+            seen = set()
+            trips = Trip.objects.filter(route_id__in=chunk).exclude(
+                geometry=None).order_by('route_id', 'id').values_list(
+                'route_id', 'geometry')
+            for route_id, geometry in trips.iterator():
+                if (route_id, geometry.coords) not in seen:
+                    seen.add((route_id, geometry.coords))
+                    lines[route_id].append(geometry)
+            geometries = dict(
+                (route_id, MultiLineString(route_lines, srid=4326))
+                for route_id, route_lines in lines.items())
+            changed += cls._save_changed_geometries(current, geometries)
+        return changed
 
     def __str__(self):
         return "%d-%s" % (self.feed.id, self.route_id)
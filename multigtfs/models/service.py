@@ -81,8 +81,8 @@ class Service(Base):
     _unique_fields = ('service_id',)
 
     @classmethod
-    def export_txt(cls, feed):
-        '''Export records as calendar.txt'''
+    def export_objects(cls, feed):
+        '''Get the records to export as calendar.txt'''
 
         # If no records with start/end dates, skip calendar.txt
         objects = cls.objects.in_feed(feed)
@@ -91,4 +91,4 @@ class Service(Base):
                 start_date__isnull=True, end_date__isnull=True).exists():
             return None
 
-        return super(Service, cls).export_txt(feed)
+        return objects
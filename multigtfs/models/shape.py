@@ -13,15 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import unicode_literals
+from itertools import groupby
+from logging import getLogger
+from operator import itemgetter
+import time
 import warnings
 
 from django.contrib.gis.geos import LineString
+from django.db import connection
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from jsonfield import JSONField
 
-from multigtfs.models.base import models, Base
+from multigtfs.geometries import current_batch
+from multigtfs.models.base import models, Base, default_batch_size
+
+logger = getLogger(__name__)
 
 
 @python_2_unicode_compatible
@@ -36,6 +44,9 @@ class Shape(Base):
     geometry = models.LineStringField(
         null=True, blank=True,
         help_text='Geometry cache of ShapePoints')
+    geometry_dirty = models.BooleanField(
+        default=False, db_index=True,
+        help_text='Is the geometry cache out of date?')
 
     def __str__(self):
         return "%d-%s" % (self.feed.id, self.shape_id)
@@ -47,11 +58,45 @@ class Shape(Base):
             'sequence').values_list('point', flat=True)
         if len(points) > 1:
             self.geometry = LineString([pt.coords for pt in points])
-            if self.geometry != original:
-                self.save()
-                if update_parent:
-                    for trip in self.trip_set.all():
-                        trip.update_geometry()
+        if self._save_geometry(self.geometry != original) and update_parent:
+            for trip in self.trip_set.all():
+                trip.update_geometry()
+
+    @classmethod
+    def update_geometries(cls, feed, ids=None):
+        """Update the geometries of shapes from their points
+
+        Keyword arguments:
+        feed - The Feed of the shapes
+        ids - If set, only update the shapes with these IDs
+
+        Returns the number of shapes changed
+        """
+        changed = 0
+        for chunk in cls._geometry_chunks(feed, ids):
+            cls._clear_geometry_dirty(feed, chunk)
+            if getattr(connection.ops, 'postgis', False):
+                id_sql, id_params = cls._id_filter('sp.shape_id', chunk)
+                changed += cls._update_geometries_sql(
+                    'SELECT sp.shape_id,'
+                    ' ST_MakeLine(sp.point ORDER BY sp.sequence)'
+                    ' FROM shape_point sp JOIN shape s ON s.id = sp.shape_id'
+                    ' WHERE s.feed_id = %s' + id_sql +
+                    ' GROUP BY sp.shape_id HAVING COUNT(*) > 1',
+                    [feed.id] + id_params)
+                continue
+
+            current = dict(cls.objects.filter(
+                id__in=chunk).values_list('id', 'geometry'))
+            points = ShapePoint.objects.filter(shape_id__in=chunk).order_by(
+                'shape_id', 'sequence').values_list('shape_id', 'point')
+            geometries = {}
+            for shape_id, rows in groupby(points.iterator(), itemgetter(0)):
+                coords = [point.coords for _, point in rows]
+                if len(coords) > 1:
+                    geometries[shape_id] = LineString(coords, srid=4326)
+            changed += cls._save_changed_geometries(current, geometries)
+        return changed
 
     class Meta:
         db_table = 'shape'
@@ -60,6 +105,70 @@ class Shape(Base):
     _rel_to_feed = 'feed'
 
 
+class ShapeGeometries(object):
+    """Build shape geometries from the points as they are imported
+
+    Most feeds sort shapes.txt by shape and sequence, so a shape's
+    LineString is complete when the points of the next shape start.  The
+    points of one shape are sorted by sequence, so only shapes with points
+    split across the file are read back from the database at the end.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.shape_id = None
+        self.points = []
+        self.finished = set()
+        self.split = set()
+        self.geometries = {}
+
+    def add_rows(self, rows):
+        """Add a batch of saved ShapePoint rows"""
+        for fields in rows:
+            shape_id = fields['shape_id']
+            if shape_id != self.shape_id:
+                self.finish_shape()
+                if shape_id in self.finished:
+                    self.split.add(shape_id)
+                self.shape_id = shape_id
+            lon, lat = fields['point'][len('POINT('):-1].split()
+            self.points.append(
+                (int(fields['sequence']), (float(lon), float(lat))))
+        if len(self.geometries) >= default_batch_size():
+            Shape.save_geometries(self.geometries)
+            self.geometries = {}
+
+    def finish_shape(self):
+        """Build the geometry of the current shape"""
+        if self.shape_id is not None:
+            self.finished.add(self.shape_id)
+            if len(self.points) > 1 and self.shape_id not in self.split:
+                # Sort by sequence, keeping the first of duplicates
+                self.points.sort(key=lambda point: point[0])
+                coords = [
+                    point[1] for i, point in enumerate(self.points)
+                    if i == 0 or point[0] != self.points[i - 1][0]]
+                if len(coords) > 1:
+                    self.geometries[self.shape_id] = LineString(
+                        coords, srid=4326)
+        self.shape_id = None
+        self.points = []
+
+    def save(self):
+        """Save the geometries, reading the split shapes from the database
+
+        Returns the number of shapes updated
+        """
+        self.finish_shape()
+        for shape_id in self.split:
+            self.geometries.pop(shape_id, None)
+        Shape.save_geometries(self.geometries)
+        if self.split:
+            Shape.update_geometries(self.feed, self.split)
+        self.geometries = {}
+        return len(self.finished)
+
+
 @python_2_unicode_compatible
 class ShapePoint(Base):
     """A point along the shape"""
@@ -114,6 +223,37 @@ class ShapePoint(Base):
 
         super(ShapePoint, self).__init__(*args, **kwargs)
 
+    @classmethod
+    def import_txt(cls, txt_file, feed, *args, **kwargs):
+        """Import shapes.txt, and update the shape geometries
+
+        The geometries are built from the points as they are read.  If an
+        earlier import of the file is resumed, the geometries of all the
+        shapes in the feed are updated from the database instead.
+        """
+        progress = feed.meta.get('import_progress', {}).get(
+            kwargs.get('checkpoint'), {})
+        shapes = ShapeGeometries(feed)
+        kwargs['on_save'] = shapes.add_rows
+        count = super(ShapePoint, cls).import_txt(
+            txt_file, feed, *args, **kwargs)
+        if count is None:
+            return None
+        start_time = time.time()
+        if progress.get('line'):
+            updated = Shape.update_geometries(feed)
+        else:
+            updated = shapes.save()
+        logger.info(
+            "Updated geometries for %d shapes in %0.1f seconds",
+            updated, time.time() - start_time)
+        return count
+
+    def delete(self, *args, **kwargs):
+        """Delete the ShapePoint, and mark the Shape geometry out of date"""
+        Shape.objects.filter(id=self.shape_id).update(geometry_dirty=True)
+        return super(ShapePoint, self).delete(*args, **kwargs)
+
     class Meta:
         db_table = 'shape_point'
         app_label = 'multigtfs'
@@ -131,7 +271,17 @@ class ShapePoint(Base):
     _unique_fields = ('shape_id', 'shape_pt_sequence')
 
 
+@receiver(post_save, sender=ShapePoint, dispatch_uid="mark_shapepoint_saved")
+def mark_shapepoint_saved(sender, instance, **kwargs):
+    '''Mark the geometry of the ShapePoint's Shape as out of date'''
+    Shape.objects.filter(id=instance.shape_id).update(geometry_dirty=True)
+
+
 @receiver(post_save, sender=ShapePoint, dispatch_uid="post_save_shapepoint")
 def post_save_shapepoint(sender, instance, **kwargs):
     '''Update related objects when the ShapePoint is updated'''
-    instance.shape.update_geometry()
+    batch = current_batch()
+    if batch is not None:
+        batch.shape_ids.add(instance.shape_id)
+    else:
+        instance.shape.update_geometry()
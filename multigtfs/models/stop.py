@@ -13,21 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import unicode_literals
-from logging import getLogger
 import warnings
 
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
-from django.utils.six import StringIO
 from jsonfield import JSONField
 
+from multigtfs.geometries import current_batch
 from multigtfs.models.base import models, Base
 
 
-logger = getLogger(__name__)
-
-
 @python_2_unicode_compatible
 class Stop(Base):
     """A stop or station
@@ -129,42 +125,23 @@ class Stop(Base):
     _filename = 'stops.txt'
     _unique_fields = ('stop_id',)
 
-    @classmethod
-    def import_txt(cls, txt_file, feed):
-        '''Import from a stops.txt file
-
-        Stations need to be imported before stops
-        '''
-
-        txt = txt_file.read()
-
-        def is_station(pairs):
-            '''Does the row represent a station?'''
-            for name, val in pairs:
-                if name == 'location_type':
-                    return val == '1'
-            return False
 
-        logger.info("Importing station stops")
-        stations = super(Stop, cls).import_txt(StringIO(txt), feed, is_station)
-        logger.info("Imported %d station stops", stations)
-
-        def is_stop(pairs):
-            '''Does the row represent a stop?'''
-            for name, val in pairs:
-                if name == 'location_type':
-                    return val != '1'
-            return True
-
-        logger.info("Importing non-station stops")
-        stops = super(Stop, cls).import_txt(StringIO(txt), feed, is_stop)
-        logger.info("Imported %d non-station stops", stops)
-        return stations + stops
+@receiver(post_save, sender=Stop, dispatch_uid="mark_stop_saved")
+def mark_stop_saved(sender, instance, **kwargs):
+    '''Mark the geometries of Trips without a Shape as out of date'''
+    from multigtfs.models.trip import Trip
+    trip_ids = instance.stoptime_set.filter(
+        trip__shape=None).values_list('trip_id', flat=True)
+    Trip.objects.filter(id__in=trip_ids).update(geometry_dirty=True)
 
 
 @receiver(post_save, sender=Stop, dispatch_uid="post_save_stop")
 def post_save_stop(sender, instance, **kwargs):
     '''Update related objects when the Stop is updated'''
+    batch = current_batch()
+    if batch is not None:
+        batch.stop_ids.add(instance.id)
+        return
     from multigtfs.models.trip import Trip
     trip_ids = instance.stoptime_set.filter(
         trip__shape=None).values_list('trip_id', flat=True).distinct()
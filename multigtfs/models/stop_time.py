@@ -14,6 +14,8 @@
 # limitations under the License.
 from __future__ import unicode_literals
 
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from jsonfield import JSONField
 
@@ -64,6 +66,11 @@ class StopTime(Base):
     def __str__(self):
         return "%s-%s-%s" % (self.trip, self.stop.stop_id, self.stop_sequence)
 
+    def delete(self, *args, **kwargs):
+        """Delete the StopTime, and mark the Trip geometry out of date"""
+        Trip.objects.filter(id=self.trip_id).update(geometry_dirty=True)
+        return super(StopTime, self).delete(*args, **kwargs)
+
     class Meta:
         db_table = 'stop_time'
         app_label = 'multigtfs'
@@ -83,3 +90,9 @@ class StopTime(Base):
     _rel_to_feed = 'trip__route__feed'
     _sort_order = ('trip__trip_id', 'stop_sequence')
     _unique_fields = ('trip_id', 'stop_sequence')
+
+
+@receiver(post_save, sender=StopTime, dispatch_uid="mark_stoptime_saved")
+def mark_stoptime_saved(sender, instance, **kwargs):
+    '''Mark the geometry of the StopTime's Trip as out of date'''
+    Trip.objects.filter(id=instance.trip_id).update(geometry_dirty=True)
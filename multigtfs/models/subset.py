@@ -0,0 +1,183 @@
+#
+# Copyright 2012-2014 John Whitlock
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import unicode_literals
+
+from django.contrib.gis.geos import GEOSGeometry, Polygon
+from django.db.models import Q
+
+from .agency import Agency
+from .fare import Fare
+from .fare_rule import FareRule
+from .frequency import Frequency
+from .route import Route
+from .service import Service
+from .service_date import ServiceDate
+from .shape import ShapePoint
+from .stop import Stop
+from .stop_time import StopTime
+from .transfer import Transfer
+from .trip import Trip
+
+
+class FeedSubset(object):
+    """A closed subset of a feed, selected by routes, dates or area
+
+    Keyword arguments:
+    route_ids - If set, only the routes with these GTFS route_ids
+    agency_ids - If set, only the routes of the agencies with these GTFS
+        agency_ids
+    start_date, end_date - If set, only the trips with service in this
+        window, including the end dates.  Calendar dates outside the window
+        are dropped, but calendar.txt date ranges are unchanged.
+    bbox - If set, only the trips that stop inside this area, a Polygon or
+        a (min lon, min lat, max lon, max lat) tuple
+
+    The selected trips are followed to their routes and agencies, services
+    and calendar dates, shapes, frequencies, stop times, and stops and
+    their parent stations.  Transfers between the stops are kept, as are
+    fare rules for the routes and the zones of the stops, and their fares.
+
+    Each model's records are selected by a query with subqueries, so the
+    database finds the subset without loading the trips.
+    """
+
+    def __init__(
+            self, route_ids=None, agency_ids=None, start_date=None,
+            end_date=None, bbox=None):
+        self.route_ids = route_ids
+        self.agency_ids = agency_ids
+        self.start_date = start_date
+        self.end_date = end_date
+        if bbox is not None and not isinstance(bbox, GEOSGeometry):
+            bbox = Polygon.from_bbox(bbox)
+        if bbox is not None and not bbox.srid:
+            bbox.srid = 4326
+        self.bbox = bbox
+
+    def filter(self, klass, feed, objects):
+        """Limit a model's records in the feed to the subset"""
+        selected = {
+            Agency: self.agencies,
+            Fare: self.fares,
+            FareRule: self.fare_rules,
+            Frequency: self.frequencies,
+            Route: self.routes,
+            Service: self.services,
+            ServiceDate: self.service_dates,
+            ShapePoint: self.shape_points,
+            Stop: self.stops,
+            StopTime: self.stop_times,
+            Transfer: self.transfers,
+            Trip: self.trips,
+        }.get(klass)
+        if selected is None:
+            return objects
+        return objects.filter(id__in=selected(feed).values('id'))
+
+    def trips(self, feed):
+        """Get the selected trips, which the other records follow"""
+        routes = Route.objects.in_feed(feed)
+        if self.route_ids is not None:
+            routes = routes.filter(route_id__in=self.route_ids)
+        if self.agency_ids is not None:
+            routes = routes.filter(agency__agency_id__in=self.agency_ids)
+        trips = Trip.objects.filter(route__in=routes.values('id'))
+
+        if self.start_date is not None or self.end_date is not None:
+            # Running on the calendar, or on an added date in the window
+            in_calendar = Q()
+            added = ServiceDate.objects.in_feed(feed).filter(
+                exception_type=1)
+            if self.start_date is not None:
+                in_calendar &= Q(end_date__gte=self.start_date)
+                added = added.filter(date__gte=self.start_date)
+            if self.end_date is not None:
+                in_calendar &= Q(start_date__lte=self.end_date)
+                added = added.filter(date__lte=self.end_date)
+            services = Service.objects.in_feed(feed).filter(
+                in_calendar | Q(id__in=added.values('service')))
+            trips = trips.filter(service__in=services.values('id'))
+
+        if self.bbox is not None:
+            stops = Stop.objects.in_feed(feed).filter(
+                point__within=self.bbox)
+            trips = trips.filter(id__in=StopTime.objects.filter(
+                stop__in=stops.values('id')).values('trip'))
+        return trips
+
+    def routes(self, feed):
+        return Route.objects.in_feed(feed).filter(
+            id__in=self.trips(feed).values('route'))
+
+    def agencies(self, feed):
+        agencies = Agency.objects.in_feed(feed)
+        routes = self.routes(feed)
+        if routes.filter(agency=None).exists():
+            # Routes without an agency_id are run by the only agency
+            return agencies
+        return agencies.filter(id__in=routes.values('agency'))
+
+    def services(self, feed):
+        return Service.objects.in_feed(feed).filter(
+            id__in=self.trips(feed).values('service'))
+
+    def service_dates(self, feed):
+        service_dates = ServiceDate.objects.in_feed(feed).filter(
+            service__in=self.services(feed).values('id'))
+        if self.start_date is not None:
+            service_dates = service_dates.filter(date__gte=self.start_date)
+        if self.end_date is not None:
+            service_dates = service_dates.filter(date__lte=self.end_date)
+        return service_dates
+
+    def shape_points(self, feed):
+        return ShapePoint.objects.filter(
+            shape__in=self.trips(feed).values('shape'))
+
+    def frequencies(self, feed):
+        return Frequency.objects.filter(
+            trip__in=self.trips(feed).values('id'))
+
+    def stop_times(self, feed):
+        return StopTime.objects.filter(
+            trip__in=self.trips(feed).values('id'))
+
+    def stops(self, feed):
+        visited = Stop.objects.in_feed(feed).filter(
+            id__in=self.stop_times(feed).values('stop'))
+        return Stop.objects.in_feed(feed).filter(
+            Q(id__in=visited.values('id')) |
+            Q(id__in=visited.values('parent_station')))
+
+    def transfers(self, feed):
+        stops = self.stops(feed).values('id')
+        return Transfer.objects.in_feed(feed).filter(
+            from_stop__in=stops, to_stop__in=stops)
+
+    def fare_rules(self, feed):
+        zones = self.stops(feed).values('zone')
+        rules = FareRule.objects.in_feed(feed).filter(
+            Q(route=None) | Q(route__in=self.routes(feed).values('id')))
+        for name in ('origin', 'destination', 'contains'):
+            rules = rules.filter(
+                Q(**{name: None}) | Q(**{name + '__in': zones}))
+        return rules
+
+    def fares(self, feed):
+        # Fares without rules apply to the whole feed
+        all_rules = FareRule.objects.in_feed(feed)
+        return Fare.objects.in_feed(feed).filter(
+            Q(id__in=self.fare_rules(feed).values('fare')) |
+            ~Q(id__in=all_rules.values('fare')))
@@ -13,8 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from __future__ import unicode_literals
+from itertools import groupby
+from operator import itemgetter
 
 from django.contrib.gis.geos import LineString
+from django.db import connection
 from django.utils.encoding import python_2_unicode_compatible
 from jsonfield import JSONField
 
@@ -53,6 +56,9 @@ class Trip(Base):
     geometry = models.LineStringField(
         null=True, blank=True,
         help_text='Geometry cache of Shape or Stops')
+    geometry_dirty = models.BooleanField(
+        default=False, db_index=True,
+        help_text='Is the geometry cache out of date?')
     wheelchair_accessible = models.CharField(
         max_length=1, blank=True,
         choices=(
@@ -79,10 +85,69 @@ class Trip(Base):
             if stoptimes.count() > 1:
                 self.geometry = LineString(
                     [st.stop.point.coords for st in stoptimes])
-        if self.geometry != original:
-            self.save()
-            if update_parent:
-                self.route.update_geometry()
+        if self._save_geometry(self.geometry != original) and update_parent:
+            self.route.update_geometry()
+
+    @classmethod
+    def update_geometries(cls, feed, ids=None):
+        """Update the geometries of trips from their Shapes or Stops
+
+        This is the same as update_geometry(update_parent=False) for each
+        trip.  With PostGIS, the lines are built in the database.
+
+        Keyword arguments:
+        feed - The Feed of the trips
+        ids - If set, only update the trips with these IDs
+
+        Returns the number of trips changed
+        """
+        from multigtfs.models.stop_time import StopTime
+        changed = 0
+        for chunk in cls._geometry_chunks(feed, ids):
+            cls._clear_geometry_dirty(feed, chunk)
+            if getattr(connection.ops, 'postgis', False):
+                id_sql, id_params = cls._id_filter('t.id', chunk)
+                changed += cls._update_geometries_sql(
+                    'SELECT t.id, s.geometry FROM trip t'
+                    ' JOIN route r ON r.id = t.route_id'
+                    ' JOIN shape s ON s.id = t.shape_id'
+                    ' WHERE r.feed_id = %s' + id_sql +
+                    ' UNION ALL'
+                    ' SELECT t.id,'
+                    ' ST_MakeLine(stop.point ORDER BY st.stop_sequence)'
+                    ' FROM trip t JOIN route r ON r.id = t.route_id'
+                    ' JOIN stop_time st ON st.trip_id = t.id'
+                    ' JOIN stop ON stop.id = st.stop_id'
+                    ' WHERE r.feed_id = %s AND t.shape_id IS NULL' + id_sql +
+                    ' GROUP BY t.id HAVING COUNT(*) > 1',
+                    [feed.id] + id_params + [feed.id] + id_params)
+                continue
+
+            current = {}
+            geometries = {}
+            trips = cls.objects.filter(id__in=chunk).values_list(
+                'id', 'geometry', 'shape_id', 'shape__geometry')
+            for trip_id, geometry, shape_id, shape_geometry in trips:
+                current[trip_id] = geometry
+                if shape_id:
+                    geometries[trip_id] = shape_geometry
+            stop_times = StopTime.objects.filter(
+                trip_id__in=chunk, trip__shape=None).order_by(
+                'trip_id', 'stop_sequence').values_list(
+                'trip_id', 'stop__point')
+            for trip_id, rows in groupby(
+                    stop_times.iterator(), itemgetter(0)):
+                coords = [point.coords for _, point in rows]
+                if len(coords) > 1:
+                    geometries[trip_id] = LineString(coords, srid=4326)
+            changed += cls._save_changed_geometries(current, geometries)
+        return changed
+
+    def delete(self, *args, **kwargs):
+        """Delete the Trip, and mark the Route geometry out of date"""
+        from multigtfs.models.route import Route
+        Route.objects.filter(id=self.route_id).update(geometry_dirty=True)
+        return super(Trip, self).delete(*args, **kwargs)
 
     def __str__(self):
         return "%s-%s" % (self.route, self.trip_id)
@@ -0,0 +1,154 @@
+#
+# Copyright 2012-2014 John Whitlock
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Signals sent while importing a GTFS feed
+
+The sender of the file and batch signals is the model class being imported,
+and the sender of the others is the Feed class.  Every signal has a feed
+argument, the Feed being imported.  Timings are in seconds, and rates only
+count the rows loaded since the import started or resumed.  peak_memory
+is the peak resident memory of the process in kilobytes, or None if it
+can't be measured.  Signals may be sent from import threads (see the jobs
+argument of Feed.import_gtfs).
+"""
+from __future__ import unicode_literals
+import sys
+import threading
+
+from django.dispatch import Signal
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+import_started = Signal(providing_args=['feed'])
+file_started = Signal(providing_args=['feed', 'filename'])
+batch_flushed = Signal(providing_args=[
+    'feed', 'filename', 'rows', 'total_rows', 'elapsed', 'rows_per_second'])
+file_finished = Signal(providing_args=[
+    'feed', 'filename', 'rows', 'elapsed', 'rows_per_second',
+    'peak_memory'])
+geometry_stage_finished = Signal(providing_args=[
+    'feed', 'stage', 'rows', 'elapsed', 'rows_per_second', 'peak_memory'])
+import_finished = Signal(providing_args=[
+    'feed', 'elapsed', 'peak_memory'])
+
+
+def peak_memory():
+    '''Get the peak resident memory of the process in kilobytes'''
+    if resource is None:  # pragma: no cover
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # pragma: no cover
+        usage //= 1024  # Reported in bytes
+    return usage
+
+
+def rows_per_second(rows, elapsed):
+    '''Get the rate of a stage, or None if it took no measurable time'''
+    if elapsed > 0:
+        return rows / elapsed
+    return None
+
+
+class ImportReport(object):
+    '''Collect the import signals of a feed into a report
+
+    Use as a context manager around Feed.import_gtfs, then call as_dict()
+    to get a report that can be serialized as JSON.
+
+    Keyword arguments:
+    feed - The Feed to report on.  If not set, the first feed whose import
+        starts in the block is reported.  The signals of other feeds, such
+        as an import running at the same time in another thread, are
+        ignored.
+    '''
+
+    def __init__(self, feed=None):
+        self.lock = threading.Lock()
+        self.files = []
+        self.geometries = []
+        self.feed_id = None if feed is None else feed.id
+        self.elapsed = None
+        self.peak_memory = None
+
+    def __enter__(self):
+        import_started.connect(self.on_import_started)
+        file_finished.connect(self.on_file_finished)
+        geometry_stage_finished.connect(self.on_geometry_stage_finished)
+        import_finished.connect(self.on_import_finished)
+        return self
+
+    def __exit__(self, *exc_info):
+        import_started.disconnect(self.on_import_started)
+        file_finished.disconnect(self.on_file_finished)
+        geometry_stage_finished.disconnect(self.on_geometry_stage_finished)
+        import_finished.disconnect(self.on_import_finished)
+
+    def reports(self, feed):
+        '''Is the signal about the reported feed?'''
+        with self.lock:
+            return feed.id == self.feed_id
+
+    def on_import_started(self, sender, feed, **kwargs):
+        with self.lock:
+            if self.feed_id is None:
+                self.feed_id = feed.id
+
+    def on_file_finished(self, sender, feed, filename, rows, elapsed,
+                         rows_per_second, peak_memory, **kwargs):
+        if not self.reports(feed):
+            return
+        with self.lock:
+            self.files.append({
+                'model': sender.__name__,
+                'filename': filename,
+                'rows': rows,
+                'elapsed': elapsed,
+                'rows_per_second': rows_per_second,
+                'peak_memory': peak_memory,
+            })
+
+    def on_geometry_stage_finished(
+            self, sender, feed, stage, rows, elapsed, rows_per_second,
+            peak_memory, **kwargs):
+        if not self.reports(feed):
+            return
+        with self.lock:
+            self.geometries.append({
+                'stage': stage,
+                'rows': rows,
+                'elapsed': elapsed,
+                'rows_per_second': rows_per_second,
+                'peak_memory': peak_memory,
+            })
+
+    def on_import_finished(self, sender, feed, elapsed, peak_memory,
+                           **kwargs):
+        if not self.reports(feed):
+            return
+        self.elapsed = elapsed
+        self.peak_memory = peak_memory
+
+    def as_dict(self):
+        '''Get the report as a dictionary'''
+        return {
+            'feed': self.feed_id,
+            'elapsed': self.elapsed,
+            'peak_memory': self.peak_memory,
+            'rows': sum(f['rows'] for f in self.files),
+            'files': self.files,
+            'geometries': self.geometries,
+        }
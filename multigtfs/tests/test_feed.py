@@ -15,18 +15,27 @@
 
 from __future__ import unicode_literals
 
+from unittest import skipIf, skipUnless
 import os
 import shutil
 import tempfile
+import threading
+import time
 import zipfile
 
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
 from django.utils.six import text_type
 
+from multigtfs.columnar import pyarrow
+from multigtfs.export_cache import ExportCache
 from multigtfs.models import (
     Agency, Block, Fare, FareRule, Feed, FeedInfo, Frequency,
     Route, Service, ServiceDate, Shape, ShapePoint, Stop, StopTime, Transfer,
     Trip, Zone)
+from multigtfs.models.feed import import_dependencies
+from multigtfs.models.subset import FeedSubset
+from multigtfs.signals import ImportReport, batch_flushed, file_started
 
 my_dir = os.path.dirname(__file__)
 fixtures_dir = os.path.join(my_dir, 'fixtures')
@@ -58,6 +67,18 @@ class FeedTest(TestCase):
         feed.name = 'Test'
         self.assertEqual(str(feed), '%d Test' % feed.id)
 
+    def test_save_keeps_version(self):
+        feed = Feed(pk=123, name='New')
+        feed.save()
+        feed.bump_version()
+        stale = Feed.objects.get(pk=123)
+        stale.version = 0
+        stale.name = 'Renamed'
+        stale.save()
+        feed = Feed.objects.get(pk=123)
+        self.assertEqual(feed.name, 'Renamed')
+        self.assertEqual(feed.version, 1)
+
     def test_import_gtfs_test1(self, gtfs_obj=None):
         '''Try importing test1.zip
 
@@ -113,6 +134,255 @@ class FeedTest(TestCase):
         z.extractall(self.temp_dir)
         self.test_import_gtfs_test1(self.temp_dir)
 
+    def test_import_gtfs_test1_jobs(self):
+        '''A parallel import inside a transaction falls back to one job'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path, jobs=4)
+        self.assertEqual(Stop.objects.count(), 9)
+        self.assertEqual(StopTime.objects.count(), 28)
+        self.assertEqual(Trip.objects.count(), 11)
+
+    def test_import_gtfs_test1_atomic_batch_size(self):
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(
+            test_path, atomic='feed',
+            batch_size={'StopTime': 5, 'stops.txt': 2, None: 3})
+        self.assertEqual(Stop.objects.count(), 9)
+        self.assertEqual(StopTime.objects.count(), 28)
+        self.assertEqual(Trip.objects.count(), 11)
+        self.assertTrue(Trip.objects.exclude(geometry=None).exists())
+
+    def test_import_gtfs_test1_signals(self):
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        batches = []
+
+        def on_batch_flushed(sender, **kwargs):
+            batches.append((sender, kwargs['rows'], kwargs['total_rows']))
+
+        batch_flushed.connect(on_batch_flushed)
+        try:
+            with ImportReport() as report:
+                feed.import_gtfs(test_path, batch_size={'StopTime': 20})
+        finally:
+            batch_flushed.disconnect(on_batch_flushed)
+        self.assertEqual(
+            [b for b in batches if b[0] == StopTime],
+            [(StopTime, 20, 20), (StopTime, 8, 28)])
+        result = report.as_dict()
+        self.assertEqual(result['feed'], feed.id)
+        files = dict((f['model'], f) for f in result['files'])
+        self.assertEqual(files['StopTime']['rows'], 28)
+        self.assertEqual(files['StopTime']['filename'], 'dv/stop_times.txt')
+        self.assertEqual(
+            [g['stage'] for g in result['geometries']],
+            ['trips', 'routes'])
+        self.assertEqual(
+            result['geometries'][0]['rows'],
+            Trip.objects.exclude(geometry=None).count())
+
+    def test_import_report_other_feed(self):
+        '''A report ignores the imports of other feeds'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        other = Feed.objects.create()
+        feed = Feed.objects.create()
+        with ImportReport(other) as report:
+            feed.import_gtfs(test_path)
+        result = report.as_dict()
+        self.assertEqual(result['feed'], other.id)
+        self.assertIsNone(result['elapsed'])
+        self.assertEqual(result['files'], [])
+        self.assertEqual(result['geometries'], [])
+
+    def test_import_gtfs_test1_defer_indexes(self):
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        table = StopTime._meta.db_table
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, table)
+        feed.import_gtfs(test_path, defer_indexes=True)
+        self.assertEqual(StopTime.objects.count(), 28)
+        self.assertTrue(Trip.objects.exclude(geometry=None).exists())
+        with connection.cursor() as cursor:
+            rebuilt = connection.introspection.get_constraints(cursor, table)
+        self.assertEqual(sorted(rebuilt), sorted(indexes))
+
+    def test_update_gtfs_test1(self):
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        stop_time_ids = set(StopTime.objects.values_list('id', flat=True))
+        changes = feed.update_gtfs(test_path)
+        for filename, change in changes.items():
+            self.assertEqual(change['inserted'], set(), filename)
+            self.assertEqual(change['updated'], set(), filename)
+            self.assertEqual(change['deleted'], 0, filename)
+        self.assertEqual(changes['stop_times.txt']['unchanged'], 28)
+        self.assertEqual(
+            set(StopTime.objects.values_list('id', flat=True)),
+            stop_time_ids)
+
+    def write_calendar_dates_feed(self, trips):
+        '''Write a feed with services only in calendar_dates.txt'''
+        if not self.temp_dir:
+            self.temp_dir = tempfile.mkdtemp()
+        files = {
+            'agency.txt': '''\
+agency_id,agency_name,agency_url,agency_timezone
+DTA,Demo Transit Authority,http://google.com,America/Los_Angeles
+''',
+            'stops.txt': '''\
+stop_id,stop_name,stop_lat,stop_lon
+BEATTY_AIRPORT,Nye County Airport,36.868446,-116.784582
+BULLFROG,Bullfrog,36.88108,-116.81797
+''',
+            'routes.txt': '''\
+route_id,agency_id,route_short_name,route_long_name,route_type
+AB,DTA,10,Airport - Bullfrog,3
+BFC,DTA,20,Bullfrog - Furnace Creek Resort,3
+''',
+            'calendar_dates.txt': '''\
+service_id,date,exception_type
+WE,20070602,1
+WE,20070603,1
+HOL,20070704,1
+''',
+            'trips.txt': 'route_id,service_id,trip_id\n' + trips,
+        }
+        for name, content in files.items():
+            with open(os.path.join(self.temp_dir, name), 'w') as txt_file:
+                txt_file.write(content)
+        return self.temp_dir
+
+    def test_update_gtfs_calendar_dates_only(self):
+        '''Services only in calendar_dates.txt are kept by an update'''
+        path = self.write_calendar_dates_feed('AB,WE,AB1\nBFC,HOL,BFC1\n')
+        feed = Feed.objects.create()
+        feed.import_gtfs(path)
+        service_ids = dict(
+            Service.objects.values_list('service_id', 'id'))
+        self.assertEqual(sorted(service_ids), ['HOL', 'WE'])
+        trip_services = dict(Trip.objects.values_list('trip_id', 'service'))
+
+        changes = feed.update_gtfs(path)
+        for filename, change in changes.items():
+            self.assertEqual(change['inserted'], set(), filename)
+            self.assertEqual(change['updated'], set(), filename)
+            self.assertEqual(change['deleted'], 0, filename)
+        self.assertEqual(
+            dict(Service.objects.values_list('service_id', 'id')),
+            service_ids)
+        self.assertEqual(ServiceDate.objects.count(), 3)
+        self.assertEqual(
+            dict(Trip.objects.values_list('trip_id', 'service')),
+            trip_services)
+
+    def test_update_gtfs_unreferenced(self):
+        '''Records missing from a file are deleted once nothing uses them'''
+        path = self.write_calendar_dates_feed('AB,WE,AB1\nBFC,HOL,BFC1\n')
+        feed = Feed.objects.create()
+        feed.import_gtfs(path)
+        with open(os.path.join(path, 'routes.txt'), 'w') as txt_file:
+            txt_file.write('''\
+route_id,agency_id,route_short_name,route_long_name,route_type
+AB,DTA,10,Airport - Bullfrog,3
+''')
+        with open(os.path.join(path, 'calendar_dates.txt'), 'w') as txt_file:
+            txt_file.write('''\
+service_id,date,exception_type
+WE,20070602,1
+WE,20070603,1
+''')
+        with open(os.path.join(path, 'trips.txt'), 'w') as txt_file:
+            txt_file.write('route_id,service_id,trip_id\nAB,WE,AB1\n')
+
+        changes = feed.update_gtfs(path)
+        self.assertEqual(changes['routes.txt']['deleted'], 1)
+        self.assertEqual(changes['trips.txt']['deleted'], 1)
+        self.assertEqual(changes['calendar.txt']['deleted'], 1)
+        self.assertEqual(
+            list(Route.objects.values_list('route_id', flat=True)), ['AB'])
+        self.assertEqual(
+            list(Service.objects.values_list('service_id', flat=True)),
+            ['WE'])
+
+    def test_import_dependencies(self):
+        gtfs_order = (
+            Agency, Stop, Route, Service, ServiceDate, ShapePoint, Trip,
+            StopTime, Frequency, Fare, FareRule, Transfer, FeedInfo,
+        )
+        depends = import_dependencies(gtfs_order)
+        self.assertEqual(depends[Agency], set())
+        self.assertEqual(depends[Stop], set())
+        self.assertEqual(depends[Route], set([Agency]))
+        self.assertEqual(depends[Service], set())
+        self.assertEqual(depends[ServiceDate], set([Service]))
+        self.assertEqual(depends[ShapePoint], set())
+        # Trip follows ServiceDate and ShapePoint, since they all create
+        # Services and Shapes
+        self.assertEqual(
+            depends[Trip], set([Route, Service, ServiceDate, ShapePoint]))
+        self.assertEqual(depends[StopTime], set([Stop, Trip]))
+        # Frequency follows StopTime, since both create Trips
+        self.assertEqual(depends[Frequency], set([StopTime, Trip]))
+        self.assertEqual(depends[Fare], set())
+        # FareRule follows Stop and Trip, since they create Zones and Routes
+        self.assertEqual(depends[FareRule], set([Fare, Route, Stop, Trip]))
+        # Transfer follows StopTime, since both create Stops
+        self.assertEqual(depends[Transfer], set([Stop, StopTime]))
+        self.assertEqual(depends[FeedInfo], set())
+
+    def test_import_parallel_order(self):
+        '''Files start after the files they depend on, up to jobs at once'''
+        klass_files = [
+            ('agency', ['agency.txt']), ('stops', ['stops.txt']),
+            ('routes', ['routes.txt']), ('calendar', ['calendar.txt']),
+            ('trips', ['trips.txt']), ('stop_times', ['stop_times.txt'])]
+        depends = {
+            'agency': set(), 'stops': set(), 'routes': set(['agency']),
+            'calendar': set(), 'trips': set(['routes', 'calendar']),
+            'stop_times': set(['stops', 'trips'])}
+        events = []
+        running = set()
+        most_running = []
+        lock = threading.Lock()
+
+        def import_klass(klass, names):
+            with lock:
+                events.append(('start', klass))
+                running.add(klass)
+                most_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.discard(klass)
+                events.append(('finish', klass))
+
+        Feed()._import_parallel(klass_files, depends, import_klass, 2)
+        self.assertEqual(len(events), 12)
+        for klass, klass_depends in depends.items():
+            started = events.index(('start', klass))
+            for depend in klass_depends:
+                self.assertLess(events.index(('finish', depend)), started)
+        self.assertEqual(max(most_running), 2)
+
+    def test_import_parallel_error(self):
+        '''An error stops new files, and is raised once the others finish'''
+        klass_files = [('a', ['a.txt']), ('b', ['b.txt']), ('c', ['c.txt'])]
+        depends = {'a': set(), 'b': set(), 'c': set(['a', 'b'])}
+        imported = []
+
+        def import_klass(klass, names):
+            if klass == 'a':
+                raise ValueError('Bad file')
+            imported.append(klass)
+
+        self.assertRaises(
+            ValueError, Feed()._import_parallel, klass_files, depends,
+            import_klass, 2)
+        self.assertEqual(imported, ['b'])
+
     def test_import_gtfs_test2(self):
         '''Try importing test2.zip
 
@@ -404,6 +674,117 @@ CITY,W,CITY2,to Nowhere,1,45
 STBA,W,STBA,Shuttle,1,2
 """)
 
+    def test_export_gtfs_test1_copy(self):
+        '''COPY TO STDOUT is used on PostgreSQL, with the same output'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        file_id, self.temp_path = tempfile.mkstemp()
+        os.close(file_id)
+        feed.export_gtfs(self.temp_path)
+        with zipfile.ZipFile(self.temp_path, 'r') as z_out:
+            expected = dict(
+                (name, z_out.read(name)) for name in z_out.namelist())
+        feed.export_gtfs(self.temp_path, use_copy=True)
+        with zipfile.ZipFile(self.temp_path, 'r') as z_out:
+            actual = dict(
+                (name, z_out.read(name)) for name in z_out.namelist())
+        self.assertEqual(sorted(actual), sorted(expected))
+        for name in expected:
+            self.assertEqual(actual[name], expected[name], name)
+
+    def test_export_gtfs_test1_jobs(self):
+        '''Files are exported in parallel on PostgreSQL, in the same order'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        file_id, self.temp_path = tempfile.mkstemp()
+        os.close(file_id)
+        feed.export_gtfs(self.temp_path)
+        with zipfile.ZipFile(self.temp_path, 'r') as z_out:
+            expected = [
+                (name, z_out.read(name)) for name in z_out.namelist()]
+        feed.export_gtfs(self.temp_path, jobs=3)
+        with zipfile.ZipFile(self.temp_path, 'r') as z_out:
+            actual = [(name, z_out.read(name)) for name in z_out.namelist()]
+        self.assertEqual(actual, expected)
+
+    def test_export_gtfs_test1_cached(self):
+        '''The cached export is reused until the feed version changes'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        self.assertTrue(Feed.objects.get(id=feed.id).version)
+        self.temp_dir = tempfile.mkdtemp()
+        cache = ExportCache(self.temp_dir)
+        path = cache.get_path(feed)
+        self.assertEqual(cache.get_path(feed), path)
+
+        stop = Stop.objects.get(feed=feed, stop_id='FUR_CREEK_RES')
+        stop.name = 'Fur Creek Reservoir'
+        stop.save()
+        new_path = cache.get_path(feed)
+        self.assertNotEqual(new_path, path)
+        self.assertFalse(os.path.exists(path))
+        with zipfile.ZipFile(new_path, 'r') as z_out:
+            self.assertIn(b'Fur Creek Reservoir', z_out.read('stops.txt'))
+
+    @skipIf(pyarrow is None, 'pyarrow is not installed')
+    def test_export_parquet_test1(self):
+        '''A feed exported as Parquet imports with the same records'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        self.temp_dir = tempfile.mkdtemp()
+        feed.export_parquet(self.temp_dir)
+        self.assertIn('stop_times.parquet', os.listdir(self.temp_dir))
+        schema = pyarrow.parquet.read_schema(
+            os.path.join(self.temp_dir, 'stops.parquet'))
+        self.assertEqual(schema.field('stop_lat').type, pyarrow.float64())
+
+        new_feed = Feed.objects.create()
+        new_feed.import_parquet(self.temp_dir)
+        for klass in (Stop, StopTime, Trip, ShapePoint, Service, Frequency):
+            self.assertEqual(klass.export_txt(new_feed),
+                             klass.export_txt(feed), klass.__name__)
+
+    def test_export_gtfs_test1_subset(self):
+        '''A subset follows the trips of the routes to their records'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        file_id, self.temp_path = tempfile.mkstemp()
+        os.close(file_id)
+        feed.export_gtfs(self.temp_path, subset=FeedSubset(route_ids=['AB']))
+        with zipfile.ZipFile(self.temp_path, 'r') as z_out:
+            self.assertEqual(
+                z_out.namelist(),
+                ['agency.txt', 'calendar.txt', 'calendar_dates.txt',
+                 'routes.txt', 'stop_times.txt', 'stops.txt', 'trips.txt'])
+            self.assertEqual(self.normalize(z_out.read('routes.txt')), b'''\
+route_id,agency_id,route_short_name,route_long_name,route_type
+AB,DTA,10,Airport - Bullfrog,3
+''')
+            self.assertEqual(self.normalize(z_out.read('trips.txt')), b'''\
+route_id,service_id,trip_id,trip_headsign,direction_id,block_id
+AB,W,AB1,to Bullfrog,0,1
+AB,W,AB2,to Airport,1,2
+''')
+            stops = self.normalize(z_out.read('stops.txt')).splitlines()
+            self.assertEqual(
+                sorted(line.split(b',')[0] for line in stops[1:]),
+                [b'BEATTY_AIRPORT', b'BULLFROG'])
+            calendar = self.normalize(z_out.read('calendar.txt'))
+            self.assertEqual(calendar.splitlines()[1:], [
+                b'W,1,1,1,1,1,1,1,20070101,20101231'])
+
+        # Trips that stop at Amargosa Valley
+        subset = FeedSubset(bbox=(-116.5, 36.6, -116.3, 36.7))
+        trips = list(Trip.export_batches(feed, subset=subset))[1]
+        self.assertEqual(
+            sorted(row[2] for row in trips),
+            ['AAMV1', 'AAMV2', 'AAMV3', 'AAMV4'])
+
     def test_export_gtfs_test2(self):
         '''Try exporting test2.zip'''
         test_path = os.path.abspath(os.path.join(fixtures_dir, 'test2.zip'))
@@ -889,3 +1270,126 @@ route_id,service_id,trip_id,direction_id,block_id,shape_id,trip_type
 route_id,service_id,trip_id,direction_id,block_id,shape_id
 34,W.411,5215038,0,3401,235511
 ''')
+
+
+@skipUnless(
+    connection.vendor == 'postgresql', 'Parallel imports need PostgreSQL')
+class FeedParallelTest(TransactionTestCase):
+    '''Imports and exports with several jobs, outside of a transaction'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_feed(self, files):
+        for name, content in files.items():
+            with open(os.path.join(self.temp_dir, name), 'w') as txt_file:
+                txt_file.write(content)
+
+    def test_import_gtfs_test1_jobs(self):
+        '''test1.zip is imported by several threads'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        threads = set()
+
+        def note_thread(sender, **kwargs):
+            threads.add(threading.current_thread().ident)
+
+        file_started.connect(note_thread)
+        try:
+            feed = Feed.objects.create()
+            feed.import_gtfs(test_path, jobs=4)
+        finally:
+            file_started.disconnect(note_thread)
+        self.assertNotIn(threading.current_thread().ident, threads)
+        self.assertEqual(Route.objects.count(), 5)
+        self.assertEqual(Service.objects.count(), 3)
+        self.assertEqual(ServiceDate.objects.count(), 1)
+        self.assertEqual(Stop.objects.count(), 9)
+        self.assertEqual(StopTime.objects.count(), 28)
+        self.assertEqual(Trip.objects.count(), 11)
+        self.assertEqual(Frequency.objects.count(), 11)
+
+    def export_files(self, feed, **kwargs):
+        '''Export the feed, and return the (name, content) of the files'''
+        path = os.path.join(self.temp_dir, 'export.zip')
+        feed.export_gtfs(path, **kwargs)
+        with zipfile.ZipFile(path, 'r') as z_out:
+            return [(name, z_out.read(name)) for name in z_out.namelist()]
+
+    def test_export_gtfs_test1_jobs(self):
+        '''Files exported in threads match a serial export'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        expected = self.export_files(feed)
+        self.assertEqual(self.export_files(feed, jobs=3), expected)
+        self.assertEqual(
+            self.export_files(feed, jobs=3, use_copy=True), expected)
+
+    def test_export_parallel(self):
+        '''Files are exported in threads, and written in order'''
+        test_path = os.path.abspath(os.path.join(fixtures_dir, 'test1.zip'))
+        feed = Feed.objects.create()
+        feed.import_gtfs(test_path)
+        logged = []
+
+        def log_file(klass, record_count, start_time):
+            logged.append((klass, record_count))
+
+        path = os.path.join(self.temp_dir, 'export.zip')
+        with zipfile.ZipFile(path, 'w') as z:
+            feed._export_parallel(
+                z, [Stop, Transfer, Route, Agency], False, False, None, 2,
+                log_file)
+        with zipfile.ZipFile(path, 'r') as z_out:
+            self.assertEqual(
+                z_out.namelist(), ['stops.txt', 'routes.txt', 'agency.txt'])
+        self.assertEqual(logged, [(Stop, 9), (Route, 5), (Agency, 1)])
+
+    def test_import_gtfs_calendar_dates_only_jobs(self):
+        '''Services only in calendar_dates.txt are created once'''
+        self.write_feed({
+            'agency.txt': '''\
+agency_id,agency_name,agency_url,agency_timezone
+DTA,Demo Transit Authority,http://google.com,America/Los_Angeles
+''',
+            'stops.txt': '''\
+stop_id,stop_name,stop_lat,stop_lon
+BEATTY_AIRPORT,Nye County Airport,36.868446,-116.784582
+BULLFROG,Bullfrog,36.88108,-116.81797
+''',
+            'routes.txt': '''\
+route_id,agency_id,route_short_name,route_long_name,route_type
+AB,DTA,10,Airport - Bullfrog,3
+''',
+            'calendar_dates.txt': '''\
+service_id,date,exception_type
+WE,20070602,1
+WE,20070603,1
+HOL,20070704,1
+''',
+            'trips.txt': '''\
+route_id,service_id,trip_id
+AB,WE,AB1
+AB,HOL,AB2
+''',
+            'stop_times.txt': '''\
+trip_id,arrival_time,departure_time,stop_id,stop_sequence
+AB1,8:00:00,8:00:00,BEATTY_AIRPORT,1
+AB1,8:10:00,8:15:00,BULLFROG,2
+AB2,12:05:00,12:05:00,BULLFROG,1
+AB2,12:15:00,12:15:00,BEATTY_AIRPORT,2
+''',
+        })
+        feed = Feed.objects.create()
+        feed.import_gtfs(self.temp_dir, jobs=4)
+        services = Service.objects.in_feed(feed)
+        self.assertEqual(
+            sorted(services.values_list('service_id', flat=True)),
+            ['HOL', 'WE'])
+        we = services.get(service_id='WE')
+        self.assertEqual(we.servicedate_set.count(), 2)
+        self.assertEqual(
+            list(we.trip_set.values_list('trip_id', flat=True)), ['AB1'])
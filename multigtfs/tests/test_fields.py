@@ -17,7 +17,8 @@ from __future__ import unicode_literals
 
 from django.test import TestCase
 
-from multigtfs.models.fields import Seconds, SecondsField
+from multigtfs.models.fields import (
+    Seconds, SecondsField, format_times, parse_times)
 
 
 class SecondsTest(TestCase):
@@ -51,6 +52,21 @@ class SecondsTest(TestCase):
         self.assertFalse(one_hour < one_hour2)
         self.assertTrue(one_hour <= one_hour2)
 
+    def test_cached(self):
+        self.assertIs(Seconds(3600), Seconds.from_hms(hours=1))
+        self.assertEqual(hash(Seconds(3600)), hash(Seconds(3600)))
+        with self.assertRaises(AttributeError):
+            Seconds(3600).seconds = 60
+
+    def test_parse_times(self):
+        self.assertEqual(
+            [21600, None, 90060, 7],
+            parse_times(['06:00:00', '', '25:01', '7']))
+
+    def test_format_times(self):
+        self.assertEqual(
+            ['00:00:00', '', '25:01:01'], format_times([0, None, 90061]))
+
 
 class SecondsFieldTest(TestCase):
 
@@ -86,3 +102,7 @@ class SecondsFieldTest(TestCase):
 
     def test_prep_db_value_None(self):
         self.assertIsNone(self.f.get_prep_value(None))
+
+    def test_from_db_value_int(self):
+        self.assertEqual(
+            Seconds(500), self.f.from_db_value(500, None, None, None))
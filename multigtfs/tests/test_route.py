@@ -156,3 +156,19 @@ AB,DTA,10,Airport - Bullfrog,Our Airport Route,3,http://example.com,\
         self.assertEqual(route.geometry.coords, (((1.0, 2.0), (1.0, 3.0)),))
         route.update_geometry()
         self.assertEqual(route.geometry.coords, (((1.0, 2.0), (1.0, 3.0)),))
+
+    def test_update_geometries(self):
+        route1 = Route.objects.create(feed=self.feed, route_id='R1', rtype=3)
+        route2 = Route.objects.create(
+            feed=self.feed, route_id='R2', rtype=3,
+            geometry='MULTILINESTRING((1 2, 1 3))')
+        Trip.objects.create(route=route1, geometry='LINESTRING(1 2, 1 3)')
+        Trip.objects.create(route=route1, geometry='LINESTRING(1 2, 1 3)')
+        Trip.objects.create(route=route1, geometry='LINESTRING(1 2, 1 4)')
+        Trip.objects.create(route=route2, geometry='LINESTRING(1 2, 1 3)')
+        self.assertEqual(Route.update_geometries(self.feed), 1)
+        route1 = Route.objects.get(id=route1.id)
+        self.assertEqual(
+            route1.geometry.coords,
+            (((1.0, 2.0), (1.0, 3.0)), ((1.0, 2.0), (1.0, 4.0))))
+        self.assertEqual(Route.update_geometries(self.feed), 0)
@@ -19,6 +19,7 @@ from django.contrib.gis.geos import MultiLineString
 from django.test import TestCase
 from django.utils.six import StringIO
 
+from multigtfs.geometries import GeometryBatch
 from multigtfs.models import Feed, Route, Shape, ShapePoint, Trip
 
 
@@ -124,6 +125,27 @@ S1,36.425288,-117.133162,1,
         self.assertEqual(shape_pt.sequence, 1)
         self.assertEqual(shape_pt.traveled, None)
 
+    def test_import_shape_geometries(self):
+        '''Shape geometries are built during import, in sequence order'''
+        shape_txt = StringIO("""\
+shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence
+S1,36.42,-117.13,2
+S1,36.425288,-117.133162,1
+S2,36.5,-117.5,1
+S3,36.6,-117.6,1
+S2,36.51,-117.51,2
+S3,36.61,-117.61,2
+""")
+        ShapePoint.import_txt(shape_txt, self.feed)
+        shapes = dict(
+            (shape.shape_id, shape.geometry.coords)
+            for shape in Shape.objects.all())
+        self.assertEqual(shapes, {
+            'S1': ((-117.133162, 36.425288), (-117.13, 36.42)),
+            'S2': ((-117.5, 36.5), (-117.51, 36.51)),
+            'S3': ((-117.6, 36.6), (-117.61, 36.61)),
+        })
+
     def test_export_shape_empty(self):
         shape_txt = ShapePoint.export_txt(self.feed)
         self.assertFalse(shape_txt)
@@ -168,6 +190,20 @@ S1,36.425288,-117.133162,1,1.1
         self.assertEqual(route.geometry,
                          MultiLineString(shape.geometry, srid=4326))
 
+    def test_shapepoint_save_bumps_version_once(self):
+        shape = Shape.objects.create(feed=self.feed)
+        route = Route.objects.create(feed=self.feed, rtype=3)
+        Trip.objects.create(shape=shape, route=route)
+        ShapePoint.objects.create(
+            shape=shape, point="POINT(-117.133162 36.425288)", sequence=1)
+        point = ShapePoint.objects.create(
+            shape=shape, point="POINT(-117.13 36.42)", sequence=2)
+        # One bump per record, none for the updated geometries
+        self.assertEqual(Feed.objects.get(id=self.feed.id).version, 5)
+
+        point.delete()
+        self.assertEqual(Feed.objects.get(id=self.feed.id).version, 6)
+
     def test_update_geometry_no_parent(self):
         shape = Shape.objects.create(feed=self.feed)
         route = Route.objects.create(feed=self.feed, rtype=3)
@@ -190,6 +226,29 @@ S1,36.425288,-117.133162,1,1.1
             ((-117.133162, 36.425288), (-117.13, 36.42)))
         self.assertIsNone(trip.geometry, None)
 
+    def test_update_geometry_in_batch(self):
+        shape = Shape.objects.create(feed=self.feed)
+        route = Route.objects.create(feed=self.feed, rtype=3)
+        trip = Trip.objects.create(shape=shape, route=route)
+        with GeometryBatch():
+            ShapePoint.objects.create(
+                shape=shape, point="POINT(-117.133162 36.425288)",
+                sequence=1)
+            ShapePoint.objects.create(
+                shape=shape, point="POINT(-117.13 36.42)", sequence=2)
+            self.assertIsNone(Shape.objects.get(id=shape.id).geometry)
+
+        shape = Shape.objects.get(id=shape.id)
+        trip = Trip.objects.get(id=trip.id)
+        route = Route.objects.get(id=route.id)
+        self.assertEqual(
+            shape.geometry.coords,
+            ((-117.133162, 36.425288), (-117.13, 36.42)))
+        self.assertFalse(shape.geometry_dirty)
+        self.assertEqual(trip.geometry, shape.geometry)
+        self.assertEqual(route.geometry,
+                         MultiLineString(shape.geometry, srid=4326))
+
     def test_shape_geometry_is_ordered(self):
         '''Shape geometry is ordered by ShapePoint sequence
 
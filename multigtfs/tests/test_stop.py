@@ -198,6 +198,64 @@ http://example.com,1,,America/Los_Angeles
         stop = Stop.objects.get(stop_id='FUR_CREEK_RES')
         self.assertEqual(stop.parent_station, station)
 
+    def test_import_stops_txt_unknown_parent_station(self):
+        '''An unknown parent_station is logged and left unset'''
+        stops_txt = StringIO("""\
+stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station
+FUR_CREEK_RES,Furnace Creek Resort,36.425288,-117.133162,0,FUR_CREEK_STA
+""")
+        count = Stop.import_txt(stops_txt, self.feed)
+        self.assertEqual(count, 1)
+        stop = Stop.objects.get()
+        self.assertEqual(stop.stop_id, 'FUR_CREEK_RES')
+        self.assertEqual(stop.parent_station, None)
+
+    def test_update_stops_txt(self):
+        Stop.import_txt(StringIO("""\
+stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station
+FUR_CREEK_RES,Furnace Creek Resort,36.425288,-117.133162,0,FUR_CREEK_STA
+FUR_CREEK_STA,Furnace Creek Station,36.425288,-117.133162,1,
+NADAV,North Ave / D Ave N,36.914893,-116.76821,0,
+"""), self.feed)
+        res = Stop.objects.get(stop_id='FUR_CREEK_RES')
+        station = Stop.objects.get(stop_id='FUR_CREEK_STA')
+        nadav = Stop.objects.get(stop_id='NADAV')
+        changes = Stop.update_txt(StringIO("""\
+stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station
+FUR_CREEK_RES,Furnace Creek Resort,36.425288,-117.133162,0,
+FUR_CREEK_STA,Furnace Creek Station,36.425288,-117.133162,1,
+NADAV,North Ave / D Ave N,36.9,-116.76821,0,
+BEATTY_AIRPORT,Nye County Airport,36.868446,-116.784582,0,
+"""), self.feed)
+        new = Stop.objects.get(stop_id='BEATTY_AIRPORT')
+        self.assertEqual(changes['inserted'], set([new.id]))
+        self.assertEqual(changes['updated'], set([res.id, nadav.id]))
+        self.assertEqual(changes['deleted'], 0)
+        self.assertEqual(changes['unchanged'], 2)
+        self.assertEqual(Stop.objects.get(id=station.id), station)
+        self.assertEqual(Stop.objects.get(id=res.id).parent_station, None)
+        self.assertEqual(Stop.objects.get(id=nadav.id).point.y, 36.9)
+
+        changes = Stop.update_txt(StringIO("""\
+stop_id,stop_name,stop_lat,stop_lon,location_type,parent_station
+FUR_CREEK_STA,Furnace Creek Station,36.425288,-117.133162,1,
+"""), self.feed)
+        self.assertEqual(changes['deleted'], 3)
+        self.assertEqual(list(Stop.objects.all()), [station])
+
+    def test_update_stops_txt_unchanged(self):
+        stops_txt = """\
+stop_id,stop_name,stop_lat,stop_lon
+FUR_CREEK_RES,Furnace Creek Resort,36.425288,-117.133162
+NADAV,North Ave / D Ave N,36.914893,-116.76821
+"""
+        Stop.import_txt(StringIO(stops_txt), self.feed)
+        changes = Stop.update_txt(StringIO(stops_txt), self.feed)
+        self.assertEqual(changes['inserted'], set())
+        self.assertEqual(changes['updated'], set())
+        self.assertEqual(changes['deleted'], 0)
+        self.assertEqual(changes['unchanged'], 2)
+
     def test_import_stops_txt_stop_before_station_plus_extra(self):
         stops_txt = StringIO("""\
 stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id,stop_url,\
@@ -261,6 +319,36 @@ stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id,stop_url
         self.assertEqual(stop.zone, None)
         self.assertEqual(stop.url, '')
 
+    def test_import_stops_txt_populated_columns(self):
+        stops_txt = StringIO("""\
+stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon,zone_id
+FUR_CREEK_RES,,Furnace Creek Resort (Demo),Resort,36.425288,-117.133162,
+""")
+        Stop.import_txt(stops_txt, self.feed)
+        self.assertEqual(
+            self.feed.meta['populated_columns']['Stop'], ['stop_desc'])
+
+        Stop.objects.update(code='FC')
+        self.assertEqual(Stop.export_txt(self.feed), """\
+stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon
+FUR_CREEK_RES,FC,Furnace Creek Resort (Demo),Resort,36.425288,-117.133162
+""")
+        header = next(Stop.export_batches(self.feed, cached_columns=True))
+        self.assertEqual(header, [[
+            'stop_id', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon']])
+
+    def test_update_stops_txt_populated_columns(self):
+        Stop.import_txt(StringIO("""\
+stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon
+FUR_CREEK_RES,,Furnace Creek Resort (Demo),Resort,36.425288,-117.133162
+"""), self.feed)
+        Stop.update_txt(StringIO("""\
+stop_id,stop_code,stop_name,stop_desc,stop_lat,stop_lon
+FUR_CREEK_RES,FC,Furnace Creek Resort (Demo),,36.425288,-117.133162
+"""), self.feed)
+        self.assertEqual(
+            self.feed.meta['populated_columns']['Stop'], ['stop_code'])
+
     def test_export_stops_txt_none(self):
         stops_txt = Stop.export_txt(self.feed)
         self.assertFalse(stops_txt)
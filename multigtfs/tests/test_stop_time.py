@@ -20,6 +20,9 @@ from django.test import TestCase
 from django.utils.six import StringIO
 
 from multigtfs.models import Feed, Route, Stop, StopTime, Trip
+from multigtfs.models import base
+from multigtfs.models.base import ImportPlan, UniqueKeys
+from multigtfs.signals import batch_flushed
 
 
 class StopTimeTest(TestCase):
@@ -71,6 +74,102 @@ STBA,7:00:00,7:00:00,XXX,1
         self.assertEqual(stoptime.trip, self.trip)
         self.assertEqual(str(stoptime.arrival_time), '06:00:00')
 
+    def test_import_stop_times_txt_duplicate_database(self):
+        Stop.objects.create(
+            feed=self.feed, stop_id='XXX',
+            point="POINT(-117.133 36.425)")
+        stop_times_txt = StringIO("""\
+trip_id,arrival_time,departure_time,stop_id,stop_sequence
+STBA,6:00:00,6:00:00,STAGECOACH,1
+STBA,7:00:00,7:00:00,XXX,1
+STBA,8:00:00,8:00:00,XXX,2
+""")
+        count = StopTime.import_txt(
+            stop_times_txt, self.feed, dedupe='database')
+        self.assertEqual(count, 2)
+        first, second = StopTime.objects.order_by('stop_sequence')
+        self.assertEqual(str(first.arrival_time), '06:00:00')
+        self.assertEqual(str(second.arrival_time), '08:00:00')
+
+    def test_import_stop_times_txt_duplicates_database(self):
+        '''Many duplicated keys are deleted in one query'''
+        lines = ['trip_id,arrival_time,departure_time,stop_id,stop_sequence']
+        for sequence in range(1, 21):
+            for hour in (6, 7, 8):
+                lines.append('STBA,%d:%02d:00,%d:%02d:00,STAGECOACH,%d' % (
+                    hour, sequence, hour, sequence, sequence))
+        stop_times_txt = StringIO('\n'.join(lines) + '\n')
+        count = StopTime.import_txt(
+            stop_times_txt, self.feed, dedupe='database')
+        self.assertEqual(count, 20)
+        stop_times = StopTime.objects.order_by('stop_sequence')
+        self.assertEqual(
+            [str(st.arrival_time) for st in stop_times],
+            ['06:%02d:00' % sequence for sequence in range(1, 21)])
+        with self.assertNumQueries(1):
+            deleted = StopTime._delete_duplicates(
+                self.feed, ('trip_id', 'stop_sequence'))
+        self.assertEqual(deleted, 0)
+
+    def test_import_stop_times_txt_resume(self):
+        '''An interrupted import continues after the last saved batch'''
+        header = 'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+        lines = [
+            'STBA,6:00:00,6:00:00,STAGECOACH,1\n',
+            'STBA,7:00:00,7:00:00,STAGECOACH,1\n',
+            'STBA,8:00:00,8:00:00,STAGECOACH,2\n',
+        ]
+        count = StopTime.import_txt(
+            StringIO(header + lines[0]), self.feed, checkpoint='st.txt')
+        self.assertEqual(count, 1)
+        progress = self.feed.meta['import_progress']['st.txt']
+        self.assertEqual(progress['line'], 2)
+        self.assertTrue(progress['complete'])
+        progress['complete'] = False  # Interrupted before the next batch
+
+        flushed = []
+
+        def on_batch_flushed(sender, **kwargs):
+            flushed.append(kwargs)
+
+        batch_flushed.connect(on_batch_flushed)
+        try:
+            count = StopTime.import_txt(
+                StringIO(header + ''.join(lines)), self.feed,
+                checkpoint='st.txt')
+        finally:
+            batch_flushed.disconnect(on_batch_flushed)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(flushed), 1)
+        self.assertEqual(flushed[0]['rows'], 1)
+        self.assertEqual(flushed[0]['total_rows'], 2)
+        if flushed[0]['rows_per_second'] is not None:
+            # Just the row loaded by this import
+            self.assertAlmostEqual(
+                flushed[0]['rows_per_second'] * flushed[0]['elapsed'], 1)
+        arrivals = [
+            str(st.arrival_time)
+            for st in StopTime.objects.order_by('stop_sequence')]
+        self.assertEqual(arrivals, ['06:00:00', '08:00:00'])
+        count = StopTime.import_txt(
+            StringIO(header + ''.join(lines)), self.feed,
+            checkpoint='st.txt')
+        self.assertIsNone(count)
+
+    def test_unique_keys_saved(self):
+        '''Duplicates of saved rows are confirmed in the database'''
+        plan = ImportPlan(
+            StopTime, self.feed, ['trip_id', 'stop_id', 'stop_sequence'])
+        unique_keys = UniqueKeys(plan)
+        row = ['STBA', 'STAGECOACH', '1']
+        fields, _ = plan.convert(row)
+        self.assertIsNone(unique_keys.add(plan.unique_key(row), 2, fields))
+        self.assertEqual(unique_keys.add(plan.unique_key(row), 3, fields), 2)
+        unique_keys.saved()
+        StopTime.objects.create(**fields)
+        self.assertEqual(unique_keys.add(plan.unique_key(row), 4, fields), 0)
+        self.assertEqual(len(unique_keys), 1)
+
     def test_import_stop_times_txt_bad_column_empty_OK(self):
         stop_times_txt = StringIO("""\
 trip_id,arrival_time,departure_time,stop_id,stop_sequence,drop_off_time
@@ -119,6 +218,36 @@ STBA,6:00:00,6:00:00,STAGECOACH,1,"SC",2,1,5.25
         self.assertEqual(stoptime.drop_off_type, '1')
         self.assertEqual(stoptime.shape_dist_traveled, 5.25)
 
+    def test_import_stop_times_txt_copy(self):
+        '''COPY FROM STDIN is used on PostgreSQL, bulk_create elsewhere'''
+        stop_times_txt = StringIO("""\
+trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign,\
+pickup_type,drop_off_type,shape_dist_traveled,note
+STBA,6:00:00,6:00:00,STAGECOACH,1,"S\tC",2,1,5.25,"a\\b"
+STBA,,,STAGECOACH,2,,,,,
+STBA,6:00:00,6:00:00,STAGECOACH,1,Duplicate,,,,
+""")
+        count = StopTime.import_txt(
+            stop_times_txt, self.feed, use_copy=True)
+        self.assertEqual(count, 2)
+        first, second = StopTime.objects.order_by('stop_sequence')
+        self.assertEqual(first.trip, self.trip)
+        self.assertEqual(str(first.arrival_time), '06:00:00')
+        self.assertEqual(str(first.departure_time), '06:00:00')
+        self.assertEqual(first.stop, self.stop)
+        self.assertEqual(first.stop_sequence, 1)
+        self.assertEqual(first.stop_headsign, 'S\tC')
+        self.assertEqual(first.pickup_type, '2')
+        self.assertEqual(first.drop_off_type, '1')
+        self.assertEqual(first.shape_dist_traveled, 5.25)
+        self.assertEqual(first.extra_data, {'note': 'a\\b'})
+        self.assertEqual(second.stop_sequence, 2)
+        self.assertIsNone(second.arrival_time)
+        self.assertIsNone(second.departure_time)
+        self.assertEqual(second.stop_headsign, '')
+        self.assertIsNone(second.shape_dist_traveled)
+        self.assertEqual(second.extra_data, {})
+
     def test_import_stop_times_txt_empty_optional(self):
         stop_times_txt = StringIO("""\
 trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign,\
@@ -192,6 +321,99 @@ trip_id,arrival_time,departure_time,stop_id,stop_sequence
 STBA,06:00:00,06:00:00,STAGECOACH,1
 """)
 
+    def test_export_batches(self):
+        for sequence in range(1, 4):
+            StopTime.objects.create(
+                trip=self.trip, arrival_time='6:00:00',
+                departure_time='6:00:00', stop=self.stop,
+                stop_sequence=sequence)
+        old_batch_size = base.batch_size
+        base.batch_size = 2
+        try:
+            batches = list(StopTime.export_batches(self.feed))
+        finally:
+            base.batch_size = old_batch_size
+        self.assertEqual([len(rows) for rows in batches], [1, 2, 1])
+        self.assertEqual(batches[0], [[
+            'trip_id', 'arrival_time', 'departure_time', 'stop_id',
+            'stop_sequence']])
+        self.assertEqual(
+            batches[2], [['STBA', '06:00:00', '06:00:00', 'STAGECOACH', '3']])
+
+    def test_import_plan_convert_columns(self):
+        columns = [
+            'trip_id', 'arrival_time', 'departure_time', 'stop_id',
+            'stop_sequence']
+        plan = ImportPlan(StopTime, self.feed, columns)
+        rows = [
+            plan.convert(['STBA', '6:00:00', '6:00:00', 'STAGECOACH', '1'])[0],
+            plan.convert(['STBA', '', '', 'STAGECOACH', '2'])[0],
+            plan.convert(['STBA', '25:01'])[0],
+        ]
+        self.assertEqual(rows[0]['arrival_time'], '6:00:00')
+        plan.convert_columns(rows)
+        self.assertEqual(
+            [row['arrival_time'] for row in rows], [21600, None, 90060])
+        self.assertNotIn('departure_time', rows[2])
+
+    def test_export_typed_batches(self):
+        StopTime.objects.create(
+            trip=self.trip, arrival_time='25:00:00',
+            departure_time='25:01:00', stop=self.stop, stop_sequence=1,
+            shape_dist_traveled=5.25)
+        StopTime.objects.create(
+            trip=self.trip, stop=self.stop, stop_sequence=2)
+        batches = list(StopTime.export_typed_batches(self.feed))
+        self.assertEqual(batches[0], [
+            ('trip_id', 'text'), ('arrival_time', 'seconds'),
+            ('departure_time', 'seconds'), ('stop_id', 'text'),
+            ('stop_sequence', 'integer'), ('shape_dist_traveled', 'float')])
+        self.assertEqual(batches[1], [
+            ['STBA', 90000, 90060, 'STAGECOACH', 1, 5.25],
+            ['STBA', None, None, 'STAGECOACH', 2, None]])
+
+    def test_import_stop_times_typed(self):
+        class TypedRows(list):
+            '''Typed rows counting the rows read, like ParquetRows'''
+            line_num = 0
+
+            def __iter__(self):
+                for row in super(TypedRows, self).__iter__():
+                    self.line_num += 1
+                    yield row
+
+        rows = TypedRows([
+            ['trip_id', 'arrival_time', 'departure_time', 'stop_id',
+             'stop_sequence', 'shape_dist_traveled'],
+            ['STBA', 90000, 90060, 'STAGECOACH', 1, 0.0],
+            ['STBA', None, None, 'STAGECOACH', 2, None]])
+        count = StopTime.import_txt(rows, self.feed, typed=True)
+        self.assertEqual(count, 2)
+        first, second = StopTime.objects.order_by('stop_sequence')
+        self.assertEqual(str(first.arrival_time), '25:00:00')
+        self.assertEqual(str(first.departure_time), '25:01:00')
+        self.assertEqual(first.shape_dist_traveled, 0.0)
+        self.assertEqual(second.arrival_time, None)
+        self.assertEqual(second.shape_dist_traveled, None)
+
+    def test_import_stop_times_rows(self):
+        '''A new import reads every row, whatever the reader's line_num'''
+        rows = iter([
+            ['trip_id', 'arrival_time', 'departure_time', 'stop_id',
+             'stop_sequence'],
+            ['STBA', 90000, 90060, 'STAGECOACH', 1],
+            ['STBA', 90120, 90180, 'STAGECOACH', 2]])
+
+        class StuckRows(object):
+            line_num = 0
+
+            def __iter__(self):
+                return rows
+
+        count = StopTime.import_txt(StuckRows(), self.feed, typed=True)
+        self.assertEqual(count, 2)
+        self.assertEqual(StopTime.objects.count(), 2)
+
     def test_export_stop_times_maximal(self):
         StopTime.objects.create(
             trip=self.trip, arrival_time='6:00:00', departure_time='6:00:00',
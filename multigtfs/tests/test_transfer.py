@@ -81,6 +81,11 @@ STOP1,STOP2,,
         self.assertEqual(transfer.transfer_type, 0)
         self.assertEqual(transfer.min_transfer_time, None)
 
+    def test_import_transfers_txt_empty(self):
+        count = Transfer.import_txt(StringIO(''), self.feed)
+        self.assertEqual(count, 0)
+        self.assertFalse(Transfer.objects.exists())
+
     def test_export_transfers_empty(self):
         transfers_txt = Transfer.export_txt(self.feed)
         self.assertFalse(transfers_txt)
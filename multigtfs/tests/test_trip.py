@@ -91,6 +91,29 @@ R1,S1,T1,Headsign,HS,0,B1,S1,1,2
         self.assertEqual(trip.wheelchair_accessible, '1')
         self.assertEqual(trip.bikes_allowed, '2')
 
+    def test_import_trips_txt_new_blocks(self):
+        '''Missing blocks are created once, before the trips are saved'''
+        trips_txt = StringIO("""\
+route_id,service_id,trip_id,block_id
+R1,S1,T1,B1
+R1,S1,T2,B2
+R1,S1,T3,B3
+R1,S1,T4,B2
+R1,S1,T5,
+""")
+        Service.objects.create(
+            feed=self.feed, service_id='S1', start_date=date(2011, 4, 14),
+            end_date=date(2011, 12, 31))
+        block1 = Block.objects.create(feed=self.feed, block_id='B1')
+        Trip.import_txt(trips_txt, self.feed)
+        self.assertEqual(Block.objects.count(), 3)
+        block2 = Block.objects.get(block_id='B2')
+        block3 = Block.objects.get(block_id='B3')
+        blocks = dict(Trip.objects.values_list('trip_id', 'block'))
+        self.assertEqual(blocks, {
+            'T1': block1.id, 'T2': block2.id, 'T3': block3.id,
+            'T4': block2.id, 'T5': None})
+
     def test_import_trips_txt_multiple_services(self):
         '''
         If a trip is associated with several services, only one is created
@@ -193,3 +216,62 @@ R1,S1,T1,Headsign,HS,0,B1,S1,2,1
         self.assertEqual(
             trip.geometry.coords,
             ((-117.133162, 36.425288), (-117.14, 36.43)))
+
+    def test_update_geometries(self):
+        stop1 = Stop.objects.create(
+            feed=self.feed, stop_id='STAGECOACH',
+            point="POINT(-117.133162 36.425288)")
+        stop2 = Stop.objects.create(
+            feed=self.feed, stop_id='TAVERN',
+            point="POINT(-117.14 36.43)")
+        shape = Shape.objects.create(
+            feed=self.feed, shape_id='S1',
+            geometry='LINESTRING(-117.133162 36.425288, -117.15 36.44)')
+        trip1 = Trip.objects.create(route=self.route, trip_id='T1')
+        trip2 = Trip.objects.create(
+            route=self.route, trip_id='T2', shape=shape)
+        Trip.objects.create(route=self.route, trip_id='T3')
+        StopTime.objects.create(
+            trip=trip1, stop=stop2, arrival_time=time(7),
+            departure_time=time(7), stop_sequence=2)
+        StopTime.objects.create(
+            trip=trip1, stop=stop1, arrival_time=time(6),
+            departure_time=time(6), stop_sequence=1)
+        self.assertEqual(Trip.update_geometries(self.feed), 2)
+        geometries = dict(Trip.objects.values_list('trip_id', 'geometry'))
+        self.assertEqual(
+            geometries['T1'].coords,
+            ((-117.133162, 36.425288), (-117.14, 36.43)))
+        self.assertEqual(geometries['T2'].coords, shape.geometry.coords)
+        self.assertEqual(geometries['T3'], None)
+        self.assertEqual(Trip.update_geometries(self.feed, [trip2.id]), 0)
+
+    def test_update_dirty_geometries(self):
+        stop1 = Stop.objects.create(
+            feed=self.feed, stop_id='STAGECOACH',
+            point="POINT(-117.133162 36.425288)")
+        stop2 = Stop.objects.create(
+            feed=self.feed, stop_id='TAVERN',
+            point="POINT(-117.14 36.43)")
+        trip = Trip.objects.create(route=self.route, trip_id='T1')
+        Trip.objects.create(route=self.route, trip_id='T2')
+        StopTime.objects.create(
+            trip=trip, stop=stop1, arrival_time=time(6),
+            departure_time=time(6), stop_sequence=1)
+        stop_time = StopTime.objects.create(
+            trip=trip, stop=stop2, arrival_time=time(7),
+            departure_time=time(7), stop_sequence=2)
+        dirty = Trip.objects.filter(geometry_dirty=True)
+        self.assertEqual(list(dirty.values_list('trip_id', flat=True)),
+                         ['T1'])
+        self.feed.update_dirty_geometries()
+        self.assertFalse(dirty.exists())
+        trip = Trip.objects.get(id=trip.id)
+        self.assertEqual(
+            trip.geometry.coords,
+            ((-117.133162, 36.425288), (-117.14, 36.43)))
+        self.assertEqual(Route.objects.get().geometry.coords, (
+            trip.geometry.coords,))
+
+        stop_time.delete()
+        self.assertTrue(Trip.objects.get(id=trip.id).geometry_dirty)
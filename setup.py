@@ -78,6 +78,7 @@ setup(
     url='https://github.com/tulsawebdevs/django-multi-gtfs',
     packages=find_packages(),
     install_requires=['Django>=1.8', 'jsonfield>=0.9.20'],
+    extras_require={'parquet': ['pyarrow']},
     keywords=['django', 'gtfs'],
     test_suite="run_tests",  # Ignored, but makes pyroma happy
     cmdclass={'test': my_test},